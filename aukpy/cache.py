@@ -0,0 +1,148 @@
+"""A cache of query results, for applications that run the same queries repeatedly against a database that rarely changes.
+Entries are keyed by the state of the database, so rebuilding or appending to a database invalidates them automatically.
+"""
+import os
+import sqlite3
+import threading
+import pandas as pd
+
+from collections import OrderedDict
+from typing import Any, Callable, List, Optional, Tuple, TypeVar
+
+
+T = TypeVar("T")
+CacheKey = Tuple[Any, ...]
+
+
+def database_fingerprint(db_conn: sqlite3.Connection) -> Optional[Tuple[Any, ...]]:
+    """Identify the current contents of the database behind a connection.
+    Changes when the database is modified, whether by this connection or another one.
+
+    Returns:
+        The fingerprint, or None for in-memory databases, which can't be identified.
+    """
+    path = db_conn.execute("PRAGMA database_list").fetchone()[2]
+    if not path:
+        return None
+    stats: List[Optional[Tuple[int, int]]] = []
+    for p in (path, path + "-wal"):
+        try:
+            st = os.stat(p)
+            stats.append((st.st_mtime_ns, st.st_size))
+        except FileNotFoundError:
+            stats.append(None)
+    # The file stats can miss a change within the filesystem's timestamp resolution that keeps the size,
+    # but data_version changes whenever another connection commits
+    data_version = db_conn.execute("PRAGMA data_version").fetchone()[0]
+    return path, tuple(stats), (db_conn.total_changes, data_version)
+
+
+def copy_result(result: T) -> T:
+    """Copy a result, so that callers can't modify the cached value."""
+    if isinstance(result, pd.DataFrame):
+        return result.copy()  # type: ignore
+    elif isinstance(result, list):
+        return list(result)  # type: ignore
+    else:
+        return result
+
+
+class ResultCache:
+    """An in-memory LRU cache of query results, bounded by the total number of rows stored.
+    Safe to share between threads.
+
+    Results from in-memory databases are never cached, since there's no way to tell whether they've changed.
+    """
+
+    def __init__(self, max_rows: int = 1000000):
+        self.max_rows = max_rows
+        self.rows = 0
+        self.hits = 0
+        self.misses = 0
+        # Key to (result, number of rows)
+        self._entries: "OrderedDict[CacheKey, Tuple[Any, int]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    @staticmethod
+    def key(
+        db_conn: sqlite3.Connection, kind: str, query: str, params: Tuple[Any, ...]
+    ) -> Optional[CacheKey]:
+        """The cache key of a query, or None if its results can't be cached.
+
+        Args:
+            db_conn:    The database connection.
+            kind:       The form of the result, e.g. rows or a dataframe.
+            query:      The sql query. Whitespace is normalized.
+            params:     The query parameters.
+        """
+        fingerprint = database_fingerprint(db_conn)
+        if fingerprint is None:
+            return None
+        return kind, " ".join(query.split()), tuple(params), fingerprint
+
+    def get(self, key: CacheKey) -> Optional[Any]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+        return copy_result(entry[0])
+
+    def put(self, key: CacheKey, result: Any, rows: int):
+        """Store a result. Results larger than the whole cache aren't stored."""
+        if rows > self.max_rows:
+            return
+        result = copy_result(result)
+        with self._lock:
+            # Anything cached for an older version of the same database file can never be hit again
+            path, files, _ = key[-1]
+            stale = [k for k in self._entries if k[-1][0] == path and k[-1][1] != files]
+            for k in stale:
+                self._remove(k)
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (result, rows)
+            self.rows += rows
+            while self.rows > self.max_rows:
+                self._remove(next(iter(self._entries)))
+
+    def _remove(self, key: CacheKey):
+        _, rows = self._entries.pop(key)
+        self.rows -= rows
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.rows = 0
+
+    def get_or_run(
+        self,
+        db_conn: sqlite3.Connection,
+        kind: str,
+        query: str,
+        params: Tuple[Any, ...],
+        run: Callable[[], T],
+    ) -> T:
+        """Get the cached result of a query, or run it and cache the result.
+
+        Args:
+            db_conn:    The database connection.
+            kind:       The form of the result, e.g. rows or a dataframe.
+            query:      The sql query.
+            params:     The query parameters.
+            run:        Runs the query. Its result must be a list of rows or a dataframe.
+        """
+        key = self.key(db_conn, kind, query, params)
+        if key is None:
+            return run()
+        cached = self.get(key)
+        if cached is not None:
+            return cached
+        result = run()
+        self.put(key, result, len(result))  # type: ignore
+        return result
@@ -0,0 +1,39 @@
+-- Secondary indexes, created after the bulk load.
+
+-- Fill in the derived date columns for databases built before they existed, as SamplingWrapper.df_processing would.
+-- day_of_year is counted as if every year were a leap year, so dates after February in other years are shifted by one.
+UPDATE sampling_event SET
+    year = CAST(strftime('%Y', observation_date, 'unixepoch') AS integer),
+    month = CAST(strftime('%m', observation_date, 'unixepoch') AS integer),
+    day_of_year = CAST(strftime('%j', observation_date, 'unixepoch') AS integer)
+        + (CAST(strftime('%m', observation_date, 'unixepoch') AS integer) > 2
+           AND strftime('%j', observation_date, 'unixepoch', 'start of year', '+1 year', '-1 day') = '365')
+WHERE day_of_year IS NULL AND observation_date IS NOT NULL;
+
+-- Foreign keys
+CREATE INDEX IF NOT EXISTS observation_sampling_event_id ON observation(sampling_event_id);
+CREATE INDEX IF NOT EXISTS observation_species_id ON observation(species_id);
+CREATE INDEX IF NOT EXISTS observation_breeding_id ON observation(breeding_id);
+CREATE INDEX IF NOT EXISTS observation_protocol_id ON observation(protocol_id);
+CREATE INDEX IF NOT EXISTS sampling_event_location_data_id ON sampling_event(location_data_id);
+CREATE INDEX IF NOT EXISTS sampling_event_observer_id ON sampling_event(observer_id);
+
+-- Columns filtered on by queries.Query
+CREATE INDEX IF NOT EXISTS observation_last_edited_date ON observation(last_edited_date);
+CREATE INDEX IF NOT EXISTS sampling_event_observation_date ON sampling_event(observation_date);
+CREATE INDEX IF NOT EXISTS sampling_event_day_of_year ON sampling_event(day_of_year);
+CREATE INDEX IF NOT EXISTS sampling_event_duration_minutes ON sampling_event(duration_minutes);
+CREATE INDEX IF NOT EXISTS species_scientific_name ON species(scientific_name);
+CREATE INDEX IF NOT EXISTS species_common_name ON species(common_name);
+CREATE INDEX IF NOT EXISTS location_data_country ON location_data(country);
+CREATE INDEX IF NOT EXISTS location_data_country_code ON location_data(country_code);
+CREATE INDEX IF NOT EXISTS location_data_state_code ON location_data(state_code);
+CREATE INDEX IF NOT EXISTS protocol_protocol_type ON protocol(protocol_type);
+
+-- Group checklists, for queries.Query.unique_checklists. Most observations aren't in a group.
+CREATE INDEX IF NOT EXISTS observation_group_identifier ON observation(group_identifier, species_id) WHERE group_identifier IS NOT NULL;
+
+-- Fill in the spatial index for databases built before it existed
+INSERT INTO location_rtree
+SELECT id, longitude, longitude, latitude, latitude FROM location_data
+WHERE longitude IS NOT NULL AND latitude IS NOT NULL AND id NOT IN (SELECT id FROM location_rtree);
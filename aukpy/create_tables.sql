@@ -14,8 +14,7 @@ CREATE TABLE IF NOT EXISTS location_data (
     usfws_code integer,
     atlas_block text,
     bcr_code integer,
-    iba_code text,
-    UNIQUE(country, state, county, locality_id, usfws_code, atlas_block, longitude, latitude)
+    iba_code text
 );
 
 CREATE TABLE IF NOT EXISTS species (
@@ -26,24 +25,21 @@ CREATE TABLE IF NOT EXISTS species (
     scientific_name text NOT NULL,
     subspecies_common_name text,
     subspecies_scientific_name text,
-    taxon_concept_id text,
-    UNIQUE(taxonomic_order, category, common_name, scientific_name, subspecies_common_name, subspecies_scientific_name, taxon_concept_id)
+    taxon_concept_id text
 );
 
 CREATE TABLE IF NOT EXISTS breeding (
     id integer PRIMARY KEY,
     breeding_code text,
     breeding_category text,
-    behavior_code text,
-    UNIQUE(breeding_code, breeding_category, behavior_code)
+    behavior_code text
 );
 
 CREATE TABLE IF NOT EXISTS protocol (
     id integer PRIMARY KEY,
     protocol_type text,
     protocol_code text,
-    project_code text,
-    UNIQUE(protocol_type, protocol_code, project_code)
+    project_code text
 );
 
 CREATE TABLE IF NOT EXISTS observer (
@@ -64,7 +60,10 @@ CREATE TABLE IF NOT EXISTS sampling_event (
     all_species_reported integer,
     number_observers integer,
     location_data_id integer,
-    UNIQUE(sampling_event_identifier),
+    year integer,
+    month integer,
+    -- Counted as if every year were a leap year
+    day_of_year integer,
     FOREIGN KEY (location_data_id) REFERENCES location_data(id)
 );
 
@@ -85,9 +84,29 @@ CREATE TABLE IF NOT EXISTS observation (
     reason text,
     species_comments text,
     exotic_code text,
-    UNIQUE(global_unique_identifier),
     FOREIGN KEY (sampling_event_id) REFERENCES sampling_event(id),
     FOREIGN KEY (species_id) REFERENCES species(id),
     FOREIGN KEY (breeding_id) REFERENCES breeding(id),
     FOREIGN KEY (protocol_id) REFERENCES protocol(id)
 );
+
+CREATE TABLE IF NOT EXISTS build_progress (
+    input_file text PRIMARY KEY,
+    seek_to integer NOT NULL
+);
+
+-- Spatial index over location coordinates, kept in sync with location_data by the trigger below.
+-- Each location is stored as a degenerate box.
+CREATE VIRTUAL TABLE IF NOT EXISTS location_rtree USING rtree(
+    id,
+    min_longitude,
+    max_longitude,
+    min_latitude,
+    max_latitude
+);
+
+CREATE TRIGGER IF NOT EXISTS location_rtree_insert AFTER INSERT ON location_data
+WHEN new.longitude IS NOT NULL AND new.latitude IS NOT NULL
+BEGIN
+    INSERT INTO location_rtree VALUES (new.id, new.longitude, new.longitude, new.latitude, new.latitude);
+END;
@@ -0,0 +1,8 @@
+-- Unique constraints on each table.
+-- Kept separate from the table definitions so that fast builds can create them after the bulk load.
+CREATE UNIQUE INDEX IF NOT EXISTS location_data_unique ON location_data(country, state, county, locality_id, usfws_code, atlas_block, longitude, latitude);
+CREATE UNIQUE INDEX IF NOT EXISTS species_unique ON species(taxonomic_order, category, common_name, scientific_name, subspecies_common_name, subspecies_scientific_name, taxon_concept_id);
+CREATE UNIQUE INDEX IF NOT EXISTS breeding_unique ON breeding(breeding_code, breeding_category, behavior_code);
+CREATE UNIQUE INDEX IF NOT EXISTS protocol_unique ON protocol(protocol_type, protocol_code, project_code);
+CREATE UNIQUE INDEX IF NOT EXISTS sampling_event_sampling_event_identifier ON sampling_event(sampling_event_identifier);
+CREATE UNIQUE INDEX IF NOT EXISTS observation_global_unique_identifier ON observation(global_unique_identifier);
@@ -3,14 +3,36 @@ The full dataset is distributed as a ~400GB csv file, much of which is redundant
 We store it in a fully normalized sqlite file instead, which reduces the size of the data
 and makes querying it much faster.
 """
+import bz2
+import csv
+import gzip
+import io
+import re
 import numpy as np
 import pandas as pd
-import pickle
 import sqlite3
-
+import tarfile
+import zipfile
+
+from collections import deque
+from concurrent.futures import Executor, ProcessPoolExecutor
+from contextlib import ExitStack, contextmanager
+from fnmatch import fnmatch
+from functools import partial
+from itertools import islice
 from pathlib import Path
 from time import time
-from typing import Dict, List, Optional, Tuple, Any
+from typing import (
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Tuple,
+    Union,
+    Any,
+)
 
 from aukpy import config
 
@@ -130,97 +152,329 @@ observer_query = """INSERT OR IGNORE INTO observer (string_id)
 VALUES(?)"""
 
 
-def create_tables(db):
+# Settings for bulk loading. Nothing is journaled or synced, so a build using these can't be resumed after a crash.
+BULK_PRAGMAS = (
+    # Only takes effect on a new database
+    "PRAGMA page_size = 65536",
+    "PRAGMA journal_mode = OFF",
+    "PRAGMA synchronous = OFF",
+    # In KiB, so 1GiB
+    "PRAGMA cache_size = -1048576",
+    "PRAGMA temp_store = MEMORY",
+    "PRAGMA locking_mode = EXCLUSIVE",
+)
+
+# Settings for a finished database
+SAFE_PRAGMAS = (
+    "PRAGMA locking_mode = NORMAL",
+    "PRAGMA journal_mode = WAL",
+    "PRAGMA synchronous = NORMAL",
+)
+
+
+def create_tables(db, defer_unique: bool = False):
+    """Create all tables.
+
+    Args:
+        db:           The database connection.
+        defer_unique: Don't create the unique indexes yet, see `create_unique_indexes`.
+    """
     sql = (Path(__file__).parent / "create_tables.sql").open().read()
     db.executescript(sql)
+    add_derived_columns(db)
+    if not defer_unique:
+        create_unique_indexes(db)
 
 
-def undo_compression(df: pd.DataFrame) -> pd.DataFrame:
-    """Undo the data compression performed when storing the dataframe in sqlite.
-    Mostly this is just converting things back into strings
+def add_derived_columns(db):
+    """Add the columns computed during preprocessing (see `TableWrapper.derived_columns`) to a database built before they existed.
+    They're filled in by `create_indexes`.
     """
-    g_prefix = "URN:CornellLabOfOrnithology:EBIRD:OBS"
-    df["global_unique_identifier"] = g_prefix + df["global_unique_identifier"].astype(
-        str
-    )
+    existing = {row[1] for row in db.execute("PRAGMA table_info(sampling_event)")}
+    for column in SamplingWrapper.derived_columns:
+        if column not in existing:
+            db.execute(f"ALTER TABLE sampling_event ADD COLUMN {column} integer")
+
+
+def create_unique_indexes(db):
+    """Create the indexes that enforce uniqueness in each table.
+    Builds don't need them, since the wrappers' caches already prevent duplicates, so fast builds create them at the end.
+    Databases built while the constraints were part of the table definitions already have an equivalent index,
+    which is kept instead of adding a second one that every insert would have to maintain.
+    """
+    sql = (Path(__file__).parent / "create_unique_indexes.sql").open().read()
+    for statement in sql.split(";"):
+        match = re.search(r"ON (\w+)\((.*)\)", statement)
+        if match is None:
+            continue
+        columns = tuple(c.strip() for c in match[2].split(","))
+        if not has_unique_index(db, match[1], columns):
+            db.execute(statement)
+
+
+def has_unique_index(db, table: str, columns: Tuple[str, ...]) -> bool:
+    """Whether a table has a unique index on exactly these columns, in this order."""
+    for _, name, unique, *_ in db.execute(f"PRAGMA index_list({table})").fetchall():
+        indexed = tuple(r[2] for r in db.execute(f"PRAGMA index_info({name})"))
+        if unique and indexed == columns:
+            return True
+    return False
+
+
+def set_pragmas(db, pragmas: Iterable[str]):
+    for pragma in pragmas:
+        db.execute(pragma).fetchall()
+
+
+def create_indexes(db):
+    """Create the secondary indexes used by queries, and gather statistics for the query planner.
+    Much faster to do once after a bulk load than to maintain the indexes during it.
+    """
+    add_derived_columns(db)
+    sql = (Path(__file__).parent / "create_indexes.sql").open().read()
+    db.executescript(sql)
+    db.execute("ANALYZE")
+    db.commit()
+
+
+# The prefixes stripped from identifier columns when they're stored
+ID_PREFIXES = {
+    "global_unique_identifier": "URN:CornellLabOfOrnithology:EBIRD:OBS",
+    "sampling_event_identifier": "S",
+    "locality_id": "L",
+    "observer_id": "obsr",
+    "usfws_code": "USFWS_",
+    "group_identifier": "G",
+}
+COMPRESSED_COLUMNS = tuple(ID_PREFIXES) + (
+    "observation_count",
+    "observation_date",
+    "time_observations_started",
+    "last_edited_date",
+)
 
-    df["observation_count"] = df["observation_count"].astype(str)
 
-    df["sampling_event_identifier"] = "S" + df["sampling_event_identifier"].astype(str)
+def integer_strings(values: np.ndarray) -> np.ndarray:
+    """Format an array of integral values (possibly stored as floats or strings) as strings."""
+    if not np.issubdtype(values.dtype, np.integer):
+        values = values.astype(float)
+    return values.astype(np.int64).astype(str).astype(object)
 
-    df["locality_id"] = "L" + df["locality_id"].astype(str)
 
-    df["observer_id"] = "obsr" + df["observer_id"].astype(str)
+def prefixed(prefix: str, values: np.ndarray) -> np.ndarray:
+    return prefix + integer_strings(values)
 
-    empty = df["usfws_code"].isna()
-    df.loc[~empty, "usfws_code"] = "USFWS_" + df[~empty]["usfws_code"].astype(
-        int
-    ).astype(str)
 
-    df["observation_date"] = pd.to_datetime(df["observation_date"] * 1e9).astype(str)
+def time_strings(seconds: np.ndarray) -> np.ndarray:
+    """Format seconds since midnight as HH:MM:SS."""
+    s = seconds.astype(np.int64)
+    return np.array(
+        [f"{x // 3600:02}:{x // 60 % 60:02}:{x % 60:02}" for x in s.tolist()],
+        dtype=object,
+    )
+
+
+def decode(
+    column: pd.Series,
+    labels: Callable[[np.ndarray], np.ndarray],
+    categorical: bool = False,
+) -> pd.Series:
+    """Decode a column by computing the label of each distinct value once.
+    Missing values stay missing.
+
+    Args:
+        column:         The column to decode.
+        labels:         Computes the decoded value of each element of an array of (non-null) stored values.
+        categorical:    Return a categorical column instead of strings.
+    """
+    codes, uniques = pd.factorize(column)
+    decoded = labels(np.asarray(uniques))
+    if categorical:
+        # Distinct stored values can decode to the same label (e.g. 1 and "1")
+        label_codes, categories = pd.factorize(pd.Series(decoded))
+        codes = np.append(label_codes, -1)[codes]
+        return pd.Series(
+            pd.Categorical.from_codes(codes, categories), index=column.index
+        )
+    # Missing values have code -1, so they pick up the trailing NaN
+    with_missing = np.append(decoded.astype(object), np.nan)
+    return pd.Series(with_missing[codes], index=column.index)
 
-    empty_time = df["time_observations_started"].isna()
-    s = pd.to_datetime(
-        df.loc[~empty_time, "time_observations_started"], unit="s"
-    ).dt.time.astype(str)
-    df.loc[~empty_time, "time_observations_started"] = s
 
-    not_empty_gi = ~df["group_identifier"].isna()
-    s = "G" + df[not_empty_gi]["group_identifier"].astype(float).astype(int).astype(str)
-    df.loc[not_empty_gi, "group_identifier"] = s
+def undo_compression(
+    df: pd.DataFrame,
+    columns: Optional[Iterable[str]] = None,
+    typed: bool = False,
+    categorical: bool = False,
+) -> pd.DataFrame:
+    """Undo the data compression performed when storing the dataframe in sqlite.
+    Mostly this is just converting things back into strings.
+    Columns are modified in place, and any that aren't in the dataframe are skipped, so the results of projected queries can be decompressed.
 
-    df["last_edited_date"] = pd.to_datetime(df["last_edited_date"]).astype(int)
+    Args:
+        df:             The results of a query.
+        columns:        The columns to decompress. Defaults to all of them.
+        typed:          Return dates as datetimes and start times as timedeltas, instead of strings.
+        categorical:    Return identifiers and dates as categoricals instead of strings. Much faster and smaller when values repeat.
+    """
+    if columns is None:
+        columns = COMPRESSED_COLUMNS
+    to_decompress = [c for c in columns if c in df.columns]
+
+    for column in to_decompress:
+        if column in ID_PREFIXES:
+            prefix = ID_PREFIXES[column]
+            if column == "global_unique_identifier":
+                # Every value is distinct, so there's nothing to gain from factorizing
+                df[column] = prefixed(prefix, df[column].to_numpy())
+            else:
+                df[column] = decode(df[column], partial(prefixed, prefix), categorical)
+        elif column == "observation_count":
+            df[column] = decode(df[column], lambda u: u.astype(str), categorical)
+        elif column == "observation_date":
+            if typed:
+                df[column] = pd.to_datetime(df[column], unit="s")
+            else:
+                df[column] = decode(
+                    df[column],
+                    lambda u: pd.to_datetime(u, unit="s").astype(str).to_numpy(),
+                    categorical,
+                )
+        elif column == "time_observations_started":
+            if typed:
+                df[column] = pd.to_timedelta(df[column], unit="s")
+            else:
+                df[column] = decode(df[column], time_strings, categorical)
+        elif column == "last_edited_date":
+            if typed:
+                df[column] = pd.to_datetime(df[column], unit="s")
+            else:
+                df[column] = df[column].astype(np.int64)
 
     return df
 
 
+def leap_day_of_year(dates: pd.Series) -> pd.Series:
+    """The day of the year of each date, counted as if every year were a leap year.
+    A given month and day always has the same value, so e.g. March 1st is 61 in every year.
+    """
+    after_feb = (dates.dt.month > 2) & ~dates.dt.is_leap_year
+    return dates.dt.dayofyear + after_feb.astype(int)
+
+
 class TableWrapper:
     table_name: str
     columns: Tuple[str, ...]
     insert_query: str
     unique_columns: Tuple[str, ...]
+    # Columns that aren't in the observations file, but are computed by df_processing and stored after `columns`
+    derived_columns: Tuple[str, ...] = ()
 
     @classmethod
     def df_processing(cls, df: pd.DataFrame) -> pd.DataFrame:
         return df
 
+    @classmethod
+    def process(cls, df: pd.DataFrame) -> pd.DataFrame:
+        """Run the table specific preprocessing on the columns of `df` that belong to this table.
+        The processed values replace the raw ones, so the frame can be passed to `insert` with `processed=True`.
+        Columns that are only created during insertion (i.e. foreign keys) are skipped.
+        """
+        present = [c for c in cls.columns if c in df.columns]
+        processed = cls.df_processing(df.loc[:, present])
+        df[list(processed.columns)] = processed
+        return df
+
     @classmethod
     def insert(
         cls,
         df: pd.DataFrame,
         db: sqlite3.Connection,
         cache: Optional[Dict[Any, int]] = None,
+        processed: bool = False,
+        update_existing: bool = False,
     ) -> Tuple[pd.DataFrame, Dict[Any, int]]:
-        """Insert a dataframe into this table"""
+        """Insert a dataframe into this table
+
+        Args:
+            df:              The dataframe to insert. The table's columns are replaced by a foreign key column.
+            db:              The database connection.
+            cache:           A map from unique column values to row IDs of rows already in the table.
+            processed:       Whether `process` has already been run on the dataframe.
+            update_existing: Overwrite the stored values of rows that are already in the table with the values in `df`.
+        """
         # Table specific preprocessing
         if cache is None:
             cache = {}
-        sub_frame = cls.df_processing(df.loc[:, list(cls.columns)])
+        if processed:
+            sub_frame = df.loc[:, list(cls.columns + cls.derived_columns)]
+        else:
+            sub_frame = cls.df_processing(df.loc[:, list(cls.columns)])
         max_id = db.execute("SELECT MAX(id) FROM {}".format(cls.table_name)).fetchone()[
             0
         ]
         max_id = max_id if max_id is not None else 0
-        # TODO: Optimization: Sort and drop_duplicates is probably faster.
-        groups_to_idx = sub_frame.fillna("").groupby(list(cls.unique_columns)).groups
-        new_idx = {g: idx[0] for g, idx in groups_to_idx.items() if g not in cache}
-        new_values = [sub_frame.loc[idx].tolist() for idx in new_idx.values()]  # type: ignore
 
-        db.executemany(cls.insert_query, new_values)
-        new_ids = dict(
-            zip(new_idx.keys(), range(max_id + 1, max_id + len(new_values) + 1))
+        codes, first, keys = cls.factorize(sub_frame)
+        is_new = np.array([k not in cache for k in keys], dtype=bool)
+        new_values = list(
+            sub_frame.iloc[first[is_new]].itertuples(index=False, name=None)
         )
-        cache.update(new_ids)
-        idx_id_map = {
-            idx: cache[group]
-            for group, indices in groups_to_idx.items()
-            for idx in indices
-        }
-        assert len(idx_id_map) == len(df)
-        as_series = pd.Series(idx_id_map)
-        df[f"{cls.table_name}_id"] = as_series
-        df.drop(list(cls.columns), axis=1, inplace=True)
+
+        db.executemany(cls.insert_query, new_values)
+        if update_existing and not is_new.all():
+            old_ids = [cache[k] for k, n in zip(keys, is_new) if not n]
+            old_values = sub_frame.iloc[first[~is_new]].itertuples(
+                index=False, name=None
+            )
+            db.executemany(
+                cls.update_query(sub_frame.columns),
+                [(*values, i) for values, i in zip(old_values, old_ids)],
+            )
+        new_keys = [k for k, n in zip(keys, is_new) if n]
+        cache.update(zip(new_keys, range(max_id + 1, max_id + len(new_keys) + 1)))
+
+        # Broadcast the ID of each group back to its rows
+        group_ids = np.array([cache[k] for k in keys], dtype=np.int64)
+        df[f"{cls.table_name}_id"] = group_ids[codes]
+        df.drop(list(sub_frame.columns), axis=1, inplace=True, errors="ignore")
         return df, cache
 
+    @classmethod
+    def update_query(cls, columns: Iterable[str]) -> str:
+        """The query overwriting `columns` of the row with a given ID."""
+        assignments = ", ".join(f"{c} = ?" for c in columns)
+        return f"UPDATE {cls.table_name} SET {assignments} WHERE id = ?"
+
+    @classmethod
+    def factorize(
+        cls, frame: pd.DataFrame
+    ) -> Tuple[np.ndarray, np.ndarray, List[Tuple[Any, ...]]]:
+        """Group the rows of a frame by this table's unique columns.
+
+        Returns:
+            The group of each row, the position of the first row of each group, and the unique column values of each group.
+            Groups are numbered in order of first appearance.
+        """
+        keys = frame.loc[:, list(cls.unique_columns)].fillna("")
+        if len(keys) == 0:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), []
+        codes = keys.groupby(list(cls.unique_columns), sort=False).ngroup().to_numpy()
+        _, first = np.unique(codes, return_index=True)
+        return codes, first, list(keys.take(first).itertuples(index=False, name=None))
+
+    @classmethod
+    def load_cache(cls, db: sqlite3.Connection) -> Dict[Any, int]:
+        """Rebuild the cache used by `insert` from the rows already in the table."""
+        frame = pd.read_sql_query(
+            "SELECT id, {} FROM {}".format(
+                ", ".join(cls.unique_columns), cls.table_name
+            ),
+            db,
+        )
+        _, first, keys = cls.factorize(frame)
+        return dict(zip(keys, frame["id"].iloc[first].tolist()))
+
 
 class LocationWrapper(TableWrapper):
     table_name = "location_data"
@@ -316,9 +570,10 @@ class SamplingWrapper(TableWrapper):
         "number_observers",
         "location_data_id",
     )
+    derived_columns = ("year", "month", "day_of_year")
     insert_query = """INSERT OR IGNORE INTO sampling_event
-        (sampling_event_identifier, observation_date, time_observations_started, observer_id, effort_distance_km, effort_area_ha, duration_minutes, trip_comments, all_species_reported, number_observers, location_data_id)
-        VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        (sampling_event_identifier, observation_date, time_observations_started, observer_id, effort_distance_km, effort_area_ha, duration_minutes, trip_comments, all_species_reported, number_observers, location_data_id, year, month, day_of_year)
+        VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
     """
     unique_columns = ("sampling_event_identifier",)
 
@@ -330,9 +585,13 @@ class SamplingWrapper(TableWrapper):
         df["observer_id"] = df["observer_id"].str[4:].astype(int)
 
         # Convert to integer and then convert from nanoseconds to seconds
-        df["observation_date"] = pd.to_datetime(df["observation_date"]).astype(int) // (
-            1e9
-        )
+        dates = pd.to_datetime(df["observation_date"])
+        df["observation_date"] = dates.astype(int) // (1e9)
+
+        # Stored separately so that seasonal queries can use an index
+        df["year"] = dates.dt.year
+        df["month"] = dates.dt.month
+        df["day_of_year"] = leap_day_of_year(dates)
 
         # Convert time to integer
         has_time = ~df["time_observations_started"].isna()
@@ -350,10 +609,23 @@ class SamplingWrapper(TableWrapper):
         df: pd.DataFrame,
         db: sqlite3.Connection,
         cache: Optional[Dict[Any, int]] = None,
+        processed: bool = False,
+        update_existing: bool = False,
     ) -> Tuple[pd.DataFrame, Dict[Any, int]]:
 
-        df, cache = LocationWrapper.insert(df, db, cache=cache)
-        return super().insert(df, db, cache=cache)
+        df, cache = LocationWrapper.insert(
+            df, db, cache=cache, processed=processed, update_existing=update_existing
+        )
+        return super().insert(
+            df, db, cache=cache, processed=processed, update_existing=update_existing
+        )
+
+    @classmethod
+    def load_cache(cls, db: sqlite3.Connection) -> Dict[Any, int]:
+        # Locations share a cache with sampling events
+        cache = LocationWrapper.load_cache(db)
+        cache.update(super().load_cache(db))
+        return cache
 
 
 class ObservationWrapper(TableWrapper):
@@ -427,11 +699,16 @@ class ObservationWrapper(TableWrapper):
         df: pd.DataFrame,
         db: sqlite3.Connection,
         cache: Optional[Dict[Any, int]] = None,
+        processed: bool = False,
+        update_existing: bool = False,
     ) -> Tuple[pd.DataFrame, Dict[Any, int]]:
+        # Observations are never updated in place, see `update_chunk`
         # Table specific preprocessing
         if cache is None:
             cache = {}
-        sub_frame = cls.df_processing(df.loc[:, list(cls.columns)])
+        sub_frame = df.loc[:, list(cls.columns)]
+        if not processed:
+            sub_frame = cls.df_processing(sub_frame)
         sub_frame.to_sql("observation", con=db, if_exists="append", index=False)
         return df, cache
 
@@ -463,29 +740,321 @@ def clean_raw_obs(df: pd.DataFrame) -> pd.DataFrame:
     return df
 
 
-def read_clean(input_path: Path) -> pd.DataFrame:
-    df = pd.read_csv(input_path, sep="\t")
+# Called with the number of bytes of the input file read so far, and its total size
+Progress = Callable[[int, int], None]
+
+# Suffixes of the data files in an eBird download, once decompressed
+DATA_SUFFIXES = (".txt", ".tsv")
+TAR_SUFFIXES = (".tar", ".tar.gz", ".tgz", ".tar.bz2", ".tbz2")
+
+
+def is_data_file(name: str, member: Optional[str] = None) -> bool:
+    """Whether a file in an archive is the one to read.
+
+    Args:
+        name:   The file's name in the archive.
+        member: A pattern matching the file's name or path. Defaults to any (possibly compressed) data file that isn't a sampling event file.
+    """
+    base = name.rsplit("/", 1)[-1]
+    if member is not None:
+        return fnmatch(name, member) or fnmatch(base, member)
+    for suffix in (".gz", ".bz2"):
+        base = base[: -len(suffix)] if base.endswith(suffix) else base
+    return base.lower().endswith(DATA_SUFFIXES) and "sampling" not in base.lower()
+
+
+def decompressed(
+    f: io.BufferedIOBase, name: str, stack: ExitStack
+) -> io.BufferedIOBase:
+    """Wrap a file so it's decompressed as it's read, according to its name."""
+    if name.lower().endswith(".gz"):
+        return stack.enter_context(gzip.GzipFile(fileobj=f, mode="rb"))
+    elif name.lower().endswith(".bz2"):
+        return stack.enter_context(bz2.BZ2File(f))
+    else:
+        return f
+
+
+@contextmanager
+def open_input(
+    input_path: Path, member: Optional[str] = None
+) -> Iterator[Tuple[io.BufferedIOBase, io.BufferedIOBase, str]]:
+    """Open an observations (or sampling event) file, decompressing it as it's read.
+    Plain, gzip and bz2 files are supported, as are zip and tar archives, which can themselves be compressed and contain compressed files.
+    Archives are read as a stream, nothing is extracted to disk.
+
+    Args:
+        input_path: The file.
+        member:     For archives, a pattern matching the name of the file to read, see `is_data_file`. The first match is read.
+
+    Returns:
+        The decompressed data, the file on disk, and the name of the archive member read (the file name if it isn't an archive).
+        The position of the file on disk is the number of compressed bytes read.
+    """
+    with ExitStack() as stack:
+        raw = stack.enter_context(input_path.open("rb"))
+        name = input_path.name.lower()
+        if name.endswith(TAR_SUFFIXES):
+            # Stream mode, members can only be read in order
+            archive = stack.enter_context(tarfile.open(fileobj=raw, mode="r|*"))
+            info = next(
+                (i for i in archive if i.isfile() and is_data_file(i.name, member)),
+                None,
+            )
+            if info is None:
+                raise FileNotFoundError(f"No data file in {input_path}")
+            member_file = archive.extractfile(info)
+            f = decompressed(member_file, info.name, stack)  # type: ignore
+            member_name = info.name
+        elif name.endswith(".zip"):
+            archive_zip = stack.enter_context(zipfile.ZipFile(raw))
+            names = [n for n in archive_zip.namelist() if is_data_file(n, member)]
+            if not names:
+                raise FileNotFoundError(f"No data file in {input_path}")
+            member_zip = stack.enter_context(archive_zip.open(names[0]))
+            f = decompressed(member_zip, names[0], stack)  # type: ignore
+            member_name = names[0]
+        else:
+            f = decompressed(raw, name, stack)
+            member_name = input_path.name
+        yield f, raw, member_name
+
+
+def read_clean(input_path: Path, member: Optional[str] = None) -> pd.DataFrame:
+    with open_input(input_path, member) as (f, _, _):
+        df = pd.read_csv(f, sep="\t", quoting=csv.QUOTE_NONE)  # type: ignore
     return clean_raw_obs(df)
 
 
+def normalize(df: pd.DataFrame) -> pd.DataFrame:
+    """Clean a raw observation dataframe and run every table's preprocessing on it.
+    The result can be inserted with `processed=True`, so this is the part of a build that doesn't need the database.
+
+    Args:
+        df: A dataframe directly read from an eBird observations file.
+    """
+    df = clean_raw_obs(df)
+    for wrapper in (LocationWrapper,) + WRAPPERS + (ObservationWrapper,):
+        df = wrapper.process(df)
+    return df
+
+
+def normalize_sampling(df: pd.DataFrame) -> pd.DataFrame:
+    """Clean a raw sampling event dataframe and run the checklist tables' preprocessing on it.
+    Sampling event files have the checklist columns of the observations file, and none of the species or observation columns.
+
+    Args:
+        df: A dataframe directly read from an eBird sampling event file.
+    """
+    df = clean_raw_obs(df)
+    for wrapper in (LocationWrapper, SamplingWrapper):
+        df = wrapper.process(df)
+    return df
+
+
+def parse_sampling_chunk(chunk: Tuple[int, bytes]) -> Tuple[int, pd.DataFrame]:
+    """Parse and normalize a chunk of a sampling event file, see `parse_chunk`."""
+    end, raw = chunk
+    df = pd.read_csv(
+        io.BytesIO(raw), sep="\t", quoting=csv.QUOTE_NONE, on_bad_lines="warn"
+    )
+    return end, normalize_sampling(df)
+
+
+def parse_chunk(chunk: Tuple[int, bytes]) -> Tuple[int, pd.DataFrame]:
+    """Parse and normalize a chunk of an observations file.
+    Runs in the worker processes of a parallel build.
+
+    Args:
+        chunk: The offset of the end of the chunk in the file, and the chunk itself.
+               The chunk is the header line of the file followed by some number of complete lines.
+    """
+    end, raw = chunk
+    df = pd.read_csv(
+        io.BytesIO(raw), sep="\t", quoting=csv.QUOTE_NONE, on_bad_lines="warn"
+    )
+    return end, normalize(df)
+
+
+def raw_chunks(
+    input_path: Path,
+    max_size: int,
+    seek_to: Union[int, Callable[[str], int]] = 0,
+    member: Optional[str] = None,
+    progress: Optional[Progress] = None,
+) -> Iterator[Tuple[int, bytes]]:
+    """Split an observations file into chunks of at most `max_size` lines.
+    Every chunk starts with the header line, so each one can be parsed independently.
+    Lines are split on newlines without parsing, which relies on eBird files being unquoted:
+    no field contains a tab or newline, and quotes are literal characters. They're parsed that way too, with `csv.QUOTE_NONE`.
+    The file can be compressed or in an archive, see `open_input`.
+
+    Args:
+        input_path: Path to the observations file.
+        max_size:   The maximum number of lines in a chunk.
+        seek_to:    The byte offset (in the decompressed data) to start reading from. The header is always read.
+                    Compressed or archived data is read and discarded up to the offset.
+                    Can also be a function of the name of the file read (see `open_input`) returning the offset.
+        member:     For archives, the file to read, see `open_input`.
+        progress:   Called after each chunk is read, with the number of bytes of `input_path` read so far and its size.
+
+    Returns:
+        An iterator of (the byte offset just past the end of the chunk, the chunk)
+    """
+    total = input_path.stat().st_size
+    with open_input(input_path, member) as (f, raw, name):
+        if callable(seek_to):
+            seek_to = seek_to(name)
+        header = f.readline()
+        if f is raw:
+            f.seek(max(seek_to, f.tell()))
+        else:
+            # Members of streamed tar archives can't seek, and decompressing streams only seek by reading anyway
+            while f.tell() < seek_to:
+                if not f.read(min(1 << 20, seek_to - f.tell())):
+                    break
+        while True:
+            lines = list(islice(f, max_size))
+            if not lines:
+                break
+            if progress is not None:
+                progress(raw.tell(), total)
+            yield f.tell(), header + b"".join(lines)
+
+
+def bounded_map(
+    executor: Executor, fn: Callable[[Any], Any], items: Iterable[Any], max_pending: int
+) -> Iterator[Any]:
+    """Like `executor.map`, but only `max_pending` items are submitted at a time.
+    `executor.map` consumes the whole input up front, which would read the entire observations file into memory.
+    Results are yielded in order.
+    """
+    pending: deque = deque()
+    for item in items:
+        pending.append(executor.submit(fn, item))
+        if len(pending) >= max_pending:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+def insert_chunk(
+    df: pd.DataFrame,
+    conn: sqlite3.Connection,
+    subtable_cache: Dict[str, Dict[Any, int]],
+    processed: bool = False,
+    update_existing: bool = False,
+):
+    """Insert a chunk of observations into every table. Does not commit.
+
+    Args:
+        df:              The observations.
+        conn:            The database connection.
+        subtable_cache:  The caches for each wrapper, keyed by wrapper name. Updated in place.
+        processed:       Whether `normalize` has already been run on the chunk.
+        update_existing: Overwrite dimension rows that already exist with the values in the chunk, see `TableWrapper.insert`.
+    """
+    for wrapper in WRAPPERS:
+        if wrapper.__name__ not in subtable_cache:
+            subtable_cache[wrapper.__name__] = {}
+        df, cache = wrapper.insert(
+            df,
+            conn,
+            cache=subtable_cache[wrapper.__name__],
+            processed=processed,
+            update_existing=update_existing,
+        )
+        subtable_cache[wrapper.__name__] = cache
+
+    # Store main observations table
+    ObservationWrapper.insert(df, conn, processed=processed)
+
+
+def progress_key(input_path: Path, name: str) -> str:
+    """The key of an input in the `build_progress` table.
+    For archives, this includes the member read, so e.g. the sampling event and observations files of one archive are tracked separately.
+
+    Args:
+        input_path: The input file.
+        name:       The name of the file read, as given by `open_input`.
+    """
+    if name == input_path.name:
+        return name
+    return f"{input_path.name}:{name}"
+
+
+def get_progress(conn: sqlite3.Connection, key: str) -> int:
+    """Get the offset in the input (see `progress_key`) up to which rows have been committed."""
+    row = conn.execute(
+        "SELECT seek_to FROM build_progress WHERE input_file = ?", (key,)
+    ).fetchone()
+    return row[0] if row is not None else 0
+
+
+def save_progress(conn: sqlite3.Connection, key: str, seek_to: int):
+    """Record the offset in the input (see `progress_key`) up to which rows have been inserted.
+    Should be committed in the same transaction as the rows themselves.
+    """
+    conn.execute(
+        "INSERT OR REPLACE INTO build_progress (input_file, seek_to) VALUES (?, ?)",
+        (key, seek_to),
+    )
+
+
+def start_build(output_path: Path, fast: bool) -> sqlite3.Connection:
+    """Open and set up the database for a build.
+
+    Raises:
+        FileExistsError: For a fast build into an existing database.
+            Without a journal, a failure would corrupt what's already there, and a resumed fast build could insert duplicates.
+    """
+    if fast and output_path.exists() and output_path.stat().st_size > 0:
+        raise FileExistsError(
+            f"{output_path} already exists, a fast build needs a new database"
+        )
+    conn = sqlite3.connect(str(output_path.absolute()))
+    if fast:
+        set_pragmas(conn, BULK_PRAGMAS)
+    create_tables(conn, defer_unique=fast)
+    return conn
+
+
+def finish_build(conn: sqlite3.Connection, index: bool, fast: bool):
+    """Create the indexes deferred during a build, and switch a fast build back to safe settings."""
+    if fast:
+        create_unique_indexes(conn)
+    if index:
+        create_indexes(conn)
+    if fast:
+        conn.commit()
+        set_pragmas(conn, SAFE_PRAGMAS)
+
+
 def build_db_pandas(
-    input_path: Path, output_path: Optional[Path] = None
+    input_path: Path,
+    output_path: Optional[Path] = None,
+    index: bool = True,
+    fast: bool = False,
+    member: Optional[str] = None,
 ) -> sqlite3.Connection:
     """Build a sqlite database using pandas to parse the CSV
 
     Args:
-        input_path (Path):                      Path to the CSV of observations
+        input_path (Path):                      Path to the CSV of observations. Can be compressed or in an archive, see `open_input`.
         output_path (Optional[Path], optional): Location to store the database. DB will be built in memory if None Defaults to None.
+        index (bool, optional):                 Whether to create the query indexes after loading. Defaults to True.
+        fast (bool, optional):                  Use settings for bulk loading, see `BULK_PRAGMAS`. The database is switched to WAL mode at the end.
+                                                The output can't be an existing database, and if a fast build fails it has to be deleted. Defaults to False.
+        member (Optional[str], optional):       For archives, the file to read, see `open_input`.
 
     Returns:
         sqlite3.Connection: A connection to the finished database.
     """
     if output_path is None:
         output_path = config.DATA_HOME / f"{input_path.stem}.sqlite"
-    conn = sqlite3.connect(str(output_path.absolute()))
-    create_tables(conn)
+    conn = start_build(output_path, fast)
     # TODO: Max lines and seek
-    df = read_clean(input_path)
+    df = read_clean(input_path, member)
 
     # Store subtables
     for wrapper in WRAPPERS:
@@ -494,47 +1063,252 @@ def build_db_pandas(
     # Store main observations table
     ObservationWrapper.insert(df, conn)
     conn.commit()
+    finish_build(conn, index, fast)
     return conn
 
 
 def build_db_incremental(
-    input_path: Path, output_path: Optional[Path] = None, max_size: int = 100000
+    input_path: Path,
+    output_path: Optional[Path] = None,
+    max_size: int = 100000,
+    workers: int = 1,
+    index: bool = True,
+    fast: bool = False,
+    member: Optional[str] = None,
+    progress: Optional[Progress] = None,
 ) -> sqlite3.Connection:
     """Build a database incrementally.
     Useful for very large observation files (e.g. any that don't easily fit in memory).
 
+    With more than one worker, chunks are parsed and normalized in a pool of worker processes,
+    while this process inserts them. Insertion has to be done by a single process, since it owns
+    the connection and the caches of dimension table IDs.
+
+    The offset of the last inserted chunk is committed along with it, so an interrupted build
+    can be resumed by calling this again with the same arguments.
+
+    The observations can be read straight from a compressed file or archive, e.g. an eBird download, see `open_input`.
+
     Args:
         input_path (Path):                      Path to the CSV of observations.
         output_path (Path):                     Location to store the database.
-        max_lines (int, optional):              The maximum number of bytes of the CSV to read at a time.
+        max_size (int, optional):               The maximum number of lines of the CSV to read at a time.
+        workers (int, optional):                The number of processes used to parse the CSV. Defaults to 1 (no parallelism).
+        index (bool, optional):                 Whether to create the query indexes after loading. Defaults to True.
+        fast (bool, optional):                  Use settings for bulk loading, see `BULK_PRAGMAS`. The database is switched to WAL mode at the end.
+                                                The output can't be an existing database, so a fast build can't be resumed; if it fails it has to be deleted. Defaults to False.
+        member (Optional[str], optional):       For archives, the file to read, see `open_input`.
+        progress (Optional[Progress], optional): Called as the input is read, with the number of bytes of `input_path` read so far and its size.
+                                                For compressed files this is the compressed size.
     """
     if output_path is None:
         output_path = config.DATA_HOME / f"{input_path.stem}.sqlite"
-    cache_meta_path = config.DATA_HOME / f"{output_path.stem}_meta.pkl"
 
-    if cache_meta_path.is_file():
-        cache_meta = pickle.load(cache_meta_path.open("rb"))
+    conn = start_build(output_path, fast)
+
+    # Resume from the last committed chunk, if there is one.
+    # The caches are rebuilt from the database, so a resumed build assigns the same IDs as an uninterrupted one.
+    key = input_path.name
+
+    def resume(name: str) -> int:
+        nonlocal key
+        key = progress_key(input_path, name)
+        return get_progress(conn, key)
+
+    subtable_cache = {
+        wrapper.__name__: wrapper.load_cache(conn) for wrapper in WRAPPERS
+    }
+    chunks = raw_chunks(
+        input_path, max_size, seek_to=resume, member=member, progress=progress
+    )
+
+    def insert(parsed: Iterable[Tuple[int, pd.DataFrame]]):
+        for end, df in parsed:
+            insert_chunk(df, conn, subtable_cache, processed=True)
+            save_progress(conn, key, end)
+            conn.commit()
+
+    if workers <= 1:
+        insert(map(parse_chunk, chunks))
     else:
-        cache_meta = {"seek_to": 0}
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            # Keep every worker busy while the writer is inserting, without reading too far ahead
+            insert(bounded_map(executor, parse_chunk, chunks, 2 * workers))
+    finish_build(conn, index, fast)
+    return conn
 
-    conn = sqlite3.connect(str(output_path.absolute()))
+
+def ingest_sampling(
+    input_path: Path,
+    db_path: Path,
+    max_size: int = 100000,
+    workers: int = 1,
+    index: bool = True,
+    member: Optional[str] = "*sampling*",
+    progress: Optional[Progress] = None,
+) -> sqlite3.Connection:
+    """Add the checklists in an eBird sampling event file to a database, creating it if necessary.
+    Together with the observations, this gives the checklists on which a species wasn't reported, see `queries.Query.zero_fill`.
+
+    Checklists and locations go through the same wrappers and caches as a build, so ones already in the database are reused,
+    and the observations and sampling event files can be loaded in either order
+    (observations have to be added to an existing database with `build_db_incremental`).
+    As with `build_db_incremental`, progress is committed with each chunk, so an interrupted ingest can be resumed.
+    `update_db` keeps the ingested checklists, except those whose every observation it removed,
+    which can be restored by ingesting the new release's sampling event file.
+
+    Args:
+        input_path:     Path to the sampling event file.
+        db_path:        The database to add the checklists to.
+        max_size:       The maximum number of lines of the file to read at a time.
+        workers:        The number of processes used to parse the file. Defaults to 1 (no parallelism).
+        index:          Whether to create the query indexes (if they don't exist) after loading. Defaults to True.
+        member:         For archives, the file to read, see `open_input`. Defaults to the first sampling event file.
+        progress:       Called as the input is read, see `build_db_incremental`.
+    """
+    conn = sqlite3.connect(str(db_path.absolute()))
     create_tables(conn)
+    key = input_path.name
 
-    # Load partial csv
-    subtable_cache: Dict[str, Dict[Any, int]] = {}
+    def resume(name: str) -> int:
+        nonlocal key
+        key = progress_key(input_path, name)
+        return get_progress(conn, key)
 
-    for df in pd.read_csv(
-        input_path, sep="\t", chunksize=max_size, on_bad_lines="warn"
-    ):
-        df = clean_raw_obs(df)
+    cache = SamplingWrapper.load_cache(conn)
+    chunks = raw_chunks(
+        input_path, max_size, seek_to=resume, member=member, progress=progress
+    )
 
-        for wrapper in WRAPPERS:
-            if wrapper.__name__ not in subtable_cache:
-                subtable_cache[wrapper.__name__] = {}
-            df, cache = wrapper.insert(df, conn, cache=subtable_cache[wrapper.__name__])
-            subtable_cache[wrapper.__name__] = cache
+    def insert(parsed: Iterable[Tuple[int, pd.DataFrame]]):
+        for end, df in parsed:
+            SamplingWrapper.insert(df, conn, cache=cache, processed=True)
+            save_progress(conn, key, end)
+            conn.commit()
 
-        # Store main observations table
-        ObservationWrapper.insert(df, conn)
-        conn.commit()
+    if workers <= 1:
+        insert(map(parse_sampling_chunk, chunks))
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            insert(bounded_map(executor, parse_sampling_chunk, chunks, 2 * workers))
+    if index:
+        create_indexes(conn)
+    return conn
+
+
+def update_chunk(
+    df: pd.DataFrame,
+    conn: sqlite3.Connection,
+    subtable_cache: Dict[str, Dict[Any, int]],
+) -> Tuple[int, int]:
+    """Apply a normalized chunk of a new release to the database. Does not commit.
+    Observations that are new, or whose last edited date changed, replace the stored ones. Everything else is skipped.
+
+    Returns:
+        The number of new and changed observations.
+    """
+    conn.execute("DELETE FROM temp.update_chunk")
+    conn.executemany(
+        "INSERT INTO temp.update_chunk VALUES (?)",
+        ((g,) for g in df["global_unique_identifier"]),
+    )
+    conn.execute(
+        "INSERT OR IGNORE INTO temp.update_seen SELECT guid FROM temp.update_chunk"
+    )
+    stored = pd.read_sql_query(
+        """SELECT guid, observation.last_edited_date FROM temp.update_chunk
+        JOIN observation ON observation.global_unique_identifier = guid""",
+        conn,
+    ).set_index("guid")["last_edited_date"]
+
+    guids = df["global_unique_identifier"]
+    previous = guids.map(stored)
+    is_new = previous.isna()
+    changed = ~is_new & (previous != df["last_edited_date"])
+    if not (is_new | changed).any():
+        return 0, 0
+
+    changed_guids = [(g,) for g in guids[changed]]
+    # Their checklists may be left empty if the new versions moved elsewhere
+    conn.executemany(
+        """INSERT OR IGNORE INTO temp.update_emptied
+        SELECT sampling_event_id FROM observation WHERE global_unique_identifier = ?""",
+        changed_guids,
+    )
+    conn.executemany(
+        "DELETE FROM observation WHERE global_unique_identifier = ?",
+        changed_guids,
+    )
+    insert_chunk(
+        df.loc[is_new | changed].copy(),
+        conn,
+        subtable_cache,
+        processed=True,
+        update_existing=True,
+    )
+    return int(is_new.sum()), int(changed.sum())
+
+
+def update_db(
+    input_path: Path,
+    db_path: Path,
+    max_size: int = 100000,
+    workers: int = 1,
+    member: Optional[str] = None,
+    progress: Optional[Progress] = None,
+) -> sqlite3.Connection:
+    """Update a database built from an older release to match a new release.
+    Only new and changed observations (by `last_edited_date`) are written, and observations missing from the new release are deleted.
+    Dimension rows go through the wrappers' caches, so existing rows are reused and overwritten if their values changed.
+
+    The whole release still has to be read, but the database work is proportional to the number of changes.
+    Each chunk is committed as it's applied, and applying a chunk twice has no effect, so an interrupted update can simply be run again.
+
+    Args:
+        input_path:     Path to the CSV of observations from the new release.
+        db_path:        The database to update.
+        max_size:       The maximum number of lines of the CSV to read at a time.
+        workers:        The number of processes used to parse the CSV. Defaults to 1 (no parallelism).
+        member:         For archives, the file to read, see `open_input`.
+        progress:       Called as the input is read, see `build_db_incremental`.
+    """
+    conn = sqlite3.connect(str(db_path.absolute()))
+    conn.executescript(
+        """CREATE TEMP TABLE IF NOT EXISTS update_seen (guid integer PRIMARY KEY);
+        CREATE TEMP TABLE IF NOT EXISTS update_chunk (guid integer);
+        CREATE TEMP TABLE IF NOT EXISTS update_emptied (id integer PRIMARY KEY);"""
+    )
+    subtable_cache = {
+        wrapper.__name__: wrapper.load_cache(conn) for wrapper in WRAPPERS
+    }
+    chunks = raw_chunks(input_path, max_size, member=member, progress=progress)
+
+    def apply(parsed: Iterable[Tuple[int, pd.DataFrame]]):
+        for _, df in parsed:
+            update_chunk(df, conn, subtable_cache)
+            conn.commit()
+
+    if workers <= 1:
+        apply(map(parse_chunk, chunks))
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            apply(bounded_map(executor, parse_chunk, chunks, 2 * workers))
+
+    removed = """FROM observation WHERE global_unique_identifier NOT IN
+        (SELECT guid FROM temp.update_seen)"""
+    conn.execute(
+        f"INSERT OR IGNORE INTO temp.update_emptied SELECT sampling_event_id {removed}"
+    )
+    conn.execute(f"DELETE {removed}")
+    # Checklists whose observations were all removed by this update.
+    # Others without observations (e.g. from `ingest_sampling`) are kept.
+    conn.execute(
+        """DELETE FROM sampling_event WHERE id IN (SELECT id FROM temp.update_emptied)
+        AND NOT EXISTS (SELECT 1 FROM observation WHERE sampling_event_id = sampling_event.id)"""
+    )
+    conn.execute("DROP TABLE temp.update_seen")
+    conn.execute("DROP TABLE temp.update_chunk")
+    conn.execute("DROP TABLE temp.update_emptied")
+    conn.commit()
+    conn.execute("ANALYZE")
     return conn
@@ -0,0 +1,207 @@
+"""Sharing a built database between threads.
+sqlite releases the GIL while it executes a statement, so read-heavy workloads scale with the number of connections.
+"""
+import os
+import sqlite3
+import threading
+
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+from pathlib import Path
+from queue import Queue
+from typing import (
+    Any,
+    Callable,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    TypeVar,
+    Union,
+    TYPE_CHECKING,
+)
+
+from aukpy.cache import ResultCache
+
+if TYPE_CHECKING:
+    from aukpy.queries import Query
+
+
+T = TypeVar("T")
+
+
+class ConnectionPool:
+    """A fixed size pool of read-only connections to a database file.
+    Connections can be used from any thread, but only by one thread at a time, see `connection`.
+    The database is never written to. Readers only avoid blocking (or being blocked by) a writer if it's in WAL mode,
+    which fast builds switch to, see `db.SAFE_PRAGMAS`.
+
+    Args:
+        db_path:    The database file.
+        size:       The number of connections. Defaults to the number of cores.
+    """
+
+    def __init__(self, db_path: Union[str, Path], size: Optional[int] = None):
+        self.db_path = Path(db_path)
+        if not self.db_path.is_file():
+            raise FileNotFoundError(self.db_path)
+        self.size = size if size is not None else (os.cpu_count() or 1)
+
+        self._connections = [self._connect() for _ in range(self.size)]
+        self._idle: "Queue[sqlite3.Connection]" = Queue()
+        for conn in self._connections:
+            self._idle.put(conn)
+
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(
+            f"{self.db_path.absolute().as_uri()}?mode=ro",
+            uri=True,
+            check_same_thread=False,
+        )
+
+    def acquire(self, timeout: Optional[float] = None) -> sqlite3.Connection:
+        """Take a connection out of the pool, waiting for one to be free if necessary.
+        It must be given back with `release`. Prefer `connection` where possible.
+
+        Args:
+            timeout: The maximum time to wait, in seconds. Raises queue.Empty if it runs out.
+        """
+        return self._idle.get(timeout=timeout)
+
+    def release(self, conn: sqlite3.Connection):
+        self._idle.put(conn)
+
+    @contextmanager
+    def connection(
+        self, timeout: Optional[float] = None
+    ) -> Iterator[sqlite3.Connection]:
+        """Borrow a connection, waiting for one to be free if necessary.
+
+        Args:
+            timeout: The maximum time to wait, in seconds. Raises queue.Empty if it runs out.
+        """
+        conn = self.acquire(timeout)
+        try:
+            yield conn
+        finally:
+            self.release(conn)
+
+    def close(self):
+        for conn in self._connections:
+            conn.close()
+
+    def __enter__(self) -> "ConnectionPool":
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class Job:
+    """Work done on a connection borrowed from a pool, made of one or more calls that may run on different threads.
+    Calls must not overlap. The connection is borrowed by the first call.
+
+    The job can be closed from any thread, e.g. when the request it's serving is cancelled.
+    A running statement is interrupted, and the connection only goes back to the pool once no call is using it,
+    so an interrupt can never affect the connection's next user.
+    """
+
+    def __init__(self, pool: ConnectionPool):
+        self.pool = pool
+        # Closed before the connection is returned to the pool
+        self.cursor: Optional[sqlite3.Cursor] = None
+        self._conn: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+        self._running = False
+        self._closed = False
+
+    def call(self, f: Callable[[sqlite3.Connection], T]) -> T:
+        """Run `f` on the job's connection.
+        Raises sqlite3.OperationalError if the job is closed before or while it runs.
+        """
+        if self._closed:
+            raise sqlite3.OperationalError("interrupted")
+        if self._conn is None:
+            conn = self.pool.acquire()
+            with self._lock:
+                self._conn = conn
+        with self._lock:
+            if self._closed:
+                self._release()
+                raise sqlite3.OperationalError("interrupted")
+            self._running = True
+        try:
+            return f(self._conn)
+        finally:
+            with self._lock:
+                self._running = False
+                if self._closed:
+                    self._release()
+
+    def close(self):
+        """Finish the job, interrupting the current call if there is one."""
+        with self._lock:
+            self._closed = True
+            if self._running:
+                # The running call returns the connection once it stops
+                self._conn.interrupt()  # type: ignore
+            else:
+                self._release()
+
+    def _release(self):
+        if self._conn is not None:
+            if self.cursor is not None:
+                self.cursor.close()
+                self.cursor = None
+            self.pool.release(self._conn)
+            self._conn = None
+
+
+class QueryExecutor:
+    """Runs queries concurrently, each on a connection borrowed from a pool.
+
+    Args:
+        pool:       The connection pool.
+        workers:    The number of threads. Defaults to one per connection, more would just wait for connections.
+        cache:      If given, results are cached and shared between all the workers.
+    """
+
+    def __init__(
+        self,
+        pool: ConnectionPool,
+        workers: Optional[int] = None,
+        cache: Optional[ResultCache] = None,
+    ):
+        self.pool = pool
+        self.cache = cache
+        self._executor = ThreadPoolExecutor(workers or pool.size)
+
+    def _run(self, query: "Query", pandas: bool) -> Any:
+        with self.pool.connection() as conn:
+            if pandas:
+                return query.run_pandas(conn, cache=self.cache)
+            else:
+                return query.run(conn, cache=self.cache)
+
+    def submit(self, query: "Query", pandas: bool = False) -> Future:
+        """Start running a query.
+
+        Args:
+            query:  The query.
+            pandas: Return a dataframe, as `Query.run_pandas`, instead of rows.
+        """
+        return self._executor.submit(self._run, query, pandas)
+
+    def run_all(self, batch: Iterable["Query"], pandas: bool = False) -> List[Any]:
+        """Run a batch of queries concurrently, returning their results in the same order."""
+        futures = [self.submit(q, pandas) for q in batch]
+        return [f.result() for f in futures]
+
+    def shutdown(self, wait: bool = True):
+        self._executor.shutdown(wait=wait)
+
+    def __enter__(self) -> "QueryExecutor":
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()
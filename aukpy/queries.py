@@ -1,24 +1,109 @@
+import asyncio
 import datetime
+import math
+import threading
+from collections import OrderedDict
+from concurrent.futures import Executor
 from functools import reduce, wraps
-from aukpy import db
+from pathlib import Path
+from aukpy import db, utils
+from aukpy.cache import ResultCache, database_fingerprint
+from aukpy.pool import ConnectionPool, Job
 import pandas as pd
 import sqlite3
 from dataclasses import dataclass, field, replace as dc_replace
 from typing import (
+    AsyncIterator,
     Callable,
+    Dict,
     Iterable,
+    Iterator,
     List,
     Optional,
     Protocol,
+    Set,
     TypeVar,
     Union,
     Tuple,
     Any,
     Literal,
+    overload,
+    TYPE_CHECKING,
 )
 
+if TYPE_CHECKING:
+    import pyarrow as pa  # type: ignore
+
 
 Distance = Literal["km", "miles"]
+Box = Tuple[float, float, float, float]
+# The distinct values, and the (minimum, maximum), of some columns of a database, keyed by unqualified column name
+ColumnValues = Dict[str, Set[Any]]
+ColumnRanges = Dict[str, Tuple[Any, Any]]
+
+MILES_TO_KM = 1.60934
+EARTH_RADIUS_KM = 6371.0088
+
+# The table that each column is stored in
+COLUMN_TABLES: Dict[str, str] = {
+    column: wrapper.table_name
+    for wrapper in (
+        db.ObservationWrapper,
+        db.SamplingWrapper,
+        db.LocationWrapper,
+        db.SpeciesWrapper,
+        db.BreedingWrapper,
+        db.ProtocolWrapper,
+    )
+    for column in wrapper.columns + wrapper.derived_columns
+}
+
+# Every table that can be joined to observation, in the order they need to be joined
+JOINS = (
+    ("sampling_event", "JOIN sampling_event ON sampling_event_id = sampling_event.id"),
+    ("species", "JOIN species ON species_id = species.id"),
+    (
+        "location_data",
+        "LEFT JOIN location_data ON location_data_id = location_data.id",
+    ),
+    ("breeding", "LEFT JOIN breeding ON breeding_id = breeding.id"),
+    ("protocol", "LEFT JOIN protocol ON protocol_id = protocol.id"),
+)
+
+
+AGGREGATES = {
+    "count": ("COUNT(*)", "count"),
+    "sum": ("SUM({})", "sum_{}"),
+    "distinct": ("COUNT(DISTINCT {})", "distinct_{}"),
+}
+
+
+# The tables describing checklists, which `Query.zero_fill` queries instead of observations
+CHECKLIST_TABLES = {"sampling_event", "location_data"}
+CHECKLIST_COLUMNS = tuple(
+    c for c in db.DF_COLUMNS if COLUMN_TABLES.get(c) in CHECKLIST_TABLES
+)
+
+# Text columns of these tables have few distinct values, so they're dictionary encoded in Arrow output
+DICTIONARY_TABLES = ("species", "location_data")
+# Arrow types of the declared sqlite column types
+SQL_ARROW_TYPES = {"integer": "int64", "int": "int64", "float": "float64"}
+# Columns stored with mixed types
+ARROW_STRING_COLUMNS = ("observation_count",)
+
+
+def check_columns(columns: Iterable[str]):
+    unknown = [c for c in columns if c not in COLUMN_TABLES]
+    if unknown:
+        raise ValueError(f"Unknown columns: {unknown}")
+
+
+def table_of(column: str) -> str:
+    """Get the table a column belongs to. The column can be qualified with the table name."""
+    if "." in column:
+        return column.split(".", 1)[0]
+    else:
+        return COLUMN_TABLES[column]
 
 
 def check_simple_type(value) -> bool:
@@ -50,11 +135,36 @@ class Filter:
     def query(self) -> Tuple[str, Tuple[Any, ...]]:
         raise NotImplementedError
 
+    def tables(self) -> Set[str]:
+        """The tables this filter refers to, which have to be joined for it to work."""
+        raise NotImplementedError
+
+    def resolve(self, db_conn: sqlite3.Connection) -> "Filter":
+        """Get an equivalent filter specialized to a particular database. See `DimensionFilter`."""
+        return self
+
+    def checklist_query(self) -> Tuple[str, Tuple[Any, ...]]:
+        """Compile the filter for a query over checklists (sampling_event) rather than observations. See `Query.zero_fill`.
+        Raises ValueError if the filter isn't on a property of the checklist.
+        """
+        if not self.tables() <= CHECKLIST_TABLES:
+            raise ValueError(f"Not a checklist filter: {self}")
+        return self.query()
+
+    def may_match(self, values: ColumnValues, ranges: ColumnRanges) -> bool:
+        """Whether any row of a database could match this filter, given a summary of the database's contents.
+        Only False if the filter definitely can't match, e.g. it's on a country the database doesn't have. See `shards`.
+        """
+        return True
+
 
 class Empty(Filter):
     def query(self) -> Tuple[str, Tuple[Any, ...]]:
         return "", ()
 
+    def tables(self) -> Set[str]:
+        return set()
+
     def __or__(self, other: Filter) -> Filter:
         return other
 
@@ -64,23 +174,56 @@ class AndFilter(Filter):
     filter_1: Filter
     filter_2: Filter
 
+    def tables(self) -> Set[str]:
+        return self.filter_1.tables() | self.filter_2.tables()
+
+    def resolve(self, db_conn: sqlite3.Connection) -> Filter:
+        return AndFilter(self.filter_1.resolve(db_conn), self.filter_2.resolve(db_conn))
+
+    def may_match(self, values: ColumnValues, ranges: ColumnRanges) -> bool:
+        return self.filter_1.may_match(values, ranges) and self.filter_2.may_match(
+            values, ranges
+        )
+
     def query(self) -> Tuple[str, Tuple[Any, ...]]:
         f1, v1 = self.filter_1.query()
         f2, v2 = self.filter_2.query()
         vals = v1 + v2
         return f"{f1} AND {f2}", vals
 
+    def checklist_query(self) -> Tuple[str, Tuple[Any, ...]]:
+        f1, v1 = self.filter_1.checklist_query()
+        f2, v2 = self.filter_2.checklist_query()
+        return f"{f1} AND {f2}", v1 + v2
+
 
 @dataclass
 class OrFilter(Filter):
     filter_1: Filter
     filter_2: Filter
 
+    def tables(self) -> Set[str]:
+        return self.filter_1.tables() | self.filter_2.tables()
+
+    def resolve(self, db_conn: sqlite3.Connection) -> Filter:
+        return OrFilter(self.filter_1.resolve(db_conn), self.filter_2.resolve(db_conn))
+
+    def may_match(self, values: ColumnValues, ranges: ColumnRanges) -> bool:
+        return self.filter_1.may_match(values, ranges) or self.filter_2.may_match(
+            values, ranges
+        )
+
     def query(self) -> Tuple[str, Tuple[Any, ...]]:
         f1, v1 = self.filter_1.query()
         f2, v2 = self.filter_2.query()
         vals = v1 + v2
-        return f"{f1} OR {f2}", vals
+        # Parenthesized so the filter can be combined with others
+        return f"({f1} OR {f2})", vals
+
+    def checklist_query(self) -> Tuple[str, Tuple[Any, ...]]:
+        f1, v1 = self.filter_1.checklist_query()
+        f2, v2 = self.filter_2.checklist_query()
+        return f"({f1} OR {f2})", v1 + v2
 
 
 @dataclass
@@ -90,6 +233,14 @@ class ColumnFilter(Filter):
     def query(self) -> Tuple[str, Tuple[Any, ...]]:
         raise NotImplementedError
 
+    def tables(self) -> Set[str]:
+        return {table_of(self.column)}
+
+    @property
+    def name(self) -> str:
+        """The column name, without the table."""
+        return self.column.split(".")[-1]
+
 
 @dataclass
 class IsIn(ColumnFilter):
@@ -99,6 +250,11 @@ class IsIn(ColumnFilter):
         quotes = ",".join(("?" for _ in self.values))
         return f"{self.column} in ({quotes})", self.values
 
+    def may_match(self, values: ColumnValues, ranges: ColumnRanges) -> bool:
+        if self.name not in values:
+            return True
+        return any(v in values[self.name] for v in self.values)
+
 
 @dataclass
 class Is(ColumnFilter):
@@ -107,6 +263,9 @@ class Is(ColumnFilter):
     def query(self) -> Tuple[str, Tuple[Any, ...]]:
         return f"{self.column} = ?", (self.value,)
 
+    def may_match(self, values: ColumnValues, ranges: ColumnRanges) -> bool:
+        return self.name not in values or self.value in values[self.name]
+
 
 @dataclass
 class EqualsOrIn(ColumnFilter):
@@ -118,6 +277,12 @@ class EqualsOrIn(ColumnFilter):
         else:
             return IsIn(self.column, tuple(self.value)).query()  # type: ignore
 
+    def may_match(self, values: ColumnValues, ranges: ColumnRanges) -> bool:
+        if check_simple_type(self.value):
+            return Is(self.column, self.value).may_match(values, ranges)
+        else:
+            return IsIn(self.column, tuple(self.value)).may_match(values, ranges)  # type: ignore
+
 
 @dataclass
 class LT(ColumnFilter):
@@ -126,6 +291,9 @@ class LT(ColumnFilter):
     def query(self) -> Tuple[str, Tuple[Any, ...]]:
         return f"{self.column} < ?", (self.value,)
 
+    def may_match(self, values: ColumnValues, ranges: ColumnRanges) -> bool:
+        return self.name not in ranges or ranges[self.name][0] < self.value
+
 
 @dataclass
 class GT(ColumnFilter):
@@ -134,6 +302,9 @@ class GT(ColumnFilter):
     def query(self) -> Tuple[str, Tuple[Any, ...]]:
         return f"{self.column} > ?", (self.value,)
 
+    def may_match(self, values: ColumnValues, ranges: ColumnRanges) -> bool:
+        return self.name not in ranges or ranges[self.name][1] > self.value
+
 
 @dataclass
 class LE(ColumnFilter):
@@ -142,6 +313,9 @@ class LE(ColumnFilter):
     def query(self) -> Tuple[str, Tuple[Any, ...]]:
         return f"{self.column} <= ?", (self.value,)
 
+    def may_match(self, values: ColumnValues, ranges: ColumnRanges) -> bool:
+        return self.name not in ranges or ranges[self.name][0] <= self.value
+
 
 @dataclass
 class GE(ColumnFilter):
@@ -150,6 +324,9 @@ class GE(ColumnFilter):
     def query(self) -> Tuple[str, Tuple[Any, ...]]:
         return f"{self.column} >= ?", (self.value,)
 
+    def may_match(self, values: ColumnValues, ranges: ColumnRanges) -> bool:
+        return self.name not in ranges or ranges[self.name][1] >= self.value
+
 
 @dataclass
 class Between(ColumnFilter):
@@ -159,6 +336,12 @@ class Between(ColumnFilter):
     def query(self) -> Tuple[str, Tuple[Any, ...]]:
         return f"{self.column} BETWEEN ? AND ?", (self.lower, self.upper)
 
+    def may_match(self, values: ColumnValues, ranges: ColumnRanges) -> bool:
+        if self.name not in ranges:
+            return True
+        minimum, maximum = ranges[self.name]
+        return minimum <= self.upper and maximum >= self.lower
+
 
 @dataclass
 class IsTrue(ColumnFilter):
@@ -170,30 +353,368 @@ class IsTrue(ColumnFilter):
 class Wrapped(Filter):
     inner: Filter
 
+    def tables(self) -> Set[str]:
+        return self.inner.tables()
+
+    def resolve(self, db_conn: sqlite3.Connection) -> Filter:
+        return Wrapped(self.inner.resolve(db_conn))
+
+    def may_match(self, values: ColumnValues, ranges: ColumnRanges) -> bool:
+        return self.inner.may_match(values, ranges)
+
     def query(self) -> Tuple[str, Tuple[Any, ...]]:
         sub_q, sub_v = self.inner.query()
         return f"({sub_q})", sub_v
 
+    def checklist_query(self) -> Tuple[str, Tuple[Any, ...]]:
+        sub_q, sub_v = self.inner.checklist_query()
+        return f"({sub_q})", sub_v
+
 
 @dataclass
 class NotNull(Filter):
     column: str
 
+    def tables(self) -> Set[str]:
+        return {table_of(self.column)}
+
     def query(self) -> Tuple[str, Tuple[Any, ...]]:
         return f"{self.column} IS NOT NULL", ()
 
 
+# IDs resolved by DimensionFilter, keyed by database fingerprint and query
+_RESOLVED_IDS: "OrderedDict[Tuple[Any, ...], Tuple[int, ...]]" = OrderedDict()
+# Queries can be run from multiple threads, see `pool`
+_RESOLVED_IDS_LOCK = threading.Lock()
+MAX_CACHED_RESOLUTIONS = 1024
+# Dimension filters that match more rows than this are left as subqueries
+MAX_RESOLVED_IDS = 500
+
+
+@dataclass
+class DimensionFilter(Filter):
+    """A filter on one of the tables referenced by observation (species, location_data, protocol, breeding),
+    applied to observation's foreign key rather than after joining.
+
+    Compiled in two phases: `resolve` looks up the matching IDs in the (small) dimension table,
+    and the main query then only has to check the foreign key, which is indexed.
+    Unresolved, or if too many rows match, the IDs are selected by a subquery instead.
+    """
+
+    table: str
+    inner: Filter
+    # A label for the filter, so that Query methods can find the filters they created
+    name: str = ""
+    ids: Optional[Tuple[int, ...]] = None
+
+    def tables(self) -> Set[str]:
+        return set()
+
+    def id_query(self) -> Tuple[str, Tuple[Any, ...]]:
+        """The query selecting the IDs of the matching rows of the dimension table."""
+        inner, vals = self.inner.query()
+        return f"SELECT id FROM {self.table} WHERE {inner}", vals
+
+    def resolve(self, db_conn: sqlite3.Connection) -> Filter:
+        query, vals = self.id_query()
+        fingerprint = database_fingerprint(db_conn)
+        key = (fingerprint, query, vals)
+        with _RESOLVED_IDS_LOCK:
+            ids = _RESOLVED_IDS.get(key) if fingerprint is not None else None
+            if ids is not None:
+                _RESOLVED_IDS.move_to_end(key)
+        if ids is None:
+            ids = tuple(x[0] for x in db_conn.execute(query, vals))
+            if fingerprint is not None:
+                with _RESOLVED_IDS_LOCK:
+                    _RESOLVED_IDS[key] = ids
+                    if len(_RESOLVED_IDS) > MAX_CACHED_RESOLUTIONS:
+                        _RESOLVED_IDS.popitem(last=False)
+        if len(ids) > MAX_RESOLVED_IDS:
+            return self
+        return dc_replace(self, ids=ids)
+
+    def may_match(self, values: ColumnValues, ranges: ColumnRanges) -> bool:
+        return self.inner.may_match(values, ranges)
+
+    def _ids(self) -> Tuple[str, Tuple[Any, ...]]:
+        """The matching IDs, either resolved or as a subquery."""
+        if self.ids is None:
+            return self.id_query()
+        else:
+            return ",".join("?" for _ in self.ids), self.ids
+
+    def query(self) -> Tuple[str, Tuple[Any, ...]]:
+        ids, vals = self._ids()
+        if self.table == "location_data":
+            return observations_at(ids), vals
+        else:
+            return f"observation.{self.table}_id IN ({ids})", vals
+
+    def checklist_query(self) -> Tuple[str, Tuple[Any, ...]]:
+        if self.table != "location_data":
+            raise ValueError(f"Not a checklist filter: {self.name or self.table}")
+        ids, vals = self._ids()
+        return f"sampling_event.location_data_id IN ({ids})", vals
+
+
+def leap_day_of_year(date: str) -> int:
+    """Get the day of the year of a date, ignoring the year, as stored in sampling_event.day_of_year.
+
+    Args:
+        date: A date in year-month-day format. The year can be a wildcard, e.g. "*-05-01".
+    """
+    month_day = date.split("-", 1)[1]
+    # 2000 is a leap year
+    return pd.to_datetime(f"2000-{month_day}", format="%Y-%m-%d").dayofyear
+
+
+def haversine_km(
+    lat_1: Optional[float],
+    lon_1: Optional[float],
+    lat_2: Optional[float],
+    lon_2: Optional[float],
+) -> Optional[float]:
+    """The great circle distance between two points, in kilometers.
+    Registered as a sqlite function by `register_functions`.
+    """
+    if lat_1 is None or lon_1 is None or lat_2 is None or lon_2 is None:
+        return None
+    phi_1, phi_2 = math.radians(lat_1), math.radians(lat_2)
+    d_phi = phi_2 - phi_1
+    d_lambda = math.radians(lon_2 - lon_1)
+    a = (
+        math.sin(d_phi / 2) ** 2
+        + math.cos(phi_1) * math.cos(phi_2) * math.sin(d_lambda / 2) ** 2
+    )
+    return 2 * EARTH_RADIUS_KM * math.asin(math.sqrt(min(1.0, a)))
+
+
+def register_functions(db_conn: sqlite3.Connection):
+    """Register the custom sql functions used by some filters.
+    sqlite's own math functions are a compile time option, so we can't rely on them.
+    """
+    db_conn.create_function("haversine_km", 4, haversine_km)
+
+
+def radius_boxes(lat: float, lon: float, radius_km: float) -> List[Box]:
+    """Get bounding boxes, as (min_long, min_lat, max_long, max_lat), that together contain a circle on the globe.
+    Circles that cross the antimeridian are split into two boxes.
+    """
+    angular = radius_km / EARTH_RADIUS_KM
+    d_lat = math.degrees(angular)
+    min_lat, max_lat = lat - d_lat, lat + d_lat
+    if min_lat <= -90.0 or max_lat >= 90.0:
+        # The circle contains a pole, so it covers every longitude
+        return [(-180.0, max(min_lat, -90.0), 180.0, min(max_lat, 90.0))]
+
+    d_lon = math.degrees(math.asin(math.sin(angular) / math.cos(math.radians(lat))))
+    min_lon, max_lon = lon - d_lon, lon + d_lon
+    if min_lon < -180.0:
+        return [
+            (min_lon + 360.0, min_lat, 180.0, max_lat),
+            (-180.0, min_lat, max_lon, max_lat),
+        ]
+    elif max_lon > 180.0:
+        return [
+            (min_lon, min_lat, 180.0, max_lat),
+            (-180.0, min_lat, max_lon - 360.0, max_lat),
+        ]
+    else:
+        return [(min_lon, min_lat, max_lon, max_lat)]
+
+
+def rtree_candidates(boxes: Iterable[Box]) -> Tuple[str, Tuple[Any, ...]]:
+    """Select the IDs of all locations that may be inside any of the boxes, using the location_rtree spatial index.
+    The index stores coordinates as 32 bit floats, rounded outwards, so this can include locations slightly outside the boxes.
+    """
+    selects = []
+    vals: Tuple[Any, ...] = ()
+    for min_long, min_lat, max_long, max_lat in boxes:
+        selects.append(
+            "SELECT id FROM location_rtree WHERE max_longitude >= ? AND min_longitude <= ? AND max_latitude >= ? AND min_latitude <= ?"
+        )
+        vals += (min_long, max_long, min_lat, max_lat)
+    return " UNION ALL ".join(selects), vals
+
+
+def observations_at(locations: str) -> str:
+    """Restrict observations to a set of locations.
+    Goes through the sampling_event and observation foreign key indexes, so the cost depends on the number of matching locations rather than the number of observations.
+
+    Args:
+        locations: A query selecting location IDs.
+    """
+    return f"""observation.sampling_event_id IN (
+            SELECT id FROM sampling_event WHERE location_data_id IN ({locations})
+        )"""
+
+
+@dataclass
+class InBoundingBox(Filter):
+    """Select observations whose location may be inside a bounding box, using the location_rtree spatial index.
+    Can include locations slightly outside the box, see `rtree_candidates`.
+    """
+
+    min_long: float
+    min_lat: float
+    max_long: float
+    max_lat: float
+
+    def tables(self) -> Set[str]:
+        return set()
+
+    def query(self) -> Tuple[str, Tuple[Any, ...]]:
+        candidates, vals = rtree_candidates(
+            [(self.min_long, self.min_lat, self.max_long, self.max_lat)]
+        )
+        return observations_at(candidates), vals
+
+    def checklist_query(self) -> Tuple[str, Tuple[Any, ...]]:
+        candidates, vals = rtree_candidates(
+            [(self.min_long, self.min_lat, self.max_long, self.max_lat)]
+        )
+        return f"sampling_event.location_data_id IN ({candidates})", vals
+
+
+@dataclass
+class WithinDistance(Filter):
+    """Select observations within a distance of a point.
+    The spatial index prunes the candidate locations, then the exact distance is checked.
+    Requires `register_functions` to have been called on the connection.
+    """
+
+    lat: float
+    lon: float
+    radius_km: float
+
+    def tables(self) -> Set[str]:
+        return set()
+
+    def locations(self) -> Tuple[str, Tuple[Any, ...]]:
+        """The query selecting the IDs of the locations within the distance."""
+        candidates, vals = rtree_candidates(
+            radius_boxes(self.lat, self.lon, self.radius_km)
+        )
+        locations = f"""SELECT id FROM location_data
+            WHERE id IN ({candidates}) AND haversine_km(latitude, longitude, ?, ?) <= ?"""
+        return locations, vals + (self.lat, self.lon, self.radius_km)
+
+    def query(self) -> Tuple[str, Tuple[Any, ...]]:
+        locations, vals = self.locations()
+        return observations_at(locations), vals
+
+    def checklist_query(self) -> Tuple[str, Tuple[Any, ...]]:
+        locations, vals = self.locations()
+        return f"sampling_event.location_data_id IN ({locations})", vals
+
+
+def join_clause(needed: Set[str]) -> str:
+    """The joins to add to observation to make the columns of the `needed` tables available."""
+    # Locations are joined through sampling events
+    if "location_data" in needed:
+        needed = needed | {"sampling_event"}
+    return "\n        ".join(join for table, join in JOINS if table in needed)
+
+
+def first_in_group(
+    conditions: List[str], vals: Tuple[Any, ...], tables: Set[str]
+) -> Tuple[str, Tuple[Any, ...]]:
+    """The query selecting the observations from group checklists kept by `Query.unique_checklists`.
+
+    Args:
+        conditions: The conditions the observations have to match.
+        vals:       The parameters of the conditions.
+        tables:     The tables the conditions refer to.
+    """
+    # The condition on group_identifier lets sqlite use the partial index on it
+    where = " AND ".join(["observation.group_identifier IS NOT NULL"] + conditions)
+    query = f"""SELECT id FROM (
+            SELECT observation.id, ROW_NUMBER() OVER (
+                PARTITION BY observation.group_identifier, observation.species_id
+                ORDER BY sampling_event.sampling_event_identifier, observation.global_unique_identifier
+            ) AS position
+            FROM observation
+            {join_clause(tables | {"sampling_event"})}
+            WHERE {where}
+        ) WHERE position = 1"""
+    return query, vals
+
+
+def species_names(names: Union[str, Iterable[str]]) -> Filter:
+    """Match species rows by any of scientific name, common name, subspecies scientific name, or subspecies common name."""
+    if isinstance(names, str):
+        names_param: Tuple[str, ...] = (names,)
+    else:
+        names_param = tuple(names)
+    scientific_filt = EqualsOrIn("species.scientific_name", names_param)
+    common_filt = EqualsOrIn("species.common_name", names_param)
+    sub_science = EqualsOrIn("species.subspecies_scientific_name", names_param)
+    sub_common = EqualsOrIn("species.subspecies_common_name", names_param)
+    return scientific_filt | common_filt | sub_science | sub_common
+
+
 @dataclass
 class Query:
     """A wrapper around a set of filters for each table"""
 
     row_filters: List[Filter] = field(default_factory=list)
     row_filter: Optional[Filter] = None
+    # The columns to return. All of db.DF_COLUMNS if None
+    columns: Optional[Tuple[str, ...]] = None
+    # Columns to group by, and the aggregates to compute for each group, as (function, column)
+    group_columns: Tuple[str, ...] = ()
+    aggregates: Tuple[Tuple[str, Optional[str]], ...] = ()
+    # The species to zero fill for, see `zero_fill`
+    zero_fill_species: Tuple[str, ...] = ()
+    # Whether to deduplicate group checklists, see `unique_checklists`
+    unique: bool = False
 
     def _update_filter(self, new_filt: Filter):
         new_filters = self.row_filters + [new_filt]
         return dc_replace(self, row_filters=new_filters)
 
+    def select(self, columns: Iterable[str]) -> "Query":
+        """Only return the given columns.
+        Tables that none of the selected columns or filters use aren't joined.
+
+        Args:
+            columns: The names of the columns, as in db.DF_COLUMNS.
+        """
+        columns = tuple(columns)
+        check_columns(columns)
+        return dc_replace(self, columns=columns)
+
+    def group_by(self, *columns: str) -> "Query":
+        """Group the results by the given columns. Must be followed by at least one aggregate,
+        i.e. `count`, `sum` or `distinct`. The grouping is done by sqlite, so only the aggregated rows are returned.
+
+        Examples:
+            >>> group_by("scientific_name", "county", "month").count()
+            >>> group_by("observer_id").distinct("sampling_event_identifier")
+        """
+        check_columns(columns)
+        return dc_replace(self, group_columns=self.group_columns + tuple(columns))
+
+    def _add_aggregate(self, function: str, column: Optional[str]) -> "Query":
+        if column is not None:
+            check_columns((column,))
+        return dc_replace(self, aggregates=self.aggregates + ((function, column),))
+
+    def count(self) -> "Query":
+        """Count the observations in each group. Returned in a `count` column."""
+        return self._add_aggregate("count", None)
+
+    def sum(self, column: str) -> "Query":
+        """Sum a column over each group. Returned in a `sum_{column}` column.
+        Note that non-numeric values (e.g. "X" observation counts) are treated as 0.
+        """
+        return self._add_aggregate("sum", column)
+
+    def distinct(self, column: str) -> "Query":
+        """Count the distinct values of a column in each group. Returned in a `distinct_{column}` column."""
+        return self._add_aggregate("distinct", column)
+
     def species(self, names: Union[str, Iterable[str]]) -> "Query":
         """Filter by species name.
         Can be any of scientific name, common name, subspecies scientific name, or subspecies common name.
@@ -201,16 +722,26 @@ class Query:
         Args:
             names: A name or names.
         """
-        if isinstance(names, str):
-            names_param: Tuple[str, ...] = (names,)
-        else:
-            names_param = tuple(names)
-        scientific_filt = EqualsOrIn("species.scientific_name", names_param)
-        common_filt = EqualsOrIn("species.common_name", names_param)
-        sub_science = EqualsOrIn("species.subspecies_scientific_name", names_param)
-        sub_common = EqualsOrIn("species.subspecies_common_name", names_param)
-        new_filt = scientific_filt | common_filt | sub_science | sub_common
-        return self._update_filter(new_filt)
+        new_filt = species_names(names)
+        return self._update_filter(DimensionFilter("species", new_filt, "species"))
+
+    def clade(self, name: str) -> "Query":
+        """Filter for every taxon in a clade, i.e. an order, family, or genus.
+        Along with species and subspecies, this includes spuhs, slashes and hybrids within the clade.
+
+        Matched on ranges of taxonomic order, so the database has to use the same taxonomy version as the package, see `utils.load_taxonomy`.
+
+        Args:
+            name: The name of the clade. Case-insensitive.
+        """
+        ranges = utils.get_taxonomic_ranges(name)
+        if not ranges:
+            raise ValueError(f"Unknown clade: {name}")
+        between: List[Filter] = [
+            Between("species.taxonomic_order", lo, hi) for lo, hi in ranges
+        ]
+        new_filt = reduce(lambda a, b: a | b, between)
+        return self._update_filter(DimensionFilter("species", new_filt, "clade"))
 
     def country(
         self, names: Union[str, Iterable[str]], replace: bool = True
@@ -220,14 +751,19 @@ class Query:
             names_param: Tuple[str, ...] = (names,)
         else:
             names_param = tuple(names)
-        new_filt = EqualsOrIn("location_data.country", names_param) | EqualsOrIn(
-            "location_data.country_code", names
+        new_filt = DimensionFilter(
+            "location_data",
+            EqualsOrIn("location_data.country", names_param)
+            | EqualsOrIn("location_data.country_code", names_param),
+            "country",
         )
 
         # Get rid of old country filters if replace is True
         if replace is True:
             new_filters = [
-                x for x in self.row_filters if not getattr(x, "column", False)
+                x
+                for x in self.row_filters
+                if not (isinstance(x, DimensionFilter) and x.name == "country")
             ]
             new_obj = dc_replace(self, row_filters=new_filters)
             return new_obj._update_filter(new_filt)
@@ -236,14 +772,19 @@ class Query:
 
     def state(self, names: Union[str, Iterable[str]]) -> "Query":
         """Filter by state name or state code."""
-        new_filt = EqualsOrIn("location_data.state_name", names) | EqualsOrIn(
-            "location_data.state_code", names
+        if isinstance(names, str):
+            names_param: Tuple[str, ...] = (names,)
+        else:
+            names_param = tuple(names)
+        new_filt = EqualsOrIn("location_data.state", names_param) | EqualsOrIn(
+            "location_data.state_code", names_param
         )
-        return self._update_filter(new_filt)
+        return self._update_filter(DimensionFilter("location_data", new_filt, "state"))
 
     def bcr(self, code: Union[str, Iterable[str]]) -> "Query":
         """Filter by BCR code"""
-        return self._update_filter(EqualsOrIn("bcrcode.bcr_code", code))
+        new_filt = EqualsOrIn("location_data.bcr_code", code)
+        return self._update_filter(DimensionFilter("location_data", new_filt, "bcr"))
 
     def bbox(
         self,
@@ -253,39 +794,44 @@ class Query:
         max_lat: float = 90.0,
     ) -> "Query":
         """Filter for observations within a bounding box."""
+        # The spatial index narrows down the candidate locations, the comparisons make the result exact.
         new_filt = (
-            GT("longitude", min_long)
+            InBoundingBox(min_long, min_lat, max_long, max_lat)
+            & GT("longitude", min_long)
             & LT("longitude", max_long)
             & GT("latitude", min_lat)
             & LT("latitude", max_lat)
         )
         return self._update_filter(new_filt)
 
-    def _wildcard_date(self, after: Optional[str], before: Optional[str]) -> "Query":
-        if after is None:
-            after = "*-01-01"
-        if before is None:
-            before = "*-12-31"
-        current = datetime.datetime.now().year
-        after = after.replace("*", str(current))
-        before = before.replace("*", str(current))
-
-        after_dt = pd.to_datetime(after)
-        before_dt = pd.to_datetime(before) + pd.DateOffset(days=1)
-        offset = pd.DateOffset(years=1)
-
-        f: Filter = Empty()
-
-        # 1800 is the start of observations
-        while after_dt.year >= 1800:
-            new_f = GE("observation_date", int(after_dt.timestamp())) & LT(
-                "observation_date", int(before_dt.timestamp())
-            )
+    def near(
+        self, lat: float, lon: float, radius: float, unit: Distance = "km"
+    ) -> "Query":
+        """Filter for observations within a distance of a point.
 
-            f = f | new_f
-            after_dt -= offset
-            before_dt -= offset
+        Args:
+            lat:    The latitude of the point.
+            lon:    The longitude of the point.
+            radius: The maximum distance from the point.
+            unit:   The unit of distance, either 'km' or 'miles'. Defaults to 'km'
+        """
+        radius_km = radius * MILES_TO_KM if unit == "miles" else radius
+        return self._update_filter(WithinDistance(lat, lon, radius_km))
 
+    def _wildcard_date(self, after: Optional[str], before: Optional[str]) -> "Query":
+        """Filter for the same range of dates in every year.
+        Compiles to a range on the precomputed day of year, which can use an index.
+        Ranges that wrap around the end of the year (e.g. "*-12-01" to "*-01-31") are also supported.
+        Databases built before the day of year was stored get it from `db.create_indexes`.
+        """
+        after_day = leap_day_of_year(after if after is not None else "*-01-01")
+        before_day = leap_day_of_year(before if before is not None else "*-12-31")
+        column = "sampling_event.day_of_year"
+
+        if after_day <= before_day:
+            f: Filter = Between(column, after_day, before_day)
+        else:
+            f = Wrapped(GE(column, after_day) | LE(column, before_day))
         return self._update_filter(f)
 
     def date(
@@ -348,7 +894,8 @@ class Query:
         Args:
             protocol: The protocol or protocols to filter for
         """
-        return self._update_filter(EqualsOrIn("protocol_type", protocol))
+        new_filt = EqualsOrIn("protocol_type", protocol)
+        return self._update_filter(DimensionFilter("protocol", new_filt, "protocol"))
 
     def project(self, project: Union[str, Iterable[str]]) -> "Query":
         """Filter for observations that are part of a particular project.
@@ -356,7 +903,8 @@ class Query:
         Args:
             project: The name of the project
         """
-        return self._update_filter(EqualsOrIn("project_code", project))
+        new_filt = EqualsOrIn("project_code", project)
+        return self._update_filter(DimensionFilter("protocol", new_filt, "project"))
 
     def time(self, after: str = "00:00", before: str = "23:59") -> "Query":
         """Select observations started between the given hours.
@@ -408,7 +956,6 @@ class Query:
             maximum: The maximum distance to accept.
             unit: The unit of distance, either 'km' or 'miles'. Defaults to 'km'
         """
-        MILES_TO_KM = 1.60934
         if unit == "miles":
             minimum *= MILES_TO_KM
             maximum *= MILES_TO_KM
@@ -430,41 +977,416 @@ class Query:
             breeding_code: A breeding code or codes to filter on
         """
         if isinstance(breeding_code, str):
-            return self._update_filter(Is("breeding_code", breeding_code))
+            new_filt: Filter = Is("breeding_code", breeding_code)
         else:
-            return self._update_filter(IsIn("breeding_code", tuple(breeding_code)))
+            new_filt = IsIn("breeding_code", tuple(breeding_code))
+        return self._update_filter(DimensionFilter("breeding", new_filt, "breeding"))
 
     def complete(self) -> "Query":
-        return self._update_filter(IsTrue("complete"))
+        return self._update_filter(IsTrue("all_species_reported"))
+
+    def unique_checklists(self) -> "Query":
+        """Only return one copy of each observation from a group checklist, like auk's `auk_unique`.
+        When observers share a checklist, each of them gets a copy with its own sampling_event_identifier and the same group_identifier.
+        Of the copies of a species' observation in a group, the one on the checklist with the lowest sampling_event_identifier is kept.
+
+        The duplicates are removed by sqlite, after filtering and before aggregation, so aggregates count each observation once.
+        """
+        return dc_replace(self, unique=True)
+
+    def zero_fill(self, names: Union[str, Iterable[str]]) -> "Query":
+        """Return presence/absence data: a row for every complete checklist and species,
+        with whether the species was reported on the checklist, rather than a row per observation.
+        Requires the checklists without any of the species to be in the database, see `db.ingest_sampling`.
+
+        Rows have the species' `scientific_name`, the checklist columns (or the selected ones, which must be checklist columns),
+        `species_observed` (0 or 1), and `observation_count`: the total count, "X" if any count was missing, or 0 if the species wasn't reported.
+        Filters must be on properties of the checklist, e.g. dates, locations or effort.
+        Subspecies and other forms are counted as the species.
+        Can't be combined with `unique_checklists`, group checklists each get a row.
+
+        Args:
+            names: A species name or names, as in `species`.
+        """
+        if isinstance(names, str):
+            names = (names,)
+        return dc_replace(self, zero_fill_species=tuple(names))
+
+    def _select_list(self) -> Tuple[Tuple[str, ...], Tuple[str, ...]]:
+        """Get the expressions to select, and the columns they use."""
+        if self.zero_fill_species:
+            if self.aggregates or self.group_columns:
+                raise ValueError("zero_fill can't be combined with aggregates")
+            if self.unique:
+                raise ValueError("zero_fill can't be combined with unique_checklists")
+            columns = self.columns if self.columns is not None else CHECKLIST_COLUMNS
+            outside = [c for c in columns if COLUMN_TABLES[c] not in CHECKLIST_TABLES]
+            if outside:
+                raise ValueError(f"Not checklist columns: {outside}")
+            return (
+                ("target.scientific_name",)
+                + tuple(columns)
+                + (
+                    "detection.sampling_event_id IS NOT NULL AS species_observed",
+                    "COALESCE(detection.observation_count, 0) AS observation_count",
+                )
+            ), tuple(columns)
+        elif self.aggregates:
+            expressions = list(self.group_columns)
+            used = list(self.group_columns)
+            for function, column in self.aggregates:
+                expression, name = AGGREGATES[function]
+                expressions.append(
+                    f"{expression.format(column)} AS {name.format(column)}"
+                )
+                if column is not None:
+                    used.append(column)
+            return tuple(expressions), tuple(used)
+        elif self.group_columns:
+            raise ValueError("group_by must be followed by an aggregate")
+        else:
+            columns = self.columns if self.columns is not None else db.DF_COLUMNS
+            return columns, columns
+
+    def get_query(
+        self, db_conn: Optional[sqlite3.Connection] = None
+    ) -> Tuple[str, Tuple[Any, ...]]:
+        """Compile the query to sql.
+
+        Args:
+            db_conn: If given, filters are specialized to this database. See `DimensionFilter`.
 
-    def get_query(self) -> Tuple[str, Tuple[Any, ...]]:
+        Returns:
+            The query and its parameters.
+        """
+        if self.zero_fill_species:
+            return self._zero_fill_query(db_conn)
+        expressions, columns = self._select_list()
+        needed = {table_of(c) for c in columns}
+        conditions: List[str] = []
+        vals: Tuple[Any, ...] = ()
+        filter_tables: Set[str] = set()
         if len(self.row_filters) > 0:
             single_filter = reduce(lambda a, b: a & b, self.row_filters)
+            if db_conn is not None:
+                single_filter = single_filter.resolve(db_conn)
             q_filter, vals = single_filter.query()
-            where = f"WHERE {q_filter}"
-        else:
-            where = ""
-            vals = ()
-        query = f"""SELECT {', '.join(db.DF_COLUMNS)} FROM
+            conditions.append(q_filter)
+            filter_tables = single_filter.tables()
+            needed |= filter_tables
+        if self.unique:
+            first, first_vals = first_in_group(conditions, vals, filter_tables)
+            conditions.append(
+                f"(observation.group_identifier IS NULL OR observation.id IN ({first}))"
+            )
+            vals = vals + first_vals
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        joins = join_clause(needed)
+        group = (
+            f"GROUP BY {', '.join(self.group_columns)}" if self.group_columns else ""
+        )
+        query = f"""SELECT {', '.join(expressions)} FROM
         observation
-        LEFT JOIN sampling_event   ON sampling_event_id = sampling_event.id
-        LEFT JOIN species          ON species_id = species.id
-        LEFT JOIN location_data    ON location_data_id = location_data.id
-        LEFT JOIN breeding         ON breeding_id = breeding.id
-        LEFT JOIN protocol         ON protocol_id = protocol.id
-        {where}"""
+        {joins}
+        {where}
+        {group}"""
         return query, vals
 
-    def run(self, db_conn: sqlite3.Connection) -> List[Tuple[Any, ...]]:
-        """Execute the query, returning the raw data"""
-        query, vals = self.get_query()
+    def _zero_fill_query(
+        self, db_conn: Optional[sqlite3.Connection] = None
+    ) -> Tuple[str, Tuple[Any, ...]]:
+        """Compile a `zero_fill` query to sql.
+        Detections are found by going from the species to their observations, and every other complete checklist is a non-detection.
+        """
+        expressions, columns = self._select_list()
+        needed = {table_of(c) for c in columns}
+        target, target_vals = species_names(self.zero_fill_species).query()
+        where = "WHERE sampling_event.all_species_reported = 1"
+        vals: Tuple[Any, ...] = ()
+        if len(self.row_filters) > 0:
+            single_filter = reduce(lambda a, b: a & b, self.row_filters)
+            if db_conn is not None:
+                single_filter = single_filter.resolve(db_conn)
+            q_filter, vals = single_filter.checklist_query()
+            where += f" AND {q_filter}"
+            needed |= single_filter.tables()
+        joins = (
+            "LEFT JOIN location_data ON location_data_id = location_data.id"
+            if "location_data" in needed
+            else ""
+        )
+        query = f"""WITH target AS (
+            SELECT DISTINCT scientific_name FROM species WHERE {target}
+        ),
+        detection AS (
+            SELECT sampling_event_id, species.scientific_name,
+                CASE WHEN MAX(observation_count = 'X') THEN 'X'
+                    ELSE CAST(SUM(observation_count) AS INTEGER) END AS observation_count
+            FROM observation JOIN species ON species_id = species.id
+            WHERE species_id IN (
+                SELECT id FROM species WHERE scientific_name IN (SELECT scientific_name FROM target)
+            )
+            GROUP BY sampling_event_id, species.scientific_name
+        )
+        SELECT {', '.join(expressions)} FROM
+        sampling_event
+        CROSS JOIN target
+        LEFT JOIN detection ON detection.sampling_event_id = sampling_event.id
+            AND detection.scientific_name = target.scientific_name
+        {joins}
+        {where}"""
+        return query, target_vals + vals
+
+    def run(
+        self, db_conn: sqlite3.Connection, cache: Optional[ResultCache] = None
+    ) -> List[Tuple[Any, ...]]:
+        """Execute the query, returning the raw data
+
+        Args:
+            db_conn: The database connection.
+            cache:   If given, return the cached result if there is one, and cache the result otherwise.
+        """
+        register_functions(db_conn)
+        query, vals = self.get_query(db_conn)
+        if cache is not None:
+            return cache.get_or_run(
+                db_conn,
+                "rows",
+                query,
+                vals,
+                lambda: db_conn.execute(query, vals).fetchall(),
+            )
         cursor = db_conn.execute(query, vals)
         return cursor.fetchall()
 
-    def run_pandas(self, db_conn: sqlite3.Connection) -> pd.DataFrame:
-        """Execute the query, returning the results as a dataframe"""
-        query, vals = self.get_query()
-        return pd.read_sql_query(query, db_conn, params=vals)
+    @overload
+    def run_pandas(
+        self,
+        db_conn: sqlite3.Connection,
+        chunksize: None = None,
+        cache: Optional[ResultCache] = None,
+    ) -> pd.DataFrame:
+        ...
+
+    @overload
+    def run_pandas(
+        self,
+        db_conn: sqlite3.Connection,
+        chunksize: int,
+        cache: Optional[ResultCache] = None,
+    ) -> Iterator[pd.DataFrame]:
+        ...
+
+    def run_pandas(
+        self,
+        db_conn: sqlite3.Connection,
+        chunksize: Optional[int] = None,
+        cache: Optional[ResultCache] = None,
+    ) -> Union[pd.DataFrame, Iterator[pd.DataFrame]]:
+        """Execute the query, returning the results as a dataframe
+
+        Args:
+            db_conn:   The database connection.
+            chunksize: If given, return an iterator of dataframes with at most this many rows each,
+                       so the full result never has to be in memory.
+            cache:     If given, return the cached result if there is one, and cache the result otherwise.
+                       Chunked results aren't cached.
+        """
+        register_functions(db_conn)
+        query, vals = self.get_query(db_conn)
+        if cache is not None and chunksize is None:
+            return cache.get_or_run(
+                db_conn,
+                "pandas",
+                query,
+                vals,
+                lambda: pd.read_sql_query(query, db_conn, params=vals),
+            )
+        return pd.read_sql_query(query, db_conn, params=vals, chunksize=chunksize)
+
+    def iter_batches(
+        self, db_conn: sqlite3.Connection, batch_size: int = 100000
+    ) -> Iterator[List[Tuple[Any, ...]]]:
+        """Execute the query, returning the raw data in batches of at most `batch_size` rows.
+        Rows are fetched from sqlite as they're needed, so memory use doesn't depend on the size of the result.
+        """
+        register_functions(db_conn)
+        query, vals = self.get_query(db_conn)
+        cursor = db_conn.execute(query, vals)
+        try:
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+                yield rows
+        finally:
+            cursor.close()
+
+    async def run_async(
+        self,
+        pool: ConnectionPool,
+        pandas: bool = False,
+        executor: Optional[Executor] = None,
+    ) -> Any:
+        """Execute the query on a connection from `pool` without blocking the event loop.
+        If the task is cancelled, the running statement is interrupted.
+
+        Args:
+            pool:       The connection pool.
+            pandas:     Return a dataframe, as `run_pandas`, instead of rows.
+            executor:   The executor to run the query in. Defaults to the event loop's default executor.
+        """
+        loop = asyncio.get_running_loop()
+        job = Job(pool)
+
+        def run(conn: sqlite3.Connection) -> Any:
+            return self.run_pandas(conn) if pandas else self.run(conn)
+
+        def work() -> Any:
+            try:
+                return job.call(run)
+            finally:
+                job.close()
+
+        try:
+            return await loop.run_in_executor(executor, work)
+        except asyncio.CancelledError:
+            job.close()
+            raise
+
+    async def iter_batches_async(
+        self,
+        pool: ConnectionPool,
+        batch_size: int = 100000,
+        executor: Optional[Executor] = None,
+    ) -> AsyncIterator[List[Tuple[Any, ...]]]:
+        """Execute the query on a connection from `pool`, returning the raw data in batches of at most `batch_size` rows.
+        The connection is held until the iterator is exhausted or closed. Closing it early interrupts the query.
+
+        Args:
+            pool:       The connection pool.
+            batch_size: The maximum number of rows in each batch.
+            executor:   The executor to fetch rows in. Defaults to the event loop's default executor.
+        """
+        loop = asyncio.get_running_loop()
+        job = Job(pool)
+
+        def execute(conn: sqlite3.Connection):
+            register_functions(conn)
+            query, vals = self.get_query(conn)
+            # Set here rather than from the result, so it's closed even if the task is cancelled
+            job.cursor = conn.execute(query, vals)
+
+        def fetch(conn: sqlite3.Connection) -> List[Tuple[Any, ...]]:
+            return job.cursor.fetchmany(batch_size)  # type: ignore
+
+        try:
+            await loop.run_in_executor(executor, job.call, execute)
+            while True:
+                rows = await loop.run_in_executor(executor, job.call, fetch)
+                if not rows:
+                    break
+                yield rows
+        finally:
+            job.close()
+
+    def _output_columns(self) -> Tuple[str, ...]:
+        """The names of the columns in the result."""
+        expressions, _ = self._select_list()
+        return tuple(e.split(" AS ")[-1].split(".")[-1] for e in expressions)
+
+    def arrow_schema(self, db_conn: sqlite3.Connection) -> "pa.Schema":
+        """The schema of the Arrow output of this query.
+        Types come from the declared column types, species and location text columns are dictionary encoded.
+        """
+        import pyarrow as pa  # type: ignore
+
+        declared: Dict[str, str] = {}
+        for table in set(COLUMN_TABLES.values()):
+            for _, name, sql_type, *_ in db_conn.execute(f"PRAGMA table_info({table})"):
+                declared[f"{table}.{name}"] = sql_type.lower()
+
+        fields = []
+        for column in self._output_columns():
+            if column in ("count", "species_observed") or column.startswith(
+                "distinct_"
+            ):
+                arrow_type = pa.int64()
+            elif column.startswith("sum_"):
+                arrow_type = pa.float64()
+            elif column in ARROW_STRING_COLUMNS:
+                arrow_type = pa.string()
+            else:
+                table = table_of(column)
+                type_name = SQL_ARROW_TYPES.get(declared[f"{table}.{column}"], "string")
+                if type_name == "string" and table in DICTIONARY_TABLES:
+                    arrow_type = pa.dictionary(pa.int32(), pa.string())
+                else:
+                    arrow_type = pa.type_for_alias(type_name)
+            fields.append(pa.field(column, arrow_type))
+        return pa.schema(fields)
+
+    def iter_arrow(
+        self,
+        db_conn: sqlite3.Connection,
+        batch_size: int = 100000,
+        schema: Optional["pa.Schema"] = None,
+    ) -> Iterator["pa.RecordBatch"]:
+        """Execute the query, returning the results as Arrow record batches of at most `batch_size` rows.
+        Like `iter_batches`, memory use doesn't depend on the size of the result.
+        """
+        import pyarrow as pa  # type: ignore
+
+        if schema is None:
+            schema = self.arrow_schema(db_conn)
+        for rows in self.iter_batches(db_conn, batch_size):
+            arrays = []
+            for field, values in zip(schema, zip(*rows)):
+                if field.name in ARROW_STRING_COLUMNS:
+                    values = tuple(None if v is None else str(v) for v in values)
+                if pa.types.is_dictionary(field.type):
+                    arrays.append(
+                        pa.array(values, type=field.type.value_type).dictionary_encode()
+                    )
+                else:
+                    arrays.append(pa.array(values, type=field.type))
+            yield pa.RecordBatch.from_arrays(arrays, schema=schema)
+
+    def to_arrow(
+        self, db_conn: sqlite3.Connection, batch_size: int = 100000
+    ) -> "pa.Table":
+        """Execute the query, returning the results as an Arrow table.
+        The table is made of batches of at most `batch_size` rows, see `iter_arrow`.
+        """
+        import pyarrow as pa  # type: ignore
+
+        schema = self.arrow_schema(db_conn)
+        return pa.Table.from_batches(
+            self.iter_arrow(db_conn, batch_size, schema), schema=schema
+        )
+
+    def to_parquet(
+        self,
+        db_conn: sqlite3.Connection,
+        path: Union[str, Path],
+        batch_size: int = 100000,
+        compression: str = "zstd",
+    ):
+        """Execute the query, writing the results to a parquet file.
+        Results are written one batch at a time, so the full result is never in memory.
+
+        Args:
+            db_conn:        The database connection.
+            path:           Where to write the file.
+            batch_size:     The maximum number of rows to hold in memory. Each batch is written as (at least) one row group.
+            compression:    The parquet compression codec.
+        """
+        import pyarrow.parquet as pq  # type: ignore
+
+        schema = self.arrow_schema(db_conn)
+        with pq.ParquetWriter(str(path), schema, compression=compression) as writer:
+            for batch in self.iter_arrow(db_conn, batch_size, schema):
+                writer.write_batch(batch)
 
 
 def implicit_query(f: Callable[..., Query]) -> Callable[..., Query]:
@@ -483,11 +1405,26 @@ def no_filter():
     return q
 
 
+@implicit_query
+def select(columns: Iterable[str]) -> Query:  # type: ignore
+    pass
+
+
+@implicit_query
+def group_by(*columns: str) -> Query:  # type: ignore
+    pass
+
+
 @implicit_query
 def species(names: Union[str, Iterable[str]]) -> Query:  # type: ignore
     pass
 
 
+@implicit_query
+def clade(name: str) -> Query:  # type: ignore
+    pass
+
+
 @implicit_query
 def country(names: Union[str, Iterable[str]]) -> Query:  # type: ignore
     pass
@@ -513,6 +1450,11 @@ def bbox(
     pass
 
 
+@implicit_query
+def near(lat: float, lon: float, radius: float, unit: Distance = "km") -> Query:  # type: ignore
+    pass
+
+
 @implicit_query
 def date(after: Optional[str] = None, before: Optional[str] = None) -> Query:  # type: ignore
     pass
@@ -560,11 +1502,21 @@ def complete() -> Query:  # type: ignore
     raise NotImplementedError
 
 
+@implicit_query
+def unique_checklists() -> Query:  # type: ignore
+    pass
+
+
+@implicit_query
+def zero_fill(names: Union[str, Iterable[str]]) -> Query:  # type: ignore
+    pass
+
+
 # Extra queries
 
 
 def has_bcr(db_conn: sqlite3.Connection) -> Any:
-    q = Query()._update_filter(NotNull("bcr_id"))
+    q = Query()._update_filter(NotNull("bcr_code"))
     return q.run(db_conn)
 
 
@@ -574,5 +1526,53 @@ def has_usfws(db_conn: sqlite3.Connection) -> Any:
 
 
 def has_iba(db_conn: sqlite3.Connection) -> Any:
-    q = Query()._update_filter(NotNull("iba_coda"))
+    q = Query()._update_filter(NotNull("iba_code"))
     return q.run(db_conn)
+
+
+def nearest(
+    db_conn: sqlite3.Connection,
+    lat: float,
+    lon: float,
+    k: int = 1,
+    locality_type: Optional[str] = None,
+    unit: Distance = "km",
+) -> pd.DataFrame:
+    """Find the `k` locations closest to a point.
+    Searches outward from the point with the spatial index, so the cost depends on how far away the locations are, not on the total number of locations.
+
+    Args:
+        db_conn:       The database connection.
+        lat:           The latitude of the point.
+        lon:           The longitude of the point.
+        k:             The number of locations to find.
+        locality_type: Only find locations of this type, e.g. "H" for hotspots. Defaults to all locations.
+        unit:          The unit of the returned distances, either 'km' or 'miles'. Defaults to 'km'
+
+    Returns:
+        The rows of location_data, closest first, with the distance in a `distance` column.
+    """
+    register_functions(db_conn)
+    type_filter = "" if locality_type is None else "AND locality_type = ?"
+    type_vals: Tuple[Any, ...] = () if locality_type is None else (locality_type,)
+    half_circumference = math.pi * EARTH_RADIUS_KM
+
+    radius_km = 1.0
+    while True:
+        candidates, vals = rtree_candidates(radius_boxes(lat, lon, radius_km))
+        query = f"""SELECT * FROM (
+            SELECT *, haversine_km(latitude, longitude, ?, ?) AS distance FROM location_data
+            WHERE id IN ({candidates}) {type_filter}
+        )
+        WHERE distance <= ?
+        ORDER BY distance
+        LIMIT ?"""
+        params = (lat, lon) + vals + type_vals + (radius_km, k)
+        res = pd.read_sql_query(query, db_conn, params=params)
+        if len(res) >= k or radius_km >= half_circumference:
+            break
+        radius_km *= 4
+
+    if unit == "miles":
+        res["distance"] /= MILES_TO_KM
+    return res
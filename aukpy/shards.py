@@ -0,0 +1,315 @@
+"""Databases split into several files (shards), by country, state or year.
+Every shard is an ordinary aukpy database, so shards can be built in parallel, and each one stays small enough to vacuum or rebuild on its own.
+`ShardedDB` runs a `queries.Query` across the shards as though they were a single database.
+"""
+import io
+import json
+import re
+import shutil
+import sqlite3
+import pandas as pd
+
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, Literal, Optional, Tuple, Union
+
+from aukpy import db
+from aukpy.cache import ResultCache
+from aukpy.queries import ColumnRanges, ColumnValues, Query
+
+
+Partition = Literal["country_code", "state_code", "year"]
+
+MANIFEST = "manifest.json"
+# The columns whose distinct values are recorded for each shard, to skip shards a query can't match
+SUMMARY_VALUES = ("country", "country_code", "state", "state_code")
+# The columns whose range is recorded for each shard
+SUMMARY_RANGES = (
+    ("sampling_event", "observation_date"),
+    ("sampling_event", "year"),
+    ("location_data", "latitude"),
+    ("location_data", "longitude"),
+)
+# Group by columns that determine the shard, for each partition.
+# Groups then never span shards, so every aggregate can be merged.
+ALIGNED_COLUMNS = {
+    "country_code": ("country", "country_code", "state_code"),
+    "state_code": ("state_code",),
+    "year": ("year",),
+}
+
+
+def shard_name(key: str) -> str:
+    """The file name stem of the shard for a partition key."""
+    return re.sub(r"[^A-Za-z0-9_-]", "_", key) or "unknown"
+
+
+def split_observations(
+    input_path: Path,
+    split_dir: Path,
+    by: Partition,
+    max_size: int,
+    member: Optional[str] = None,
+    progress: Optional[db.Progress] = None,
+) -> Dict[str, Path]:
+    """Split an observations file into one file per partition key, without parsing anything but the key.
+
+    Returns:
+        The path of the file for each shard, keyed by shard name.
+    """
+    paths: Dict[str, Path] = {}
+    column = "observation_date" if by == "year" else by
+    for _, raw in db.raw_chunks(input_path, max_size, member=member, progress=progress):
+        header, body = raw.split(b"\n", 1)
+        names = [
+            x.lower().replace(" ", "_").replace("/", "_")
+            for x in header.decode().rstrip("\r").split("\t")
+        ]
+        i = names.index(column)
+
+        lines: Dict[str, List[bytes]] = defaultdict(list)
+        for line in io.BytesIO(body):
+            if not line.endswith(b"\n"):
+                line += b"\n"
+            key = line.split(b"\t", i + 1)[i].decode()
+            if by == "year":
+                key = key[:4]
+            lines[shard_name(key)].append(line)
+
+        # Files are reopened for each chunk, there can be more shards than open files allowed
+        for name, shard_lines in lines.items():
+            if name not in paths:
+                paths[name] = split_dir / f"{name}.txt"
+                paths[name].write_bytes(header + b"\n")
+            with paths[name].open("ab") as f:
+                f.writelines(shard_lines)
+    return paths
+
+
+def summarize(conn: sqlite3.Connection) -> Dict[str, Any]:
+    """Summarize a shard's contents, for `queries.Filter.may_match`."""
+    values: Dict[str, set] = {c: set() for c in SUMMARY_VALUES}
+    for row in conn.execute(
+        f"SELECT DISTINCT {', '.join(SUMMARY_VALUES)} FROM location_data"
+    ):
+        for column, value in zip(SUMMARY_VALUES, row):
+            if value is not None:
+                values[column].add(value)
+    ranges = {}
+    for table, column in SUMMARY_RANGES:
+        minimum, maximum = conn.execute(
+            f"SELECT MIN({column}), MAX({column}) FROM {table}"
+        ).fetchone()
+        if minimum is not None:
+            ranges[column] = [minimum, maximum]
+    return {
+        "rows": conn.execute("SELECT COUNT(*) FROM observation").fetchone()[0],
+        "values": {c: sorted(v) for c, v in values.items()},
+        "ranges": ranges,
+    }
+
+
+def build_shard(args: Tuple[Path, Path, int, bool, bool]) -> Dict[str, Any]:
+    """Build a single shard from its observations file, and delete the file.
+    Runs in the worker processes of `build_db_sharded`.
+
+    Returns:
+        The shard's entry in the manifest.
+    """
+    input_path, output_path, max_size, index, fast = args
+    conn = db.build_db_incremental(
+        input_path, output_path, max_size=max_size, index=index, fast=fast
+    )
+    entry = {"path": output_path.name, **summarize(conn)}
+    conn.close()
+    input_path.unlink()
+    return entry
+
+
+def build_db_sharded(
+    input_path: Path,
+    output_dir: Path,
+    by: Partition = "country_code",
+    max_size: int = 100000,
+    workers: int = 1,
+    index: bool = True,
+    fast: bool = False,
+    member: Optional[str] = None,
+    progress: Optional[db.Progress] = None,
+) -> "ShardedDB":
+    """Build a database split into one file per country, state or year.
+    The observations file is first split into one file per shard, then the shards are built in parallel.
+    A manifest describing the shards is written last, so a directory without one is an incomplete build.
+
+    Args:
+        input_path (Path):          Path to the CSV of observations.
+        output_dir (Path):          The directory to store the shards and the manifest in.
+        by (Partition, optional):   The column to partition by, one of country_code, state_code or year. Defaults to country_code.
+        max_size (int, optional):   The maximum number of lines of the CSV to read at a time.
+        workers (int, optional):    The number of shards to build at once. Defaults to 1 (no parallelism).
+        index (bool, optional):     Whether to create the query indexes after loading. Defaults to True.
+        fast (bool, optional):      Use settings for bulk loading, see `db.BULK_PRAGMAS`.
+        member (str, optional):     For archives, the file to read, see `db.open_input`.
+        progress (optional):        Called as the input is split, see `db.build_db_incremental`.
+    """
+    if by not in ALIGNED_COLUMNS:
+        raise ValueError(f"Unknown partition: {by}")
+    output_dir.mkdir(parents=True, exist_ok=True)
+    (output_dir / MANIFEST).unlink(missing_ok=True)
+    split_dir = output_dir / "split"
+    # Leftovers from an interrupted build would be appended to
+    shutil.rmtree(split_dir, ignore_errors=True)
+    split_dir.mkdir()
+
+    paths = split_observations(input_path, split_dir, by, max_size, member, progress)
+    jobs = []
+    for name, path in sorted(paths.items()):
+        output_path = output_dir / f"{name}.sqlite"
+        output_path.unlink(missing_ok=True)
+        jobs.append((path, output_path, max_size, index, fast))
+
+    if workers <= 1:
+        entries = list(map(build_shard, jobs))
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            entries = list(executor.map(build_shard, jobs))
+    split_dir.rmdir()
+
+    manifest = {"partition": by, "shards": dict(zip(sorted(paths), entries))}
+    (output_dir / MANIFEST).write_text(json.dumps(manifest, indent=2))
+    return ShardedDB(output_dir)
+
+
+class ShardedDB:
+    """A database built by `build_db_sharded`.
+    Queries are only run on the shards their filters could match, in parallel, and the results are merged.
+
+    Aggregates (`Query.count`, `Query.sum`) are merged by summing over each group.
+    `Query.distinct` can't be merged that way, so it's only allowed if the groups can't span shards,
+    i.e. the query is grouped by the partition column (or one determined by it), or it only runs on one shard.
+
+    Args:
+        directory:  The directory the database was built in.
+        workers:    The number of shards to query at once. Defaults to one per shard.
+        cache:      If given, each shard's results are cached.
+    """
+
+    def __init__(
+        self,
+        directory: Union[str, Path],
+        workers: Optional[int] = None,
+        cache: Optional[ResultCache] = None,
+    ):
+        self.directory = Path(directory)
+        manifest_path = self.directory / MANIFEST
+        if not manifest_path.is_file():
+            raise FileNotFoundError(manifest_path)
+        manifest = json.loads(manifest_path.read_text())
+        self.partition: Partition = manifest["partition"]
+        self.shards: Dict[str, Dict[str, Any]] = manifest["shards"]
+        self.workers = workers or max(1, len(self.shards))
+        self.cache = cache
+
+    def __len__(self) -> int:
+        return len(self.shards)
+
+    def shards_for(self, query: Query) -> List[str]:
+        """The names of the shards that could have results for a query."""
+        names = []
+        for name, shard in self.shards.items():
+            values: ColumnValues = {c: set(v) for c, v in shard["values"].items()}
+            ranges: ColumnRanges = {c: tuple(r) for c, r in shard["ranges"].items()}  # type: ignore
+            if all(f.may_match(values, ranges) for f in query.row_filters):
+                names.append(name)
+        return names
+
+    def connect(self, name: str) -> sqlite3.Connection:
+        """Open a read-only connection to a shard."""
+        path = self.directory / self.shards[name]["path"]
+        return sqlite3.connect(f"{path.absolute().as_uri()}?mode=ro", uri=True)
+
+    def _check_mergeable(self, query: Query, names: List[str]):
+        distinct = any(f == "distinct" for f, _ in query.aggregates)
+        aligned = set(query.group_columns) & set(ALIGNED_COLUMNS[self.partition])
+        if distinct and len(names) > 1 and not aligned:
+            raise ValueError(
+                f"distinct can't be merged across shards unless the query is grouped by {self.partition}"
+            )
+
+    def _run_shards(self, query: Query, pandas: bool) -> List[Any]:
+        names = self.shards_for(query)
+        self._check_mergeable(query, names)
+
+        def run(name: str) -> Any:
+            conn = self.connect(name)
+            try:
+                if pandas:
+                    return query.run_pandas(conn, cache=self.cache)
+                else:
+                    return query.run(conn, cache=self.cache)
+            finally:
+                conn.close()
+
+        if len(names) <= 1:
+            return list(map(run, names))
+        with ThreadPoolExecutor(min(self.workers, len(names))) as executor:
+            return list(executor.map(run, names))
+
+    def run(self, query: Query) -> List[Tuple[Any, ...]]:
+        """Execute the query on every shard it could match, returning the raw data, as `Query.run`."""
+        results = self._run_shards(query, pandas=False)
+        if not results and query.aggregates and not query.group_columns:
+            return [empty_aggregates(query)]
+        rows = [row for result in results for row in result]
+        if not query.aggregates or len(results) <= 1:
+            return rows
+        return merge_aggregate_rows(rows, len(query.group_columns))
+
+    def run_pandas(self, query: Query) -> pd.DataFrame:
+        """Execute the query on every shard it could match, returning the results as a dataframe, as `Query.run_pandas`."""
+        results = self._run_shards(query, pandas=True)
+        if not results:
+            if query.aggregates and not query.group_columns:
+                return pd.DataFrame(
+                    [empty_aggregates(query)], columns=list(query._output_columns())
+                )
+            return pd.DataFrame(columns=list(query._output_columns()))
+        df = pd.concat(results, ignore_index=True)
+        if not query.aggregates or len(results) <= 1:
+            return df
+        if not query.group_columns:
+            return df.groupby(lambda _: 0).sum(min_count=1).reset_index(drop=True)
+        return df.groupby(
+            list(query.group_columns), dropna=False, sort=False, as_index=False
+        ).sum(min_count=1)
+
+
+def empty_aggregates(query: Query) -> Tuple[Any, ...]:
+    """The row an ungrouped aggregate query returns when nothing matches, as sqlite would:
+    counts are 0 and sums are NULL.
+    """
+    return tuple(None if function == "sum" else 0 for function, _ in query.aggregates)
+
+
+def merge_aggregate_rows(
+    rows: Iterable[Tuple[Any, ...]], num_groups: int
+) -> List[Tuple[Any, ...]]:
+    """Merge the aggregated rows of several shards by summing the aggregates of each group.
+    NULL sums (groups with no numeric values) stay NULL unless another shard has a value.
+
+    Args:
+        rows:       The rows, each the group columns followed by the aggregates.
+        num_groups: The number of group columns.
+    """
+    merged: Dict[Tuple[Any, ...], List[Any]] = {}
+    for row in rows:
+        key, aggregates = row[:num_groups], row[num_groups:]
+        if key not in merged:
+            merged[key] = list(aggregates)
+            continue
+        totals = merged[key]
+        for i, value in enumerate(aggregates):
+            if value is not None:
+                totals[i] = value if totals[i] is None else totals[i] + value
+    return [key + tuple(totals) for key, totals in merged.items()]
@@ -1,4 +1,7 @@
-from typing import List, Optional, Set
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import Dict, FrozenSet, List, Optional, Set, Tuple
+import numpy as np
 import pandas as pd
 
 from aukpy import config
@@ -24,35 +27,102 @@ def load_usfws() -> pd.DataFrame:
     return pd.read_csv(config.USFWS_CODES, sep="\t")
 
 
+@dataclass(frozen=True)
+class TaxonomyIndex:
+    """Precomputed lookups over the taxonomy. All names are lowercase.
+    Where a name is used at more than one level, orders take precedence over families, and families over genera.
+    """
+
+    # Taxon to its child taxa. The children of a genus are species epithets.
+    children: Dict[str, List[str]]
+    # Taxon to its parent taxon
+    parents: Dict[str, str]
+    # Taxon to the scientific names of every species in it
+    species: Dict[str, FrozenSet[str]]
+    # Taxon to the (inclusive) ranges of taxonomic order of every taxon in it, including spuhs, slashes and hybrids
+    ranges: Dict[str, Tuple[Tuple[int, int], ...]]
+
+
+def contiguous_ranges(orders: np.ndarray) -> Tuple[Tuple[int, int], ...]:
+    """Split positions in the taxonomy into runs of consecutive positions.
+
+    Args:
+        orders: The sorted positions.
+
+    Returns:
+        The first and last position of each run.
+    """
+    breaks = np.flatnonzero(np.diff(orders) != 1) + 1
+    return tuple((int(run[0]), int(run[-1])) for run in np.split(orders, breaks))
+
+
+@lru_cache(maxsize=None)
+def taxonomy_index() -> TaxonomyIndex:
+    """Get the taxonomy index. Built the first time it's needed, and shared by the whole process."""
+    taxonomy = load_taxonomy().sort_values("taxon_order", ignore_index=True)
+    proper_species = taxonomy.loc[taxonomy["category"] == "species", :].copy()
+    g_and_s = proper_species["sci_name"].str.split(" ")
+    proper_species["genus"] = g_and_s.str[0]
+    proper_species["species"] = g_and_s.str[1]
+
+    levels = (
+        # (column, child column, rows to use)
+        ("genus", "species", proper_species),
+        ("family", "genus", proper_species),
+        ("order", "family", taxonomy),
+    )
+    children: Dict[str, List[str]] = {}
+    parents: Dict[str, str] = {}
+    species: Dict[str, FrozenSet[str]] = {}
+    # Lower levels are added first, so that higher levels overwrite them
+    for column, child, data in levels:
+        children.update(
+            (str(k), list(v)) for k, v in data.groupby(column)[child].unique().items()
+        )
+        species.update(
+            (str(k), frozenset(v))
+            for k, v in proper_species.groupby(column)["sci_name"].unique().items()
+        )
+    for column, parent, data in (
+        ("genus", "family", proper_species),
+        ("family", "order", taxonomy),
+    ):
+        parents.update(
+            (str(k), v) for k, v in data.groupby(column)[parent].first().items()
+        )
+    parents.update((o, "aves") for o in taxonomy["order"].unique())
+
+    # Taxa are contiguous in taxonomic order, apart from a few genera
+    taxon_order = taxonomy["taxon_order"].to_numpy()
+    all_levels = taxonomy.assign(genus=taxonomy["sci_name"].str.split(" ").str[0])
+    ranges: Dict[str, Tuple[Tuple[int, int], ...]] = {}
+    for column in ("genus", "family", "order"):
+        for k, positions in all_levels.groupby(column).indices.items():
+            # Spuhs have common names in place of a genus
+            if str(k) in species:
+                ranges[str(k)] = tuple(
+                    (int(taxon_order[first]), int(taxon_order[last]))
+                    for first, last in contiguous_ranges(np.asarray(positions))
+                )
+    return TaxonomyIndex(children, parents, species, ranges)
+
+
 def get_all_species(clade_name: str) -> Set[str]:
     """Get all species in a clade"""
-    taxonomy = load_taxonomy()
-    relevant = taxonomy[taxonomy["category"] == "species"]
     fmt_name = clade_name.lower().strip()
+    return set(taxonomy_index().species.get(fmt_name, ()))
 
-    if fmt_name in relevant["order"].values:
-        filt = relevant["order"] == fmt_name
-    elif fmt_name in relevant["family"].values:
-        filt = relevant["family"] == fmt_name
-        # return list(relevant.loc[filt, "sci_name"].unique())  # type: ignore
-    else:
-        g_and_s = taxonomy["sci_name"].str.split(" ")
-        taxonomy["genus"] = g_and_s.str[0]
-        taxonomy["species"] = g_and_s.str[1]
-        relevant = taxonomy[taxonomy["category"] == "species"]
 
-        if fmt_name in relevant["genus"].values:
-            filt = relevant["genus"] == fmt_name
-        else:
-            return set()
-
-    species = relevant.loc[filt, "sci_name"].unique()
-    return set(species)  # type: ignore
+def get_taxonomic_ranges(clade_name: str) -> List[Tuple[int, int]]:
+    """Get the ranges of taxonomic order (inclusive) covering a clade, or an empty list if it isn't one.
+    Unlike `get_all_species`, the ranges include every taxon in the clade, e.g. subspecies, spuhs and hybrids.
+    """
+    fmt_name = clade_name.lower().strip()
+    return list(taxonomy_index().ranges.get(fmt_name, ()))
 
 
 def get_parent_taxon(name: str) -> Optional[str]:
     """Given the name of a taxon, get the parent taxon.
-    Performance could be improved by caching more of the taxonomy but there's not much point yet.
 
     Args:
         name: The name of the taxon. Case-insensitive.
@@ -66,28 +136,7 @@ def get_parent_taxon(name: str) -> Optional[str]:
         "struthionidae"
     """
     fmt_name = name.lower().strip()
-    taxonomy = load_taxonomy()
-    # Check orders
-    orders = set(taxonomy["order"].unique())
-    if fmt_name in orders:
-        return "aves"
-    else:
-        # Check family
-        f_to_o = taxonomy.groupby("family")["order"].first()
-        if fmt_name in f_to_o:
-            return f_to_o[fmt_name]
-        else:
-            # Check genus
-            # We ignore the SettingWithCopyWarning because we're throwing out dataframe immediately.
-            # Copying it would be a waste.
-            prev = pd.options.mode.chained_assignment
-            pd.options.mode.chained_assignment = None  # type: ignore
-            proper_species = taxonomy.loc[taxonomy["category"] == "species", :]
-            proper_species["genus"] = proper_species["sci_name"].str.split(" ").str[0]
-            g_to_f = proper_species.groupby("genus")["family"].first()
-            # Return to previous setting
-            pd.options.mode.chained_assignment = prev
-            return g_to_f.get(fmt_name, None)  # type: ignore
+    return taxonomy_index().parents.get(fmt_name, None)
 
 
 def get_child_taxa(name: str) -> Optional[List[str]]:
@@ -104,27 +153,6 @@ def get_child_taxa(name: str) -> Optional[List[str]]:
         >>> get_child_taxa('gavia')
         ['stellata', 'arctica', 'pacifica', 'immer', 'adamsii']
     """
-    taxonomy = load_taxonomy()
     fmt_name = name.lower().strip()
-    # Check orders
-    orders = taxonomy.groupby("order")["family"].unique()
-    if fmt_name in orders:
-        return list(orders[fmt_name])
-    else:
-        # Check family
-        g_and_s = taxonomy["sci_name"].str.split(" ")
-        taxonomy["genus"] = g_and_s.str[0]
-        taxonomy["species"] = g_and_s.str[1]
-        relevant = taxonomy[taxonomy["category"] == "species"]
-
-        f_to_g = relevant.groupby("family")["genus"].unique()
-        if fmt_name in f_to_g:
-            return list(f_to_g[fmt_name])
-        else:
-            # Check genus
-            g_to_s = relevant.groupby("genus")["species"].unique()
-            res = g_to_s.get(fmt_name, None)
-            if res is not None:
-                return list(res)  # type: ignore
-            else:
-                return None
+    res = taxonomy_index().children.get(fmt_name, None)
+    return list(res) if res is not None else None
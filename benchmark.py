@@ -0,0 +1,290 @@
+"""Repeatable benchmarks for the build and query paths.
+
+Usage:
+    python benchmark.py run [num_rows] [output.json]
+    python benchmark.py compare baseline.json new.json
+
+Every case runs in a fresh process against synthetic data.
+Peak RSS is measured per case on Linux, by resetting the process's high-water mark before the case runs.
+Elsewhere it's the peak of the whole worker process, including its imports.
+"""
+import csv
+import json
+import platform
+import resource
+import sqlite3
+import subprocess
+import sys
+import numpy as np
+import pandas as pd
+
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from pathlib import Path
+from statistics import median
+from tempfile import TemporaryDirectory
+from time import perf_counter
+from typing import Any, Callable, Dict, Optional
+
+from aukpy import db, queries
+
+from tests import M_SMALL
+from tests import data_utils
+
+
+GUID_PREFIX = "URN:CornellLabOfOrnithology:EBIRD:OBS"
+QUERY_REPEATS = 5
+# A change in a metric smaller than this is treated as noise by `compare`
+TOLERANCE = 0.1
+
+
+def synthetic_observations(
+    out_path: Path, num_rows: int, seed_path: Path = M_SMALL, seed: int = 0
+) -> Path:
+    """Write a synthetic observations file with (roughly) `num_rows` rows.
+    The seed file is tiled until it's large enough, with every copy given fresh identifiers and shifted into a different year,
+    and then scrambled with `data_utils.scramble_observations`.
+    """
+    np.random.seed(seed)
+    base = pd.read_csv(seed_path, sep="\t", quoting=csv.QUOTE_NONE)
+    guids = base["global_unique_identifier"].str[len(GUID_PREFIX) :].astype(int)
+    events = base["sampling_event_identifier"].str[1:].astype(int)
+    years = base["observation_date"].str[:4].astype(int)
+
+    copies = []
+    for i in range(-(-num_rows // len(base))):
+        copy = base.copy()
+        copy["global_unique_identifier"] = GUID_PREFIX + (
+            guids + i * (guids.max() + 1)
+        ).astype(str)
+        copy["sampling_event_identifier"] = "S" + (
+            events + i * (events.max() + 1)
+        ).astype(str)
+        copy["observation_date"] = (years - i % 10).astype(str) + base[
+            "observation_date"
+        ].str[4:]
+        copies.append(copy)
+    df = pd.concat(copies, ignore_index=True).iloc[:num_rows]
+
+    df = data_utils.scramble_observations(df)
+    df.to_csv(out_path, sep="\t", index=False, quoting=csv.QUOTE_NONE)
+    return out_path
+
+
+def reset_peak_rss() -> bool:
+    """Reset the peak resident set size reported by `peak_rss_kb` to the current one. Linux only.
+
+    Returns:
+        Whether the peak was reset.
+    """
+    try:
+        Path("/proc/self/clear_refs").write_text("5")
+    except OSError:
+        return False
+    return True
+
+
+def peak_rss_kb() -> int:
+    """The peak resident set size of this process, in KiB.
+    On Linux, since the last `reset_peak_rss`. `ru_maxrss` can't be used there, it's inherited across fork and exec.
+    """
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macOS reports bytes, Linux reports KiB
+    return peak // 1024 if sys.platform == "darwin" else peak
+
+
+def bench_build_pandas(data_path: Path, work_dir: Path) -> Dict[str, Any]:
+    db_path = work_dir / "pandas.sqlite"
+    start = perf_counter()
+    conn = db.build_db_pandas(data_path, db_path)
+    elapsed = perf_counter() - start
+    rows = conn.execute("SELECT COUNT(*) FROM observation").fetchone()[0]
+    conn.close()
+    return {
+        "seconds": elapsed,
+        "rows_per_second": rows / elapsed,
+        "db_size_bytes": db_path.stat().st_size,
+    }
+
+
+def bench_build_incremental(data_path: Path, work_dir: Path) -> Dict[str, Any]:
+    start = perf_counter()
+    conn = db.build_db_incremental(data_path, work_dir / "incremental.sqlite")
+    elapsed = perf_counter() - start
+    rows = conn.execute("SELECT COUNT(*) FROM observation").fetchone()[0]
+    conn.close()
+    return {"seconds": elapsed, "rows_per_second": rows / elapsed}
+
+
+def bench_inserts(data_path: Path, work_dir: Path) -> Dict[str, Any]:
+    """Time the insertion of the whole file into each table, excluding parsing and preprocessing."""
+    start = perf_counter()
+    _, df = db.parse_chunk((0, data_path.read_bytes()))
+    results: Dict[str, Any] = {"normalize_seconds": perf_counter() - start}
+    conn = sqlite3.connect(":memory:")
+    db.create_tables(conn)
+    for wrapper in db.WRAPPERS + (db.ObservationWrapper,):
+        start = perf_counter()
+        df, _ = wrapper.insert(df, conn, processed=True)
+        results[f"{wrapper.table_name}_seconds"] = perf_counter() - start
+    conn.close()
+    return results
+
+
+def bench_undo_compression(data_path: Path, work_dir: Path) -> Dict[str, Any]:
+    conn = sqlite3.connect(work_dir / "pandas.sqlite")
+    df = queries.no_filter().run_pandas(conn)
+    conn.close()
+    start = perf_counter()
+    db.undo_compression(df)
+    elapsed = perf_counter() - start
+    return {"seconds": elapsed, "rows_per_second": len(df) / elapsed}
+
+
+def representative_queries(conn: sqlite3.Connection) -> Dict[str, queries.Query]:
+    """The queries timed by `bench_queries`, with parameters picked from the data so every query has results."""
+    (species,) = conn.execute(
+        "SELECT scientific_name FROM observation JOIN species ON species.id = species_id "
+        "GROUP BY species_id ORDER BY COUNT(*) DESC LIMIT 1"
+    ).fetchone()
+    (country,) = conn.execute(
+        "SELECT country FROM location_data GROUP BY country ORDER BY COUNT(*) DESC LIMIT 1"
+    ).fetchone()
+    lat, lon = conn.execute(
+        "SELECT AVG(latitude), AVG(longitude) FROM location_data"
+    ).fetchone()
+    (year,) = conn.execute("SELECT MAX(year) FROM sampling_event").fetchone()
+    return {
+        "species": queries.species(species),
+        "bbox": queries.bbox(lon - 0.5, lat - 0.5, lon + 0.5, lat + 0.5),
+        "wildcard_date": queries.date("*-01-05", "*-01-20"),
+        "country_date": queries.country(country).date(f"{year}-01-01", f"{year}-06-30"),
+    }
+
+
+def bench_queries(data_path: Path, work_dir: Path) -> Dict[str, Any]:
+    """Median latency of each representative query, in seconds."""
+    conn = sqlite3.connect(work_dir / "pandas.sqlite")
+    results: Dict[str, Any] = {}
+    for name, query in representative_queries(conn).items():
+        times = []
+        for _ in range(QUERY_REPEATS):
+            start = perf_counter()
+            rows = query.run(conn)
+            times.append(perf_counter() - start)
+        results[f"{name}_seconds"] = median(times)
+        results[f"{name}_rows"] = len(rows)
+    conn.close()
+    return results
+
+
+# Run in order, later cases reuse the database built by `build_pandas`
+CASES: Dict[str, Callable[[Path, Path], Dict[str, Any]]] = {
+    "build_pandas": bench_build_pandas,
+    "build_incremental": bench_build_incremental,
+    "inserts": bench_inserts,
+    "undo_compression": bench_undo_compression,
+    "queries": bench_queries,
+}
+
+
+def run_case(name: str, data_path: Path, work_dir: Path) -> Dict[str, Any]:
+    reset_peak_rss()
+    results = CASES[name](data_path, work_dir)
+    results["peak_rss_kb"] = peak_rss_kb()
+    return results
+
+
+def git_commit() -> Optional[str]:
+    try:
+        out = subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+            cwd=Path(__file__).parent,
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return out.stdout.strip()
+
+
+def run_all(num_rows: int = 100000, seed: int = 0) -> Dict[str, Any]:
+    """Run every benchmark case against a freshly generated synthetic dataset."""
+    report: Dict[str, Any] = {
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "sqlite": sqlite3.sqlite_version,
+        "pandas": pd.__version__,
+        "num_rows": num_rows,
+        "seed": seed,
+        "cases": {},
+    }
+    with TemporaryDirectory() as tmp:
+        work_dir = Path(tmp)
+        data_path = synthetic_observations(
+            work_dir / "observations.txt", num_rows, seed=seed
+        )
+        report["data_size_bytes"] = data_path.stat().st_size
+        for name in CASES:
+            # A fresh process per case, so earlier cases don't leave anything cached or allocated
+            with ProcessPoolExecutor(1, mp_context=get_context("spawn")) as executor:
+                report["cases"][name] = executor.submit(
+                    run_case, name, data_path, work_dir
+                ).result()
+    return report
+
+
+def lower_is_better(metric: str) -> Optional[bool]:
+    if metric.endswith("_per_second"):
+        return False
+    elif metric.endswith("seconds") or metric.endswith("_kb"):
+        return True
+    else:
+        return None
+
+
+def compare(baseline: Dict[str, Any], new: Dict[str, Any]) -> Dict[str, float]:
+    """The ratio new / baseline of every timing and memory metric present in both reports."""
+    ratios = {}
+    for case, metrics in new["cases"].items():
+        old_metrics = baseline["cases"].get(case, {})
+        for metric, value in metrics.items():
+            old = old_metrics.get(metric)
+            if lower_is_better(metric) is None or not old:
+                continue
+            ratios[f"{case}.{metric}"] = value / old
+    return ratios
+
+
+def print_comparison(baseline: Dict[str, Any], new: Dict[str, Any]):
+    print(f'Baseline: {baseline["commit"]}, {baseline["num_rows"]} rows')
+    print(f'New:      {new["commit"]}, {new["num_rows"]} rows')
+    for metric, ratio in compare(baseline, new).items():
+        worse = ratio > 1 if lower_is_better(metric.split(".")[-1]) else ratio < 1
+        flag = "REGRESSION" if worse and abs(ratio - 1) > TOLERANCE else ""
+        print(f"\t{metric}: {ratio:.3f} {flag}")
+
+
+if __name__ == "__main__":
+    argv = sys.argv
+    if len(argv) > 1 and argv[1] == "compare":
+        print_comparison(
+            json.loads(Path(argv[2]).read_text()),
+            json.loads(Path(argv[3]).read_text()),
+        )
+    else:
+        num_rows = int(argv[2]) if len(argv) > 2 else 100000
+        report = run_all(num_rows)
+        text = json.dumps(report, indent=2)
+        if len(argv) > 3:
+            Path(argv[3]).write_text(text)
+        else:
+            print(text)
@@ -50,23 +50,53 @@ def print_stats(stats: dict):
         print(f'\tAverage row size: {table_stats["row_size"]}')
 
 
-def stats(csv_file: Path, incremental: bool = False):
+def stats(csv_file: Path, incremental: bool = False, fast: bool = False):
     """Run a build and get basic stats.
     No detailed profiling is performed.
     """
     db_file = csv_file.with_suffix(".sqlite")
-    if db_file.is_file():
-        db_file.unlink()
+    for f in (db_file, Path(f"{db_file}-wal"), Path(f"{db_file}-shm")):
+        if f.is_file():
+            f.unlink()
     start = time()
     if incremental:
-        conn = db.build_db_incremental(csv_file, db_file)
+        conn = db.build_db_incremental(csv_file, db_file, fast=fast)
     else:
-        conn = db.build_db_pandas(csv_file, db_file)
+        conn = db.build_db_pandas(csv_file, db_file, fast=fast)
     end = time()
     disk = disk_stats(csv_file, db_file, conn)
     return {"build_time": end - start, "data_stats": disk}
 
 
+def insert_times(csv_file: Path) -> Dict[str, float]:
+    """Time the insertion of a whole file into each table, excluding parsing."""
+    df = db.normalize(db.read_clean(csv_file))
+    conn = sqlite3.connect(":memory:")
+    db.create_tables(conn)
+    times = {}
+    for wrapper in db.WRAPPERS + (db.ObservationWrapper,):
+        start = time()
+        df, _ = wrapper.insert(df, conn, processed=True)
+        times[wrapper.__name__] = time() - start
+    return times
+
+
+def fast_speedup(csv_file: Path):
+    """Compare build times with and without the bulk loading settings."""
+    for incremental in (False, True):
+        normal = stats(csv_file, incremental=incremental)["build_time"]
+        fast = stats(csv_file, incremental=incremental, fast=True)["build_time"]
+        name = "incremental" if incremental else "pandas"
+        print(f"{name} build time: {normal}")
+        print(f"\tFast build time: {fast}")
+        print(f"\tSpeedup: {normal / fast}")
+
+
+def print_insert_times(times: Dict[str, float]):
+    for name, t in times.items():
+        print(f"{name} insert time: {t}")
+
+
 def plot_stats():
     table_stats = [stats(x) for x in SUBSAMPLED_DIR.glob("*.tsv")]
     num_rows = [
@@ -93,5 +123,9 @@ if __name__ == "__main__":
         print_stats(stats(LARGE))
     elif argv[1] == "plot":
         plot_stats()
+    elif argv[1] == "fast":
+        fast_speedup(Path(argv[2]))
+    elif argv[1] == "inserts":
+        print_insert_times(insert_times(Path(argv[2])))
     else:
         print_stats(stats(Path(argv[1])))
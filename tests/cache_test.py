@@ -0,0 +1,91 @@
+import os
+import pytest
+import sqlite3
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from types import SimpleNamespace
+from aukpy import cache as cache_module, db as auk_db, queries
+from aukpy.cache import ResultCache
+
+from tests import M_SMALL
+
+
+@pytest.fixture()
+def mocked_db():
+    with TemporaryDirectory() as tmp:
+        conn = auk_db.build_db_pandas(M_SMALL, Path(tmp) / "small.sqlite")
+        yield conn
+        conn.close()
+
+
+def test_cache_hit(mocked_db):
+    cache = ResultCache()
+    q = queries.species("Bald Eagle")
+    first = q.run_pandas(mocked_db, cache=cache)
+    assert (cache.hits, cache.misses, len(cache)) == (0, 1, 1)
+
+    # Modifying a result doesn't modify the cached value
+    first["latitude"] = 0
+    second = q.run_pandas(mocked_db, cache=cache)
+    assert cache.hits == 1
+    assert (second["latitude"] != 0).all()
+    assert second.equals(q.run_pandas(mocked_db))
+
+    rows = q.run(mocked_db, cache=cache)
+    assert rows == q.run(mocked_db, cache=cache) == q.run(mocked_db)
+    assert (cache.hits, len(cache), cache.rows) == (2, 2, 2 * len(second))
+
+
+def test_cache_invalidation(mocked_db):
+    cache = ResultCache()
+    q = queries.no_filter().count()
+    (before,) = q.run(mocked_db, cache=cache)
+    mocked_db.execute(
+        "DELETE FROM observation WHERE id IN (SELECT id FROM observation LIMIT 10)"
+    )
+    mocked_db.commit()
+    (after,) = q.run(mocked_db, cache=cache)
+    assert after[0] == before[0] - 10
+    # The stale entry was dropped
+    assert (cache.hits, len(cache)) == (0, 1)
+
+
+def test_cache_invalidation_same_stats(mocked_db, monkeypatch):
+    path = mocked_db.execute("PRAGMA database_list").fetchone()[2]
+    # A change the file's size and timestamp don't show
+    stat = os.stat(path)
+    monkeypatch.setattr(cache_module, "os", SimpleNamespace(stat=lambda p: stat))
+    cache = ResultCache()
+    q = queries.no_filter().count()
+    (before,) = q.run(mocked_db, cache=cache)
+    other = sqlite3.connect(path)
+    other.execute("UPDATE observation SET observation_count = '1' WHERE id = 1")
+    other.commit()
+    other.close()
+    q.run(mocked_db, cache=cache)
+    assert cache.hits == 0
+    (again,) = q.run(mocked_db, cache=cache)
+    assert cache.hits == 1 and again == before
+
+
+def test_cache_eviction(mocked_db):
+    cache = ResultCache(max_rows=400)
+    eagles = queries.species("Bald Eagle")
+    eagles.run(mocked_db, cache=cache)
+    assert cache.rows == 175
+    # Too big to cache at all
+    queries.no_filter().run(mocked_db, cache=cache)
+    assert cache.rows == 175
+    # Evicts the eagles
+    queries.species("Canada Goose").run(mocked_db, cache=cache)
+    assert cache.rows == 310
+    eagles.run(mocked_db, cache=cache)
+    assert cache.hits == 0
+
+
+def test_cache_in_memory():
+    conn = sqlite3.connect(":memory:")
+    auk_db.create_tables(conn)
+    cache = ResultCache()
+    assert queries.no_filter().run(conn, cache=cache) == []
+    assert len(cache) == 0
@@ -1,8 +1,33 @@
 from pathlib import Path
-from typing import List
+from typing import List, Optional
 import numpy as np
 import pandas as pd
-from aukpy import db
+from aukpy import db, utils
+
+
+GUID_PREFIX = "URN:CornellLabOfOrnithology:EBIRD:OBS"
+
+# Regions that generated locations are placed in.
+# (country, country code, state, state code, min latitude, max latitude, min longitude, max longitude, weight)
+REGIONS = (
+    ("United States", "US", "New York", "US-NY", 40.5, 45.0, -79.8, -71.9, 6),
+    ("United States", "US", "California", "US-CA", 32.5, 42.0, -124.4, -114.1, 8),
+    ("United States", "US", "Texas", "US-TX", 25.8, 36.5, -106.6, -93.5, 6),
+    ("United States", "US", "Florida", "US-FL", 24.5, 31.0, -87.6, -80.0, 5),
+    ("Canada", "CA", "Ontario", "CA-ON", 41.7, 56.9, -95.2, -74.3, 4),
+    ("Mexico", "MX", "Oaxaca", "MX-OAX", 15.6, 18.7, -98.6, -93.8, 1),
+    ("United Kingdom", "GB", "England", "GB-ENG", 49.9, 55.8, -5.7, 1.8, 2),
+    ("India", "IN", "Kerala", "IN-KL", 8.2, 12.8, 74.8, 77.4, 2),
+    ("Australia", "AU", "New South Wales", "AU-NSW", -37.5, -28.2, 141.0, 153.6, 2),
+    ("Colombia", "CO", "Antioquia", "CO-ANT", 5.4, 8.9, -77.1, -73.9, 1),
+)
+# (protocol type, protocol code, weight)
+PROTOCOLS = (
+    ("Traveling", "P22", 0.5),
+    ("Stationary", "P21", 0.3),
+    ("Incidental", "P20", 0.15),
+    ("Historical", "P62", 0.05),
+)
 
 
 def scramble_observations(df: pd.DataFrame) -> pd.DataFrame:
@@ -26,8 +51,8 @@ def scramble_observations(df: pd.DataFrame) -> pd.DataFrame:
     df[list(db.LocationWrapper.columns)] = merged[list(db.LocationWrapper.columns)]
 
     # Shuffle sampling events
-    to_scramble = list(db.SamplingWrapper.columns)
-    del to_scramble[0]
+    # Skip the identifier itself, and the location id (which only exists after insertion)
+    to_scramble = [c for c in db.SamplingWrapper.columns[1:] if c in df.columns]
 
     obs_shuffle = np.random.permutation(just_first.index)
     just_obs = just_first.loc[obs_shuffle, list(to_scramble)]
@@ -71,14 +96,318 @@ def extract_chunks(
 ) -> List[pd.DataFrame]:
     """Extract multiple subframes from one large dataset.
     Used to extract random chunks of data from very large observation files.
+    Chunks are reservoir sampled, so only `num_chunks` chunks are ever in memory.
     """
-
     reader = pd.read_csv(path, sep="\t", chunksize=num_rows)
-    raise NotImplementedError
+    chunks: List[pd.DataFrame] = []
+    for i, chunk in enumerate(reader):
+        if i < num_chunks:
+            chunks.append(chunk)
+        else:
+            j = np.random.randint(0, i + 1)
+            if j < num_chunks:
+                chunks[j] = chunk
+    return [db.clean_raw_obs(chunk) for chunk in chunks]
+
+
+def splitmix64(x: np.ndarray) -> np.ndarray:
+    """Hash an array of integers to uniformly distributed 64 bit integers."""
+    with np.errstate(over="ignore"):
+        z = x.astype(np.uint64) + np.uint64(0x9E3779B97F4A7C15)
+        z = (z ^ (z >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+        z = (z ^ (z >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+        return z ^ (z >> np.uint64(31))
+
+
+def hashed_uniform(ids: np.ndarray, field: int, seed: int = 0) -> np.ndarray:
+    """A float in [0, 1) for each id, which is always the same for the same id, field and seed."""
+    with np.errstate(over="ignore"):
+        key = ids.astype(np.uint64) * np.uint64(64) + np.uint64(field)
+        h = splitmix64(key ^ splitmix64(np.array([seed], dtype=np.uint64)))
+    return (h >> np.uint64(11)).astype(np.float64) * 2.0**-53
+
+
+def mocked_locations(location_ids: np.ndarray, seed: int = 0) -> pd.DataFrame:
+    """Generate the location columns for a set of location ids.
+    Every attribute is derived from a hash of the id, so a location is consistent across the whole file without being stored.
+    """
+    regions = pd.DataFrame(
+        REGIONS,
+        columns=[
+            "country",
+            "country_code",
+            "state",
+            "state_code",
+            "min_lat",
+            "max_lat",
+            "min_lon",
+            "max_lon",
+            "weight",
+        ],
+    )
+    cumulative = (regions["weight"].cumsum() / regions["weight"].sum()).values
+    region = np.searchsorted(cumulative, hashed_uniform(location_ids, 0, seed))
+    df = regions.iloc[region].reset_index(drop=True)
+
+    lat = df["min_lat"] + (df["max_lat"] - df["min_lat"]) * hashed_uniform(
+        location_ids, 1, seed
+    )
+    lon = df["min_lon"] + (df["max_lon"] - df["min_lon"]) * hashed_uniform(
+        location_ids, 2, seed
+    )
+    county = pd.Series(
+        (hashed_uniform(location_ids, 3, seed) * 60).astype(int) + 1
+    ).astype(str)
+    ids = pd.Series(location_ids).astype(str)
+    locality_type = np.array(["H", "P", "T"])[
+        np.searchsorted([0.5, 0.95], hashed_uniform(location_ids, 4, seed))
+    ]
+    bcr = (hashed_uniform(location_ids, 5, seed) * 66).astype(int) + 1
+
+    return pd.DataFrame(
+        {
+            "country": df["country"],
+            "country_code": df["country_code"],
+            "state": df["state"],
+            "state_code": df["state_code"],
+            "county": "County " + county,
+            "county_code": df["state_code"] + "-" + county.str.zfill(3),
+            "iba_code": np.nan,
+            "bcr_code": bcr.astype(float),
+            "usfws_code": np.nan,
+            "atlas_block": np.nan,
+            "locality": "Locality " + ids,
+            "locality_id": "L" + ids,
+            "locality_type": locality_type,
+            "latitude": lat.round(6),
+            "longitude": lon.round(6),
+        }
+    )
+
+
+def mocked_checklists(
+    first_id: int,
+    num_checklists: int,
+    num_locations: int,
+    num_observers: int,
+    start_year: int,
+    end_year: int,
+    rng: np.random.Generator,
+    seed: int = 0,
+) -> pd.DataFrame:
+    """Generate the location and sampling event columns for a batch of checklists, in the order they appear in a file."""
+    n = num_checklists
+    # A few hotspots and a few very active observers account for most checklists
+    location_ids = (num_locations * rng.random(n) ** 2).astype(np.int64)
+    observers = (num_observers * rng.random(n) ** 3).astype(np.int64) + 1
+
+    start = np.datetime64(f"{start_year}-01-01")
+    num_days = (np.datetime64(f"{end_year + 1}-01-01") - start).astype(int)
+    dates = start + rng.integers(0, num_days, n)
+
+    protocol = rng.choice(len(PROTOCOLS), n, p=[p[2] for p in PROTOCOLS])
+    protocol_type = np.array([p[0] for p in PROTOCOLS])[protocol]
+    protocol_code = np.array([p[1] for p in PROTOCOLS])[protocol]
+    incidental = protocol_type == "Incidental"
+    historical = protocol_type == "Historical"
+
+    hours = pd.Series(rng.integers(5, 20, n)).astype(str).str.zfill(2)
+    minutes = pd.Series(rng.integers(0, 60, n)).astype(str).str.zfill(2)
+    times = (hours + ":" + minutes + ":00").where(~(historical & (rng.random(n) < 0.5)))
+    duration = np.where(incidental, np.nan, np.round(rng.exponential(60, n)) + 1)
+    distance = np.where(
+        protocol_type == "Traveling", np.round(rng.exponential(2, n), 3), np.nan
+    )
+    number_observers = np.where(
+        rng.random(n) < 0.02, np.nan, rng.geometric(0.6, n).astype(float)
+    )
+    complete = ((~incidental) & (rng.random(n) < 0.9)).astype(int)
+    identifiers = np.arange(first_id, first_id + n)
+    # Group checklists are shared between a few observers
+    groups = ("G" + pd.Series(identifiers // 3).astype(str)).where(rng.random(n) < 0.03)
+
+    checklists = pd.DataFrame(
+        {
+            "observation_date": np.datetime_as_string(dates, unit="D"),
+            "time_observations_started": times,
+            "observer_id": "obsr" + pd.Series(observers).astype(str),
+            "sampling_event_identifier": "S" + pd.Series(identifiers).astype(str),
+            "protocol_type": protocol_type,
+            "protocol_code": protocol_code,
+            "project_code": "EBIRD",
+            "duration_minutes": duration,
+            "effort_distance_km": distance,
+            "effort_area_ha": np.nan,
+            "number_observers": number_observers,
+            "all_species_reported": complete,
+            "group_identifier": groups,
+        }
+    )
+    return pd.concat((mocked_locations(location_ids, seed), checklists), axis=1)
+
+
+def mocked_species() -> pd.DataFrame:
+    """The species columns for every taxon in the taxonomy (in file order), and how likely each is to be observed."""
+    taxonomy = utils.load_taxonomy()
+    common_names = (
+        taxonomy["primary_com_name"]
+        .str.split(" ")
+        .apply(lambda words: " ".join(w[:1].upper() + w[1:] for w in words))
+    )
+    concept = splitmix64(taxonomy["taxon_order"].to_numpy()) >> np.uint64(32)
+    weights = np.where(taxonomy["category"] == "species", 1.0, 0.02)
+    # A few species are very common, most are rare
+    rank = np.random.default_rng(0).permutation(len(taxonomy))
+    weights = weights / (rank + 10)
+
+    return pd.DataFrame(
+        {
+            "taxonomic_order": taxonomy["taxon_order"],
+            "category": taxonomy["category"],
+            "taxon_concept_id": [f"avibase-{c:08X}" for c in concept],
+            "common_name": common_names,
+            "scientific_name": taxonomy["sci_name"].str.capitalize(),
+            "subspecies_common_name": np.nan,
+            "subspecies_scientific_name": np.nan,
+            "exotic_code": np.nan,
+            "weight": weights / weights.sum(),
+        }
+    )
+
+
+def tsv_fields(df: pd.DataFrame) -> np.ndarray:
+    """Render each row of a dataframe as tab separated fields, without a trailing newline."""
+    return np.array(
+        df.to_csv(sep="\t", index=False, header=False).splitlines(), dtype=object
+    )
+
+
+# Every time of day, as it appears in the last edited date
+TIMES_OF_DAY = np.array(
+    [f"{h:02}:{m:02}:{s:02}" for h in range(24) for m in range(60) for s in range(60)],
+    dtype=object,
+)
+
+
+def generate_mocked(
+    out_path: Path,
+    num_rows: int,
+    seed: int = 0,
+    num_locations: Optional[int] = None,
+    num_observers: Optional[int] = None,
+    mean_species: int = 15,
+    start_year: int = 2000,
+    end_year: int = 2022,
+    batch_size: int = 20000,
+) -> Path:
+    """Write a synthetic eBird observations file with exactly `num_rows` rows.
+    Rows are grouped into checklists, and checklists are generated and written `batch_size` at a time,
+    so memory use doesn't depend on the size of the file.
+
+    Args:
+        out_path:       Where to write the file.
+        num_rows:       The number of observations to generate.
+        seed:           The random seed.
+        num_locations:  The number of distinct locations. Defaults to one per ten checklists.
+        num_observers:  The number of distinct observers. Defaults to one per hundred checklists.
+        mean_species:   The average number of species reported on a checklist.
+        start_year:     The first year with observations.
+        end_year:       The last year with observations.
+        batch_size:     The number of checklists generated at once.
+    """
+    rng = np.random.default_rng(seed)
+    num_checklists = max(1, num_rows // mean_species)
+    if num_locations is None:
+        num_locations = max(1, num_checklists // 10)
+    if num_observers is None:
+        num_observers = max(1, num_checklists // 100)
+    species = mocked_species()
+    weights = species.pop("weight").to_numpy()
+    # Rendering the shared columns once per taxon and once per checklist is much faster than writing every row with pandas
+    species_fields = tsv_fields(species)
+
+    written = 0
+    next_checklist = 20000000
+    with open(out_path, "w") as f:
+        f.write("\t".join(db.HEADINGS) + "\n")
+        while written < num_rows:
+            # Don't generate many more checklists than are needed for the remaining rows
+            batch = min(batch_size, (num_rows - written) // mean_species + 1)
+            checklists = mocked_checklists(
+                next_checklist,
+                batch,
+                num_locations,
+                num_observers,
+                start_year,
+                end_year,
+                rng,
+                seed,
+            )
+            next_checklist += batch
+
+            # Each checklist reports a different set of species
+            sizes = rng.poisson(mean_species - 1, batch) + 1
+            checklist = np.repeat(np.arange(batch), sizes)
+            taxon = rng.choice(len(species), size=len(checklist), p=weights)
+            _, unique = np.unique(checklist * len(species) + taxon, return_index=True)
+            unique = np.sort(unique)[: num_rows - written]
+            checklist, taxon = checklist[unique], taxon[unique]
+            n = len(unique)
+
+            guids = (
+                (np.arange(written, written + n) + 300000000).astype(str).astype(object)
+            )
+            edited = checklists["observation_date"].values[checklist].astype(
+                "datetime64[D]"
+            ) + rng.integers(0, 400, n)
+            edited_dates = np.datetime_as_string(edited, unit="D").astype(object)
+            edited_times = TIMES_OF_DAY[rng.integers(0, len(TIMES_OF_DAY), n)]
+            counts = rng.geometric(0.4, n).astype(str).astype(object)
+            counts[rng.random(n) < 0.1] = "X"
+            has_media = np.where(rng.random(n) < 0.01, "1", "0").astype(object)
+            reviewed = np.where(rng.random(n) < 0.02, "1", "0").astype(object)
+
+            # Breeding codes, behavior, age/sex, reason and comments are all left empty
+            lines = (
+                GUID_PREFIX
+                + guids
+                + "\t"
+                + edited_dates
+                + " "
+                + edited_times
+                + "\t"
+                + species_fields[taxon]
+                + "\t"
+                + counts
+                + "\t\t\t\t\t"
+                + tsv_fields(checklists)[checklist]
+                + "\t"
+                + has_media
+                + "\t1\t"
+                + reviewed
+                + "\t\t\t\n"
+            )
+            f.writelines(lines)
+            written += n
+    return out_path
+
+
+# The columns of an eBird sampling event file
+SAMPLING_COLUMNS = tuple(
+    c
+    for c in db.HEADINGS
+    if c in db.LocationWrapper.columns
+    or c in db.SamplingWrapper.columns
+    or c in db.ProtocolWrapper.columns
+    or c in ("last_edited_date", "group_identifier")
+)
 
 
-def generate_mocked():
-    raise NotImplementedError
+def sampling_events(df: pd.DataFrame) -> pd.DataFrame:
+    """The sampling event file matching a raw observations dataframe, i.e. one row per checklist with only the checklist columns."""
+    return df.drop_duplicates("sampling_event_identifier").loc[
+        :, list(SAMPLING_COLUMNS)
+    ]
 
 
 def generate_subsamples(in_path: Path, out_folder: Path):
@@ -97,3 +426,5 @@ if __name__ == "__main__":
 
     if argv[1] == "subsample":
         generate_subsamples(Path(argv[2]), Path(argv[3]))
+    elif argv[1] == "generate":
+        generate_mocked(Path(argv[2]), int(argv[3]))
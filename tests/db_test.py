@@ -1,9 +1,14 @@
+import csv
+import pandas as pd
 import pytest
-from tempfile import NamedTemporaryFile
+import shutil
+import sqlite3
+from tempfile import NamedTemporaryFile, TemporaryDirectory
 from pathlib import Path
-from aukpy import db as auk_db
+from aukpy import db as auk_db, queries
 
-from tests import SMALL, MEDIUM, LARGE, SMALL_MOCKED, SKIP_NON_MOCKED
+from tests import SMALL, MEDIUM, LARGE, M_SMALL, SMALL_MOCKED, SKIP_NON_MOCKED
+from tests import data_utils
 
 
 @pytest.mark.skipif(**SKIP_NON_MOCKED)  # type: ignore
@@ -49,3 +54,439 @@ def test_build_small_mocked():
     for p in SMALL_MOCKED:
         with NamedTemporaryFile() as output:
             auk_db.build_db_pandas(p, Path(output.name))
+
+
+def test_build_parallel_mocked():
+    with NamedTemporaryFile() as serial, NamedTemporaryFile() as parallel:
+        s_db = auk_db.build_db_incremental(M_SMALL, Path(serial.name), max_size=1000)
+        p_db = auk_db.build_db_incremental(
+            M_SMALL, Path(parallel.name), max_size=1000, workers=3
+        )
+        for table in ("observation", "sampling_event", "location_data", "species"):
+            q = f"select * from {table} order by id"
+            assert s_db.execute(q).fetchall() == p_db.execute(q).fetchall()
+
+
+def test_build_resume_mocked():
+    lines = M_SMALL.read_bytes().splitlines(keepends=True)
+    with TemporaryDirectory() as tmp, NamedTemporaryFile() as full, NamedTemporaryFile() as resumed:
+        full_db = auk_db.build_db_incremental(M_SMALL, Path(full.name), max_size=1000)
+
+        # Simulate a build that was interrupted after 4000 observations
+        partial = Path(tmp) / M_SMALL.name
+        partial.write_bytes(b"".join(lines[:4001]))
+        auk_db.build_db_incremental(partial, Path(resumed.name), max_size=1000)
+        partial.write_bytes(b"".join(lines))
+        resumed_db = auk_db.build_db_incremental(
+            partial, Path(resumed.name), max_size=1000
+        )
+
+        for table in ("observation", "sampling_event", "location_data", "species"):
+            q = f"select * from {table} order by id"
+            assert full_db.execute(q).fetchall() == resumed_db.execute(q).fetchall()
+
+        # Nothing left to do
+        auk_db.build_db_incremental(partial, Path(resumed.name), max_size=1000)
+        count = resumed_db.execute("select count(*) from observation").fetchone()[0]
+        assert count == len(lines) - 1
+
+
+def test_build_indexes_mocked():
+    index_q = "select name from sqlite_master where type = 'index' and sql not like 'CREATE UNIQUE%'"
+    with NamedTemporaryFile() as output:
+        db = auk_db.build_db_pandas(M_SMALL, Path(output.name), index=False)
+        assert db.execute(index_q).fetchall() == []
+
+        auk_db.create_indexes(db)
+        names = {x[0] for x in db.execute(index_q).fetchall()}
+        assert "observation_species_id" in names
+        assert "sampling_event_observation_date" in names
+        assert db.execute("select count(*) from sqlite_stat1").fetchone()[0] > 0
+
+        plan = db.execute(
+            "explain query plan select id from observation where species_id = 1"
+        ).fetchall()
+        assert "observation_species_id" in plan[0][-1]
+
+
+def test_leap_day_of_year():
+    dates = pd.Series(pd.to_datetime(["2015-03-01", "2016-03-01", "2016-02-29"]))
+    assert list(auk_db.leap_day_of_year(dates)) == [61, 61, 60]
+
+
+def test_build_fast_mocked():
+    with NamedTemporaryFile() as normal, NamedTemporaryFile() as fast:
+        n_db = auk_db.build_db_incremental(M_SMALL, Path(normal.name), max_size=3000)
+        f_db = auk_db.build_db_incremental(
+            M_SMALL, Path(fast.name), max_size=3000, fast=True
+        )
+        for table in ("observation", "sampling_event", "location_data", "species"):
+            q = f"select * from {table} order by id"
+            assert n_db.execute(q).fetchall() == f_db.execute(q).fetchall()
+
+        index_q = "select name from sqlite_master where type = 'index' order by name"
+        assert n_db.execute(index_q).fetchall() == f_db.execute(index_q).fetchall()
+        assert f_db.execute("pragma journal_mode").fetchone()[0] == "wal"
+        assert f_db.execute("pragma page_size").fetchone()[0] == 65536
+        f_db.close()
+        # Can't be resumed, or run on an existing database
+        with pytest.raises(FileExistsError):
+            auk_db.build_db_incremental(M_SMALL, Path(fast.name), fast=True)
+        with pytest.raises(FileExistsError):
+            auk_db.build_db_pandas(M_SMALL, Path(normal.name), fast=True)
+        n_db.close()
+
+
+def test_build_generated():
+    with TemporaryDirectory() as tmp:
+        input_path = data_utils.generate_mocked(Path(tmp) / "generated.txt", 5000)
+        raw = pd.read_csv(input_path, sep="\t")
+        assert tuple(raw.columns) == auk_db.HEADINGS
+        assert len(raw) == 5000
+        # Rows are grouped by checklist, and every location is consistent
+        events = raw["sampling_event_identifier"]
+        assert (events != events.shift()).sum() == events.nunique()
+        assert (raw.groupby("locality_id")["latitude"].nunique() == 1).all()
+
+        db = auk_db.build_db_pandas(input_path, Path(tmp) / "generated.sqlite")
+        counts = [
+            db.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+            for table in ("observation", "sampling_event", "location_data")
+        ]
+        assert counts == [
+            5000,
+            raw["sampling_event_identifier"].nunique(),
+            raw["locality_id"].nunique(),
+        ]
+        db.close()
+
+
+def test_backfill_derived_columns():
+    with TemporaryDirectory() as tmp:
+        input_path = data_utils.generate_mocked(Path(tmp) / "generated.txt", 2000)
+        fresh = auk_db.build_db_pandas(input_path, Path(tmp) / "fresh.sqlite")
+        # As built before the derived columns existed
+        old = auk_db.build_db_pandas(input_path, Path(tmp) / "old.sqlite")
+        old.execute("DROP INDEX sampling_event_day_of_year")
+        for column in ("year", "month", "day_of_year"):
+            old.execute(f"ALTER TABLE sampling_event DROP COLUMN {column}")
+        old.commit()
+
+        auk_db.create_indexes(old)
+        q = "SELECT id, year, month, day_of_year FROM sampling_event ORDER BY id"
+        assert old.execute(q).fetchall() == fresh.execute(q).fetchall()
+        seasonal = queries.date("*-02-15", "*-04-30")
+        assert sorted(seasonal.run(old)) == sorted(seasonal.run(fresh))
+        old.close()
+        fresh.close()
+
+
+def test_baseline_schema():
+    with TemporaryDirectory() as tmp:
+        db_path = Path(tmp) / "baseline.sqlite"
+        conn = sqlite3.connect(db_path)
+        conn.executescript((Path(__file__).parent / "baseline_schema.sql").read_text())
+        conn.close()
+
+        db = auk_db.build_db_incremental(M_SMALL, db_path, max_size=3000)
+        assert db.execute("SELECT COUNT(*) FROM observation").fetchone()[0] == len(
+            pd.read_csv(M_SMALL, sep="\t")
+        )
+        for table in ("location_data", "species", "sampling_event", "observation"):
+            unique = [
+                name
+                for _, name, is_unique, *_ in db.execute(f"PRAGMA index_list({table})")
+                if is_unique
+            ]
+            # Only the constraint from the original table definition
+            assert unique == [f"sqlite_autoindex_{table}_1"], table
+        with pytest.raises(sqlite3.IntegrityError):
+            db.execute(
+                "INSERT INTO observation (species_id, sampling_event_id, global_unique_identifier) "
+                "SELECT species_id, sampling_event_id, global_unique_identifier FROM observation LIMIT 1"
+            )
+        db.close()
+
+
+def test_build_quotes():
+    with TemporaryDirectory() as tmp:
+        input_path = data_utils.generate_mocked(Path(tmp) / "generated.txt", 1000)
+        raw = pd.read_csv(input_path, sep="\t")
+        # Quotes are literal, even unbalanced ones or ones around a whole field
+        comments = ['"unbalanced', 'a "quoted" word', '"whole field"']
+        first = raw.drop_duplicates("sampling_event_identifier").index[: len(comments)]
+        raw["trip_comments"] = raw["trip_comments"].astype(object)
+        for i, comment in zip(first, comments):
+            is_checklist = (
+                raw["sampling_event_identifier"]
+                == raw.loc[i, "sampling_event_identifier"]
+            )
+            raw.loc[is_checklist, "trip_comments"] = comment
+        quoted_path = Path(tmp) / "quoted.txt"
+        raw.to_csv(quoted_path, sep="\t", index=False, quoting=csv.QUOTE_NONE)
+
+        for db in (
+            auk_db.build_db_pandas(quoted_path, Path(tmp) / "pandas.sqlite"),
+            auk_db.build_db_incremental(
+                quoted_path, Path(tmp) / "incremental.sqlite", max_size=100
+            ),
+        ):
+            assert db.execute("SELECT COUNT(*) FROM observation").fetchone()[0] == len(
+                raw
+            )
+            stored = {
+                r[0]
+                for r in db.execute(
+                    "SELECT trip_comments FROM sampling_event WHERE trip_comments LIKE '%\"%'"
+                )
+            }
+            assert stored == set(comments)
+            db.close()
+
+
+def test_extract_chunks():
+    chunks = data_utils.extract_chunks(M_SMALL, 3, num_rows=1000)
+    assert len(chunks) == 3
+    assert all(len(c) == 1000 for c in chunks)
+    combined = pd.concat(chunks)
+    assert combined["global_unique_identifier"].is_unique
+
+
+def test_undo_compression_options():
+    with TemporaryDirectory() as tmp:
+        db = auk_db.build_db_pandas(M_SMALL, Path(tmp) / "small.sqlite")
+        raw = queries.no_filter().run_pandas(db)
+        db.close()
+    strings = auk_db.undo_compression(raw.copy())
+
+    categorical = auk_db.undo_compression(raw.copy(), categorical=True)
+    for column in ("observer_id", "observation_date", "group_identifier"):
+        assert categorical[column].dtype == "category"
+        assert categorical[column].astype(object).equals(strings[column])
+
+    typed = auk_db.undo_compression(raw.copy(), typed=True)
+    assert (
+        typed["observation_date"].dt.strftime("%Y-%m-%d") == strings["observation_date"]
+    ).all()
+    has_time = strings["time_observations_started"].notna()
+    started = typed.loc[has_time, "time_observations_started"]
+    assert (
+        (pd.Timestamp(0) + started).dt.strftime("%H:%M:%S")
+        == strings.loc[has_time, "time_observations_started"]
+    ).all()
+
+    # Only the requested columns are decompressed, and missing columns are skipped
+    subset = auk_db.undo_compression(
+        raw[["locality_id", "observer_id"]].copy(), columns=["locality_id", "year"]
+    )
+    assert subset["locality_id"].equals(strings["locality_id"])
+    assert subset["observer_id"].equals(raw["observer_id"])
+
+
+def test_update_generated():
+    with TemporaryDirectory() as tmp:
+        input_path = data_utils.generate_mocked(Path(tmp) / "generated.txt", 4000)
+        raw = pd.read_csv(input_path, sep="\t")
+        checklists = raw["sampling_event_identifier"].unique()
+        added, deleted, edited = checklists[:20], checklists[20:40], checklists[40:60]
+
+        old = raw[~raw["sampling_event_identifier"].isin(added)]
+        old_path = Path(tmp) / "old.txt"
+        old.to_csv(old_path, sep="\t", index=False)
+
+        new = raw[~raw["sampling_event_identifier"].isin(deleted)].copy()
+        is_edited = new["sampling_event_identifier"].isin(edited)
+        new.loc[is_edited, "last_edited_date"] = "2030-01-01 12:00:00"
+        new.loc[is_edited, "duration_minutes"] = 999
+        new.loc[is_edited, "observation_count"] = "42"
+        new_path = Path(tmp) / "new.txt"
+        new.to_csv(new_path, sep="\t", index=False)
+
+        db_path = Path(tmp) / "updated.sqlite"
+        auk_db.build_db_pandas(old_path, db_path).close()
+        updated = auk_db.update_db(new_path, db_path, max_size=1000)
+        rebuilt = auk_db.build_db_pandas(new_path, Path(tmp) / "rebuilt.sqlite")
+
+        def contents(conn):
+            df = auk_db.undo_compression(queries.no_filter().run_pandas(conn))
+            df = df.drop(columns=[c for c in df.columns if c.endswith("id")])
+            return df.sort_values("global_unique_identifier", ignore_index=True)
+
+        pd.testing.assert_frame_equal(contents(updated), contents(rebuilt))
+        assert (
+            updated.execute("SELECT COUNT(*) FROM sampling_event").fetchone()[0]
+            == new["sampling_event_identifier"].nunique()
+        )
+        # Applying the same release again changes nothing
+        updated.close()
+        updated = auk_db.update_db(new_path, db_path)
+        assert (
+            updated.execute(
+                "SELECT COUNT(*) FROM observation WHERE observation_count = '42'"
+            ).fetchone()[0]
+            == is_edited.sum()
+        )
+        updated.close()
+        rebuilt.close()
+
+
+def test_ingest_sampling():
+    with TemporaryDirectory() as tmp:
+        input_path = data_utils.generate_mocked(Path(tmp) / "generated.txt", 3000)
+        raw = pd.read_csv(input_path, sep="\t")
+        sampling_path = Path(tmp) / "sampling.txt"
+        data_utils.sampling_events(raw).to_csv(sampling_path, sep="\t", index=False)
+        species = raw["scientific_name"].value_counts().index[0]
+        # An observations file filtered to one species, as eBird provides them
+        obs_path = Path(tmp) / "observations.txt"
+        raw[raw["scientific_name"] == species].to_csv(obs_path, sep="\t", index=False)
+
+        db_path = Path(tmp) / "zero_fill.sqlite"
+        auk_db.ingest_sampling(sampling_path, db_path, max_size=200).close()
+        db = auk_db.build_db_incremental(obs_path, db_path)
+        assert (
+            db.execute("SELECT COUNT(*) FROM sampling_event").fetchone()[0]
+            == raw["sampling_event_identifier"].nunique()
+        )
+        assert db.execute("SELECT COUNT(*) FROM location_data").fetchone()[0] == len(
+            raw.drop_duplicates(["locality_id", "latitude", "longitude"])
+        )
+
+        df = queries.zero_fill(species).run_pandas(db)
+        complete = raw[raw["all_species_reported"] == 1]
+        assert len(df) == complete["sampling_event_identifier"].nunique()
+        detected = set(
+            complete.loc[
+                complete["scientific_name"] == species, "sampling_event_identifier"
+            ]
+            .str[1:]
+            .astype(int)
+        )
+        observed = df["sampling_event_identifier"].isin(detected)
+        assert (df["species_observed"] == observed).all()
+        assert (df.loc[~observed, "observation_count"] == 0).all()
+        assert (df["scientific_name"] == species).all()
+        db.close()
+
+        # Updating from the same release keeps the checklists without detections
+        db = auk_db.update_db(obs_path, db_path, max_size=200)
+        assert (
+            db.execute("SELECT COUNT(*) FROM sampling_event").fetchone()[0]
+            == raw["sampling_event_identifier"].nunique()
+        )
+        pd.testing.assert_frame_equal(queries.zero_fill(species).run_pandas(db), df)
+        db.close()
+
+        # A detection withdrawn in a new release becomes a zero once the new sampling events are ingested
+        withdrawn = min(detected)
+        raw[
+            (raw["scientific_name"] == species)
+            & (raw["sampling_event_identifier"] != f"S{withdrawn}")
+        ].to_csv(obs_path, sep="\t", index=False)
+        auk_db.update_db(obs_path, db_path, max_size=200).close()
+        new_sampling_path = Path(tmp) / "sampling_new.txt"
+        shutil.copy(sampling_path, new_sampling_path)
+        db = auk_db.ingest_sampling(new_sampling_path, db_path, max_size=200)
+        updated = queries.zero_fill(species).run_pandas(db)
+        assert len(updated) == len(df)
+        row = updated[updated["sampling_event_identifier"] == withdrawn].iloc[0]
+        assert not row["species_observed"] and row["observation_count"] == 0
+        assert updated["species_observed"].sum() == df["species_observed"].sum() - 1
+        db.close()
+
+
+def compressed_inputs(input_path: Path, out_dir: Path, sampling_path: Path):
+    """Write `input_path` in every supported compressed and archive format."""
+    import bz2
+    import gzip
+    import tarfile
+    import zipfile
+
+    data = input_path.read_bytes()
+    paths = [out_dir / "obs.txt.gz", out_dir / "obs.txt.bz2"]
+    paths[0].write_bytes(gzip.compress(data))
+    paths[1].write_bytes(bz2.compress(data))
+
+    readme = out_dir / "README.md"
+    readme.write_text("Not the data")
+    nested = out_dir / "ebd_relMay-2023.txt.gz"
+    nested.write_bytes(gzip.compress(data))
+
+    zip_path = out_dir / "obs.zip"
+    with zipfile.ZipFile(zip_path, "w", compression=zipfile.ZIP_DEFLATED) as z:
+        z.write(readme, "README.md")
+        z.write(sampling_path, "ebd_sampling_relMay-2023.txt")
+        z.writestr("ebd_relMay-2023.txt", data)
+    paths.append(zip_path)
+
+    # As eBird ships them: a tar of compressed data files and documentation
+    tar_path = out_dir / "obs.tar"
+    with tarfile.open(tar_path, "w") as t:
+        t.add(readme, "ebd_relMay-2023/README.md")
+        t.add(sampling_path, "ebd_relMay-2023/ebd_sampling_relMay-2023.txt")
+        t.add(nested, "ebd_relMay-2023/ebd_relMay-2023.txt.gz")
+    tar_gz_path = out_dir / "obs.tar.gz"
+    tar_gz_path.write_bytes(gzip.compress(tar_path.read_bytes()))
+    plain_tar_path = out_dir / "obs_plain.tar"
+    with tarfile.open(plain_tar_path, "w") as t:
+        t.add(readme, "ebd/README.md")
+        t.add(input_path, "ebd/ebd_rel.txt")
+    paths.extend((tar_path, tar_gz_path, plain_tar_path))
+    return paths
+
+
+def test_build_compressed_mocked():
+    with TemporaryDirectory() as tmp:
+        raw = pd.read_csv(M_SMALL, sep="\t")
+        sampling_path = Path(tmp) / "sampling.txt"
+        data_utils.sampling_events(raw).to_csv(sampling_path, sep="\t", index=False)
+        plain = list(auk_db.raw_chunks(M_SMALL, 3000))
+
+        for path in compressed_inputs(M_SMALL, Path(tmp), sampling_path):
+            assert list(auk_db.raw_chunks(path, 3000)) == plain, path.name
+            # Resuming part way through
+            assert list(auk_db.raw_chunks(path, 3000, seek_to=plain[1][0])) == plain[2:]
+
+            reported = []
+            db = auk_db.build_db_incremental(
+                path,
+                Path(tmp) / f"{path.name}.sqlite",
+                max_size=3000,
+                progress=lambda read, total: reported.append((read, total)),
+            )
+            assert db.execute("SELECT COUNT(*) FROM observation").fetchone()[0] == len(
+                raw
+            )
+            db.close()
+            assert len(reported) == len(plain)
+            assert all(total == path.stat().st_size for _, total in reported)
+            assert [r for r, _ in reported] == sorted(r for r, _ in reported)
+            assert 0 < reported[-1][0] <= path.stat().st_size
+
+        df = auk_db.read_clean(Path(tmp) / "obs.tar.gz")
+        assert len(df) == len(raw)
+        sampling = auk_db.read_clean(Path(tmp) / "obs.zip", member="*sampling*")
+        assert len(sampling) == raw["sampling_event_identifier"].nunique()
+        with pytest.raises(FileNotFoundError):
+            auk_db.read_clean(Path(tmp) / "obs.zip", member="*.csv")
+        # The sampling event file is picked out of the archive by default
+        db = auk_db.ingest_sampling(
+            Path(tmp) / "obs.tar", Path(tmp) / "sampling.sqlite"
+        )
+        assert (
+            db.execute("SELECT COUNT(*) FROM sampling_event").fetchone()[0]
+            == raw["sampling_event_identifier"].nunique()
+        )
+        db.close()
+        # Then the observations from the same archive, which is tracked separately
+        db = auk_db.build_db_incremental(
+            Path(tmp) / "obs.tar", Path(tmp) / "sampling.sqlite"
+        )
+        assert db.execute("SELECT COUNT(*) FROM observation").fetchone()[0] == len(raw)
+        assert db.execute(
+            "SELECT input_file FROM build_progress ORDER BY input_file"
+        ).fetchall() == [
+            ("obs.tar:ebd_relMay-2023/ebd_relMay-2023.txt.gz",),
+            ("obs.tar:ebd_relMay-2023/ebd_sampling_relMay-2023.txt",),
+        ]
+        db.close()
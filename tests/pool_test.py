@@ -0,0 +1,102 @@
+import asyncio
+import pytest
+import sqlite3
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from aukpy import db as auk_db, queries
+from aukpy.cache import ResultCache
+from aukpy.pool import ConnectionPool, QueryExecutor
+
+from tests import M_SMALL
+
+
+@pytest.fixture(scope="module")
+def mocked_path():
+    with TemporaryDirectory() as tmp:
+        path = Path(tmp) / "small.sqlite"
+        auk_db.build_db_pandas(M_SMALL, path).close()
+        yield path
+
+
+def test_pool_read_only(mocked_path):
+    contents = mocked_path.read_bytes()
+    with ConnectionPool(mocked_path, size=2) as pool:
+        with pool.connection() as conn:
+            assert conn.execute("PRAGMA journal_mode").fetchone()[0] == "delete"
+            with pytest.raises(sqlite3.OperationalError):
+                conn.execute("DELETE FROM observation")
+            with pool.connection() as other:
+                assert other is not conn
+    # Not even the journal mode is changed
+    assert mocked_path.read_bytes() == contents
+
+
+def test_executor_mocked(mocked_path):
+    batch = [
+        queries.species("Bald Eagle"),
+        queries.country("US").date("2015-01-01", "2015-01-10"),
+        queries.near(42.8, -73.7, 10),
+        queries.group_by("state_code").count(),
+    ] * 5
+    conn = sqlite3.connect(mocked_path)
+    expected = [q.run(conn) for q in batch]
+    conn.close()
+
+    cache = ResultCache()
+    with ConnectionPool(mocked_path, size=3) as pool:
+        with QueryExecutor(pool, cache=cache) as executor:
+            assert executor.run_all(batch) == expected
+            frames = executor.run_all(batch, pandas=True)
+    assert [len(f) for f in frames] == [len(r) for r in expected]
+    assert cache.hits > 0
+
+
+class Forever(queries.Query):
+    """A query that runs until it's interrupted."""
+
+    def get_query(self, db_conn=None):
+        query = """WITH RECURSIVE c(x) AS (SELECT 1 UNION ALL SELECT x + 1 FROM c)
+        SELECT COUNT(*) FROM c"""
+        return query, ()
+
+
+def test_run_async_mocked(mocked_path):
+    batch = [queries.species("Bald Eagle"), queries.group_by("state_code").count()]
+    conn = sqlite3.connect(mocked_path)
+    expected = [q.run(conn) for q in batch]
+    expected_batches = list(batch[0].iter_batches(conn, batch_size=50))
+    conn.close()
+
+    async def run_all(pool):
+        results = await asyncio.gather(*(q.run_async(pool) for q in batch))
+        frame = await batch[0].run_async(pool, pandas=True)
+        batches = [b async for b in batch[0].iter_batches_async(pool, batch_size=50)]
+        return results, frame, batches
+
+    with ConnectionPool(mocked_path, size=2) as pool:
+        results, frame, batches = asyncio.run(run_all(pool))
+    assert results == expected
+    assert len(frame) == len(expected[0])
+    assert batches == expected_batches
+
+
+def test_run_async_cancel(mocked_path):
+    async def cancel(pool, query_async):
+        task = asyncio.ensure_future(query_async)
+        await asyncio.sleep(0.2)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        # The only connection is given back once the query stops, and isn't left interrupted
+        return await asyncio.wait_for(
+            queries.no_filter().count().run_async(pool), timeout=5
+        )
+
+    with ConnectionPool(mocked_path, size=1) as pool:
+        assert asyncio.run(cancel(pool, Forever().run_async(pool))) == [(10000,)]
+
+        async def first_batch():
+            async for rows in Forever().iter_batches_async(pool):
+                return rows
+
+        assert asyncio.run(cancel(pool, first_batch())) == [(10000,)]
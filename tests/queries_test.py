@@ -1,9 +1,25 @@
 import pandas as pd
 import pytest
+from collections import OrderedDict
 import sqlite3
-from aukpy import queries
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from aukpy import db as auk_db, queries, utils
 
-from tests import SMALL_DB, MEDIUM_DB, SKIP_NON_MOCKED
+from tests import SMALL_DB, MEDIUM_DB, M_SMALL, SKIP_NON_MOCKED
+
+
+@pytest.fixture(scope="module")
+def mocked_db():
+    with TemporaryDirectory() as tmp:
+        conn = auk_db.build_db_pandas(M_SMALL, Path(tmp) / "small.sqlite")
+        yield conn
+        conn.close()
+
+
+@pytest.fixture(scope="module")
+def mocked_all(mocked_db):
+    return queries.no_filter().run_pandas(mocked_db)
 
 
 @pytest.mark.skipif(**SKIP_NON_MOCKED)  # type: ignore
@@ -107,3 +123,336 @@ def test_wildcard_filter():
     conn = sqlite3.connect(str(MEDIUM_DB))
     res = queries.date("*-02-05", "*-02-07").run_pandas(conn)
     assert len(res) == 11915
+
+
+def test_bbox_filter_mocked(mocked_db, mocked_all):
+    bounds = (-74.0, 42.6, -73.7, 42.9)
+    res = queries.bbox(*bounds).run_pandas(mocked_db)
+    expected = mocked_all[
+        (mocked_all["longitude"] > bounds[0])
+        & (mocked_all["longitude"] < bounds[2])
+        & (mocked_all["latitude"] > bounds[1])
+        & (mocked_all["latitude"] < bounds[3])
+    ]
+    assert 0 < len(res) < len(mocked_all)
+    assert set(res["global_unique_identifier"]) == set(
+        expected["global_unique_identifier"]
+    )
+
+
+def test_near_filter_mocked(mocked_db, mocked_all):
+    lat, lon = 42.75, -73.8
+    res = queries.near(lat, lon, 10).run_pandas(mocked_db)
+    distances = mocked_all.apply(
+        lambda r: queries.haversine_km(r["latitude"], r["longitude"], lat, lon), axis=1
+    )
+    expected = mocked_all[distances <= 10]
+    assert 0 < len(res) < len(mocked_all)
+    assert set(res["global_unique_identifier"]) == set(
+        expected["global_unique_identifier"]
+    )
+
+    in_miles = queries.near(lat, lon, 10 / queries.MILES_TO_KM, "miles")
+    assert len(in_miles.run_pandas(mocked_db)) == len(res)
+
+
+def test_nearest_mocked(mocked_db):
+    lat, lon = 42.75, -73.8
+    locations = pd.read_sql_query("select * from location_data", mocked_db)
+    locations["distance"] = locations.apply(
+        lambda r: queries.haversine_km(r["latitude"], r["longitude"], lat, lon), axis=1
+    )
+    expected = locations.sort_values("distance").iloc[:5]
+
+    res = queries.nearest(mocked_db, lat, lon, k=5)
+    assert list(res["id"]) == list(expected["id"])
+
+    hotspots = queries.nearest(mocked_db, lat, lon, k=3, locality_type="H")
+    assert (hotspots["locality_type"] == "H").all()
+    assert len(hotspots) == 3
+
+
+def test_radius_boxes():
+    # Crosses the antimeridian
+    boxes = queries.radius_boxes(0.0, 179.9, 50)
+    assert len(boxes) == 2
+    assert boxes[0][2] == 180.0 and boxes[1][0] == -180.0
+
+    # Contains the north pole
+    boxes = queries.radius_boxes(89.9, 0.0, 50)
+    assert boxes == [(-180.0, boxes[0][1], 180.0, 90.0)]
+
+
+@pytest.mark.parametrize(
+    "after,before", [("*-01-10", "*-01-20"), ("*-12-15", "*-01-15"), (None, "*-01-05")]
+)
+def test_wildcard_filter_mocked(mocked_db, mocked_all, after, before):
+    res = queries.date(after, before).run_pandas(mocked_db)
+    dates = pd.to_datetime(mocked_all["observation_date"], unit="s")
+    month_day = dates.dt.strftime("%m-%d")
+    lower = "01-01" if after is None else after[2:]
+    upper = before[2:]
+    if lower <= upper:
+        in_range = (month_day >= lower) & (month_day <= upper)
+    else:
+        in_range = (month_day >= lower) | (month_day <= upper)
+
+    expected = mocked_all[in_range]
+    assert len(res) > 0
+    assert set(res["global_unique_identifier"]) == set(
+        expected["global_unique_identifier"]
+    )
+
+
+def test_leap_day_of_year():
+    assert queries.leap_day_of_year("*-02-29") == 60
+    assert queries.leap_day_of_year("*-03-01") == 61
+    assert queries.leap_day_of_year("2015-12-31") == 366
+
+
+def test_iter_batches_mocked(mocked_db):
+    q = queries.no_filter()
+    full = q.run(mocked_db)
+    batches = list(q.iter_batches(mocked_db, batch_size=3000))
+    assert [len(b) for b in batches] == [3000, 3000, 3000, 1000]
+    assert [row for b in batches for row in b] == full
+
+    frames = list(q.run_pandas(mocked_db, chunksize=3000))
+    assert len(frames) == 4
+    assert sum(len(f) for f in frames) == len(full)
+    assert list(frames[0].columns) == list(q.run_pandas(mocked_db).columns)
+
+
+def test_select_mocked(mocked_db, mocked_all):
+    columns = ("global_unique_identifier", "observation_date", "scientific_name")
+    q = queries.species("Bald Eagle").select(columns)
+    sql, _ = q.get_query()
+    assert "JOIN species" in sql
+    assert "location_data" not in sql and "breeding" not in sql
+
+    res = q.run_pandas(mocked_db)
+    assert tuple(res.columns) == columns
+    expected = mocked_all.loc[
+        mocked_all["common_name"] == "Bald Eagle", list(columns)
+    ].sort_values("global_unique_identifier")
+    assert len(res) > 0
+    assert res.sort_values("global_unique_identifier").values.tolist() == (
+        expected.values.tolist()
+    )
+
+    # Locations are joined through sampling events
+    sql, _ = queries.no_filter().select(["latitude"]).get_query()
+    assert "JOIN sampling_event" in sql and "JOIN location_data" in sql
+    assert "JOIN species" not in sql
+
+    with pytest.raises(ValueError):
+        queries.no_filter().select(["not_a_column"])
+
+
+def test_aggregates_mocked(mocked_db, mocked_all):
+    q = queries.group_by("scientific_name", "county").count()
+    res = q.run_pandas(mocked_db).set_index(["scientific_name", "county"])
+    expected = mocked_all.groupby(["scientific_name", "county"]).size()
+    assert len(res) == len(expected)
+    assert (res["count"] == expected.loc[res.index]).all()
+
+    q = queries.group_by("observer_id").distinct("sampling_event_identifier").count()
+    res = q.run_pandas(mocked_db).set_index("observer_id")
+    expected = mocked_all.groupby("observer_id")["sampling_event_identifier"].nunique()
+    assert (res["distinct_sampling_event_identifier"] == expected.loc[res.index]).all()
+
+    # Filters still apply, and aggregates work without groups
+    q = queries.species("Bald Eagle").sum("duration_minutes").count()
+    total, count = q.run(mocked_db)[0]
+    eagles = mocked_all[mocked_all["common_name"] == "Bald Eagle"]
+    assert count == len(eagles)
+    assert total == pytest.approx(eagles["duration_minutes"].sum())
+
+    with pytest.raises(ValueError):
+        queries.group_by("county").get_query()
+
+
+def test_dimension_filters_mocked(mocked_db, mocked_all, monkeypatch):
+    monkeypatch.setattr(queries, "_RESOLVED_IDS", OrderedDict())
+    q = queries.species("Bald Eagle").select(["global_unique_identifier"])
+    sql, _ = q.get_query()
+    assert "SELECT id FROM species" in sql
+    assert "JOIN" not in sql
+
+    # Resolved to the species' IDs, and cached
+    statements = []
+    mocked_db.set_trace_callback(statements.append)
+    try:
+        sql, vals = q.get_query(mocked_db)
+        q.get_query(mocked_db)
+    finally:
+        mocked_db.set_trace_callback(None)
+    assert "observation.species_id IN (?" in sql
+    assert len([x for x in statements if "FROM species" in x]) == 1
+
+    res = q.run_pandas(mocked_db)
+    expected = mocked_all[mocked_all["common_name"] == "Bald Eagle"]
+    assert set(res["global_unique_identifier"]) == set(
+        expected["global_unique_identifier"]
+    )
+
+    # Location filters go through sampling events, and combine correctly with other filters
+    q = queries.state("US-NY").country("US").protocol("Stationary").duration(0, 30)
+    res = q.run_pandas(mocked_db)
+    expected = mocked_all[
+        (mocked_all["state_code"] == "US-NY")
+        & (mocked_all["protocol_type"] == "Stationary")
+        & (mocked_all["duration_minutes"] > 0)
+        & (mocked_all["duration_minutes"] < 30)
+    ]
+    assert len(res) > 0
+    assert set(res["global_unique_identifier"]) == set(
+        expected["global_unique_identifier"]
+    )
+
+
+def test_dimension_filter_unresolved_mocked(mocked_db, monkeypatch):
+    monkeypatch.setattr(queries, "MAX_RESOLVED_IDS", 0)
+    q = queries.country("US").select(["global_unique_identifier"])
+    sql, _ = q.get_query(mocked_db)
+    assert "SELECT id FROM location_data" in sql
+    assert len(q.run(mocked_db)) == len(queries.no_filter().run(mocked_db))
+
+
+def test_clade_filter_mocked(mocked_db, mocked_all):
+    res = queries.clade("Accipitridae").run_pandas(mocked_db)
+    taxonomy = utils.load_taxonomy()
+    in_family = taxonomy.loc[taxonomy["family"] == "accipitridae", "taxon_order"]
+    expected = mocked_all[mocked_all["taxonomic_order"].isin(in_family)]
+    assert len(res) > 0
+    assert set(res["global_unique_identifier"]) == set(
+        expected["global_unique_identifier"]
+    )
+    # Every species, and the spuhs
+    hawks = {x.capitalize() for x in utils.get_all_species("accipitridae")}
+    assert set(expected["scientific_name"]) > (
+        set(mocked_all["scientific_name"]) & hawks
+    )
+    assert "Buteo sp." in set(res["scientific_name"])
+
+    # A genus split into several ranges
+    sql, vals = queries.clade("Anas").get_query()
+    assert 2 < len(vals) < len(utils.get_all_species("anas"))
+
+    with pytest.raises(ValueError):
+        queries.clade("not a clade")
+
+
+def test_to_arrow_mocked(mocked_db, mocked_all):
+    pa = pytest.importorskip("pyarrow")
+    q = queries.no_filter()
+    table = q.to_arrow(mocked_db, batch_size=3000)
+    assert table.num_rows == len(mocked_all)
+    assert table.column_names == list(mocked_all.columns)
+    assert pa.types.is_dictionary(table.schema.field("scientific_name").type)
+    assert pa.types.is_dictionary(table.schema.field("locality").type)
+    assert table.schema.field("observation_count").type == pa.string()
+
+    df = table.to_pandas()
+    for column in ("global_unique_identifier", "latitude", "scientific_name"):
+        assert (df[column].astype(object) == mocked_all[column]).all()
+    assert (
+        df["observation_count"] == mocked_all["observation_count"].astype(str)
+    ).all()
+
+    counts = queries.group_by("scientific_name").count().to_arrow(mocked_db)
+    assert counts.schema.field("count").type == pa.int64()
+    assert sum(counts.column("count").to_pylist()) == len(mocked_all)
+
+
+def test_to_parquet_mocked(mocked_db, mocked_all):
+    pq = pytest.importorskip("pyarrow.parquet")
+    q = queries.species("Bald Eagle").select(
+        ("global_unique_identifier", "observation_date", "state")
+    )
+    expected = q.run_pandas(mocked_db)
+    with TemporaryDirectory() as tmp:
+        path = Path(tmp) / "eagles.parquet"
+        q.to_parquet(mocked_db, path, batch_size=50)
+        table = pq.read_table(path)
+    assert table.num_rows == len(expected)
+    assert table.column("state").to_pylist() == expected["state"].tolist()
+
+
+def test_zero_fill_mocked(mocked_db, mocked_all):
+    df = queries.zero_fill("Bald Eagle").run_pandas(mocked_db)
+    complete = mocked_all[mocked_all["all_species_reported"] == 1]
+    checklists = complete.groupby("sampling_event_identifier")
+    assert len(df) == checklists.ngroups
+    assert set(df.columns) == {
+        "scientific_name",
+        "species_observed",
+        "observation_count",
+    } | set(queries.CHECKLIST_COLUMNS)
+
+    eagles = complete[complete["scientific_name"] == "Haliaeetus leucocephalus"]
+    detected = set(eagles["sampling_event_identifier"])
+    observed = df["sampling_event_identifier"].isin(detected)
+    assert (df["species_observed"] == observed).all()
+    assert (df.loc[~observed, "observation_count"] == 0).all()
+    # Counts are summed, unless one of them is missing
+    uncounted = eagles.groupby("sampling_event_identifier")["observation_count"].apply(
+        lambda counts: (counts == "X").any()
+    )
+    totals = (
+        eagles[eagles["observation_count"] != "X"]
+        .groupby("sampling_event_identifier")["observation_count"]
+        .apply(lambda counts: counts.astype(int).sum())
+    )
+    filled = df.set_index("sampling_event_identifier")["observation_count"]
+    for checklist, missing in uncounted.items():
+        assert filled[checklist] == ("X" if missing else totals[checklist])
+
+    # Checklist filters
+    filtered = (
+        queries.date("2015-01-01", "2015-01-10")
+        .country("US")
+        .near(42.8, -73.7, 50)
+        .zero_fill(["Bald Eagle", "Mallard"])
+        .select(["sampling_event_identifier", "observation_date"])
+    )
+    rows = filtered.run(mocked_db)
+    assert 0 < len(rows) < 2 * len(df)
+    assert {r[0] for r in rows} == {"Haliaeetus leucocephalus", "Anas platyrhynchos"}
+
+    with pytest.raises(ValueError):
+        queries.species("Mallard").zero_fill("Bald Eagle").run(mocked_db)
+    with pytest.raises(ValueError):
+        queries.zero_fill("Mallard").select(["scientific_name"]).run(mocked_db)
+    with pytest.raises(ValueError):
+        queries.zero_fill("Mallard").unique_checklists().run(mocked_db)
+
+
+def test_unique_checklists_mocked(mocked_db, mocked_all):
+    taxon = ["taxonomic_order", "subspecies_scientific_name"]
+    grouped = mocked_all[mocked_all["group_identifier"].notna()]
+    first = grouped.sort_values(
+        ["sampling_event_identifier", "global_unique_identifier"]
+    ).drop_duplicates(["group_identifier"] + taxon)
+    expected = set(
+        mocked_all.loc[
+            mocked_all["group_identifier"].isna(), "global_unique_identifier"
+        ]
+    ) | set(first["global_unique_identifier"])
+    assert len(expected) < len(mocked_all)
+
+    unique = queries.unique_checklists().select(["global_unique_identifier"])
+    result = [r[0] for r in unique.run(mocked_db)]
+    assert len(result) == len(expected)
+    assert set(result) == expected
+
+    # Duplicates are removed before aggregating
+    (count,) = queries.unique_checklists().group_by().count().run(mocked_db)[0]
+    assert count == len(expected)
+
+    # And after filtering
+    mallards = queries.species("Mallard").unique_checklists().run_pandas(mocked_db)
+    is_mallard = mocked_all["common_name"] == "Mallard"
+    assert set(mallards["global_unique_identifier"]) == expected & set(
+        mocked_all.loc[is_mallard, "global_unique_identifier"]
+    )
@@ -35,10 +35,10 @@ def compare_tables(df: pd.DataFrame, original: pd.DataFrame):
         assert comp.all()
 
 
-def run_rebuild(obs_path: Path, incremental: bool = False):
+def run_rebuild(obs_path: Path, incremental: bool = False, **kwargs):
     with NamedTemporaryFile() as output:
         if incremental:
-            db = auk_db.build_db_incremental(obs_path, Path(output.name))
+            db = auk_db.build_db_incremental(obs_path, Path(output.name), **kwargs)
         else:
             db = auk_db.build_db_pandas(obs_path, Path(output.name))
         q = queries.no_filter()
@@ -82,6 +82,14 @@ def test_rebuild_incremental_medium():
     run_rebuild(MEDIUM, incremental=True)
 
 
+def test_rebuild_incremental_mocked_small():
+    run_rebuild(M_SMALL, incremental=True, max_size=3000)
+
+
+def test_rebuild_parallel_mocked_small():
+    run_rebuild(M_SMALL, incremental=True, max_size=3000, workers=2)
+
+
 @pytest.mark.skip
 def test_rebuild_incremental_mocked():
     run_rebuild(M_MEDIUM, incremental=True)
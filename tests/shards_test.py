@@ -0,0 +1,107 @@
+import pytest
+import sqlite3
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from aukpy import db as auk_db, queries
+from aukpy.shards import ShardedDB, build_db_sharded
+
+from tests import data_utils
+
+
+@pytest.fixture(scope="module")
+def generated():
+    """A generated dataset, built both as a single database and sharded by country and by year."""
+    with TemporaryDirectory() as tmp:
+        input_path = data_utils.generate_mocked(Path(tmp) / "generated.txt", 3000)
+        single = auk_db.build_db_pandas(input_path, Path(tmp) / "single.sqlite")
+        by_country = build_db_sharded(input_path, Path(tmp) / "country", max_size=500)
+        by_year = build_db_sharded(input_path, Path(tmp) / "year", by="year", workers=2)
+        yield single, by_country, by_year
+        single.close()
+
+
+def sorted_rows(rows):
+    return sorted(rows, key=repr)
+
+
+def test_build_sharded(generated):
+    single, by_country, by_year = generated
+    total = single.execute("SELECT COUNT(*) FROM observation").fetchone()[0]
+    countries = single.execute(
+        "SELECT COUNT(DISTINCT country_code) FROM location_data"
+    ).fetchone()[0]
+    assert len(by_country) == countries
+    assert len(by_year) > countries
+    for sharded in (by_country, by_year):
+        assert sum(s["rows"] for s in sharded.shards.values()) == total
+        assert not (sharded.directory / "split").exists()
+    with pytest.raises(sqlite3.OperationalError):
+        by_country.connect("US").execute("DELETE FROM observation")
+
+
+def test_sharded_pruning(generated):
+    _, by_country, by_year = generated
+    assert by_country.shards_for(queries.country("CA")) == ["CA"]
+    assert by_country.shards_for(queries.country("Canada")) == ["CA"]
+    assert by_country.shards_for(queries.country("XX")) == []
+    assert len(by_country.shards_for(queries.species("Mallard"))) == len(by_country)
+    assert by_year.shards_for(queries.date("2010-01-01", "2011-12-31")) == [
+        "2010",
+        "2011",
+    ]
+    assert by_year.shards_for(queries.date("2010-01-01", "2010-12-31")) == ["2010"]
+    # Wildcard dates can't be pruned by year
+    assert len(by_year.shards_for(queries.date("*-03-01", "*-03-31"))) == len(by_year)
+
+
+def test_sharded_queries(generated):
+    single, by_country, by_year = generated
+    batch = [
+        queries.no_filter(),
+        queries.country(["CA", "GB"]),
+        queries.date("2010-01-01", "2012-06-30").select(["global_unique_identifier"]),
+        queries.group_by("scientific_name").count(),
+        queries.group_by("year", "country_code").count().sum("observation_count"),
+        queries.country("US").count(),
+    ]
+    for query in batch:
+        expected = sorted_rows(query.run(single))
+        for sharded in (by_country, by_year):
+            assert sorted_rows(sharded.run(query)) == expected
+
+            df = sharded.run_pandas(query)
+            assert len(df) == len(expected)
+            assert tuple(df.columns) == query._output_columns()
+
+
+def test_sharded_no_shards(generated):
+    single, by_country, _ = generated
+    query = queries.country("XX").count().sum("observation_count")
+    assert by_country.shards_for(query) == []
+    assert by_country.run(query) == query.run(single) == [(0, None)]
+    distinct = queries.country("XX").distinct("observer_id")
+    assert by_country.run(distinct) == distinct.run(single)
+    df = by_country.run_pandas(query)
+    assert df.values.tolist() == query.run_pandas(single).values.tolist()
+    assert tuple(df.columns) == query._output_columns()
+    # Grouped queries have no groups
+    assert by_country.run(queries.country("XX").group_by("year").count()) == []
+
+
+def test_sharded_distinct(generated):
+    single, by_country, by_year = generated
+    query = queries.group_by("country_code").distinct("observer_id")
+    assert sorted_rows(by_country.run(query)) == sorted_rows(query.run(single))
+    with pytest.raises(ValueError):
+        by_year.run(query)
+    # Fine if only one shard is queried
+    one_year = queries.date("2010-01-01", "2010-12-31").distinct("observer_id")
+    assert by_year.run(one_year) == one_year.run(single)
+
+
+def test_sharded_reopen(generated):
+    _, by_country, _ = generated
+    reopened = ShardedDB(by_country.directory)
+    assert reopened.partition == "country_code"
+    query = queries.country("GB").count()
+    assert reopened.run(query) == by_country.run(query)
@@ -49,3 +49,37 @@ def test_get_species():
     assert utils.get_all_species("gaviiformes") == loons
     assert utils.get_all_species("gaviidae") == loons
     assert utils.get_all_species("gavia") == loons
+
+
+def test_taxonomic_ranges():
+    taxonomy = utils.load_taxonomy()
+    for clade, column in (("gaviiformes", "order"), ("Gaviidae", "family")):
+        ranges = utils.get_taxonomic_ranges(clade)
+        assert len(ranges) == 1
+        in_clade = taxonomy.loc[taxonomy[column] == clade.lower(), "taxon_order"]
+        assert ranges[0] == (in_clade.min(), in_clade.max())
+    assert utils.get_taxonomic_ranges("gavia") == utils.get_taxonomic_ranges("gaviidae")
+
+    # Genera can be interleaved with others
+    ranges = utils.get_taxonomic_ranges("anas")
+    assert len(ranges) > 1
+    assert all(lo <= hi < next_lo for (lo, hi), (next_lo, _) in zip(ranges, ranges[1:]))
+    orders = taxonomy.loc[taxonomy["sci_name"].str.startswith("anas "), "taxon_order"]
+    assert all(any(lo <= o <= hi for lo, hi in ranges) for o in orders)
+    assert utils.get_taxonomic_ranges("not a clade") == []
+
+
+def test_taxonomy_index_cached(monkeypatch):
+    utils.taxonomy_index.cache_clear()
+    loads = []
+    load = utils.load_taxonomy
+    monkeypatch.setattr(utils, "load_taxonomy", lambda: loads.append(1) or load())
+
+    utils.get_all_species("gaviiformes")
+    utils.get_parent_taxon("gavia")
+    utils.get_child_taxa("gaviidae")
+    assert len(loads) == 1
+
+    index = utils.taxonomy_index()
+    assert index.species["gaviiformes"] == index.species["gavia"]
+    assert index.parents["gavia"] == "gaviidae"